@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Benchmark of reading gguf, reading and renaming ckpt, transposing and writing gguf on synthetic fixtures.
+Every stage runs in a fresh process, so its peak RSS is its own. Results are saved as json and can be compared
+with a previous run.
+
+python -m benchmarks.bench_convert --output bench.json
+python -m benchmarks.bench_convert --output bench-new.json --compare bench.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import traceback
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from gguf import GGMLQuantizationType
+
+from benchmarks.fixtures import LAYER_NAME_MAP_JSON_PATH, FixtureConfig, FixturePaths, make_fixtures
+# imported here, so that the import time is not charged to the stages
+from models.ckpt_convert_util import MsCkptRefactorHelper
+from models.ckpt_reader import MsCkptReader
+from models.main_writer import Writer
+from models.quantize_util import quantize
+from models.transpose_util import blocked_transpose
+from read_gguf import GGUFLoader
+
+QUANTIZE_POLICY_JSON_PATH = os.path.join(os.path.dirname(LAYER_NAME_MAP_JSON_PATH), "llama2_quantize_policy.json")
+DEFAULT_REPEAT = 3
+# slower than the compared run by more than this ratio is a regression
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+
+
+def peak_rss_kb() -> Optional[int]:
+    """peak resident set size of this process in KiB, None where it is not available"""
+    try:
+        # ru_maxrss of Linux counts the RSS of the parent at fork, VmHWM starts over at exec
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def bench_noop(paths: FixturePaths, work_dir: str) -> int:
+    """the interpreter with numpy, gguf and the benchmarked modules imported, its RSS is the baseline of other
+    stages"""
+    return 0
+
+
+def bench_header_parse(paths: FixturePaths, work_dir: str) -> int:
+    loader = GGUFLoader(paths.gguf_path)
+    loader.load()
+    loader.close()
+    return loader.data_offset
+
+
+def bench_tensor_read(paths: FixturePaths, work_dir: str) -> int:
+    loader = GGUFLoader(paths.gguf_path, tensor_cache_bytes=0)
+    loader.load()
+    n_bytes = sum(loader.tensor(name).nbytes for name in loader.tensor_names())
+    loader.close()
+    return n_bytes
+
+
+def bench_dequantize(paths: FixturePaths, work_dir: str) -> int:
+    loader = GGUFLoader(paths.gguf_path, tensor_cache_bytes=0)
+    loader.load()
+    n_bytes = sum(loader.dequantized_tensor(name).nbytes for name in loader.tensor_names())
+    loader.close()
+    return n_bytes
+
+
+def bench_ckpt_scan(paths: FixturePaths, work_dir: str) -> int:
+    with MsCkptReader(paths.ckpt_path) as reader:
+        n_bytes = sum(info.nbytes for info in reader.tensor_infos.values())
+    return n_bytes
+
+
+def bench_rename(paths: FixturePaths, work_dir: str) -> int:
+    helper = MsCkptRefactorHelper(paths.ckpt_path, LAYER_NAME_MAP_JSON_PATH)
+    helper.do_refactor()
+    n_tensors = len(helper.ckpt_dict)
+    helper.close()
+    return n_tensors
+
+
+def bench_transpose(paths: FixturePaths, work_dir: str) -> int:
+    n_bytes = 0
+    with MsCkptReader(paths.ckpt_path) as reader:
+        for tensor in reader:
+            if len(tensor.shape) == 2:
+                n_bytes += blocked_transpose(tensor.array(), (1, 0)).nbytes
+            del tensor
+    return n_bytes
+
+
+def _bench_quantize(paths: FixturePaths, quant_type: GGMLQuantizationType) -> int:
+    """encode the 2d ckpt tensors whose rows are whole blocks, the amount is their float32 bytes"""
+    n_bytes = 0
+    with MsCkptReader(paths.ckpt_path) as reader:
+        for tensor in reader:
+            if len(tensor.shape) == 2 and tensor.shape[-1] % 256 == 0:
+                ndarray = MsCkptRefactorHelper.convert_ms_tensor_to_ndarray(tensor, tensor.name)
+                quantize(ndarray, quant_type)
+                n_bytes += ndarray.size * 4
+            del tensor
+    return n_bytes
+
+
+def bench_quantize_q2_k(paths: FixturePaths, work_dir: str) -> int:
+    return _bench_quantize(paths, GGMLQuantizationType.Q2_K)
+
+
+def bench_quantize_q3_k(paths: FixturePaths, work_dir: str) -> int:
+    return _bench_quantize(paths, GGMLQuantizationType.Q3_K)
+
+
+def _bench_write(paths: FixturePaths, work_dir: str, **kwargs) -> int:
+    output_path = os.path.join(work_dir, "bench-output.gguf")
+    writer = Writer(metadata_json_path=paths.metadata_json_path, layer_name_map_json_path=LAYER_NAME_MAP_JSON_PATH,
+                    ckpt_file_path=paths.ckpt_path, arch="llama", output_path=output_path, **kwargs)
+    writer.write()
+    n_bytes = os.path.getsize(output_path)
+    os.remove(output_path)
+    return n_bytes
+
+
+def bench_write(paths: FixturePaths, work_dir: str) -> int:
+    return _bench_write(paths, work_dir)
+
+
+def bench_write_quantized(paths: FixturePaths, work_dir: str) -> int:
+    return _bench_write(paths, work_dir, quantize_policy_json_path=QUANTIZE_POLICY_JSON_PATH)
+
+
+def bench_write_pipeline(paths: FixturePaths, work_dir: str) -> int:
+    return _bench_write(paths, work_dir, pipeline=True)
+
+
+def bench_write_quantized_workers(paths: FixturePaths, work_dir: str) -> int:
+    """compared with write_quantized, it shows the scaling of workers on this machine"""
+    return _bench_write(paths, work_dir, quantize_policy_json_path=QUANTIZE_POLICY_JSON_PATH,
+                        workers=os.cpu_count() or 1)
+
+
+# stage name to (function, unit of the returned amount)
+STAGE_DICT: Dict[str, tuple] = {
+    "noop": (bench_noop, "bytes"),
+    "header_parse": (bench_header_parse, "bytes"),
+    "tensor_read": (bench_tensor_read, "bytes"),
+    "dequantize": (bench_dequantize, "bytes"),
+    "ckpt_scan": (bench_ckpt_scan, "bytes"),
+    "rename": (bench_rename, "tensors"),
+    "transpose": (bench_transpose, "bytes"),
+    "quantize_q2_k": (bench_quantize_q2_k, "bytes"),
+    "quantize_q3_k": (bench_quantize_q3_k, "bytes"),
+    "write": (bench_write, "bytes"),
+    "write_quantized": (bench_write_quantized, "bytes"),
+    "write_pipeline": (bench_write_pipeline, "bytes"),
+    "write_quantized_workers": (bench_write_quantized_workers, "bytes"),
+}
+
+
+def _run_stage(conn, stage: str, paths: FixturePaths, work_dir: str):
+    """entry of the stage process, it sends (seconds, amount, peak rss) or the traceback"""
+    try:
+        func: Callable[[FixturePaths, str], int] = STAGE_DICT[stage][0]
+        start = time.perf_counter()
+        amount = func(paths, work_dir)
+        seconds = time.perf_counter() - start
+        conn.send(("ok", seconds, amount, peak_rss_kb()))
+    except BaseException:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def run_isolated(stage: str, paths: FixturePaths, work_dir: str) -> tuple:
+    """run one stage in a spawned process, so neither memory nor imports leak between stages"""
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=_run_stage, args=(child_conn, stage, paths, work_dir))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        result = ("error", "stage process exited with code {0}".format(process.exitcode))
+    if result[0] != "ok":
+        raise RuntimeError("stage {0} failed:\n{1}".format(stage, result[1]))
+    return result[1:]
+
+
+def run_benchmark(config: FixtureConfig, work_dir: str, stages: List[str], repeat: int = DEFAULT_REPEAT) -> dict:
+    """
+    :param config: fixture config
+    :param work_dir: directory of fixtures and outputs
+    :param stages: names of stages to run, see STAGE_DICT
+    :param repeat: every stage runs this many times, the fastest run is reported
+    :return: json serializable results
+    """
+    paths = make_fixtures(work_dir, config)
+    results = {}
+    for stage in stages:
+        runs = [run_isolated(stage, paths, work_dir) for _ in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        amount = runs[0][1]
+        peak_rss = [run[2] for run in runs if run[2] is not None]
+        unit = STAGE_DICT[stage][1]
+        results[stage] = {"seconds": seconds, "runs": [run[0] for run in runs], unit: amount,
+                          "{0}_per_second".format(unit): amount / seconds if seconds > 0 else None,
+                          "peak_rss_kb": max(peak_rss) if peak_rss else None}
+        logging.info("%s: %.4f s, %s %s, peak rss %s KiB", stage, seconds, amount, unit, results[stage]["peak_rss_kb"])
+    return {
+        "config": config.to_dict(),
+        "fixtures": {"gguf_bytes": os.path.getsize(paths.gguf_path), "ckpt_bytes": os.path.getsize(paths.ckpt_path)},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                        "machine": platform.machine(), "cpu_count": os.cpu_count()},
+        "repeat": repeat,
+        "stages": results,
+    }
+
+
+def compare(result: dict, baseline: dict, threshold: float = DEFAULT_REGRESSION_THRESHOLD) -> List[str]:
+    """
+    :param result: result of this run
+    :param baseline: result of a previous run
+    :param threshold: ratio of slow down regarded as a regression
+    :return: lines of the comparison table, regressions are marked
+    """
+    lines = ["{0:<16} {1:>10} {2:>10} {3:>8}".format("stage", "base s", "new s", "ratio")]
+    for stage, stats in result["stages"].items():
+        base_stats = baseline.get("stages", {}).get(stage)
+        if base_stats is None:
+            lines.append("{0:<16} {1:>10} {2:>10.4f}".format(stage, "-", stats["seconds"]))
+            continue
+        ratio = stats["seconds"] / base_stats["seconds"] if base_stats["seconds"] > 0 else float("inf")
+        mark = "  REGRESSION" if ratio > 1 + threshold else ""
+        lines.append("{0:<16} {1:>10.4f} {2:>10.4f} {3:>8.3f}{4}".format(stage, base_stats["seconds"],
+                                                                         stats["seconds"], ratio, mark))
+    if baseline.get("config") != result["config"]:
+        lines.append("fixture configs differ, the comparison is not meaningful")
+    return lines
+
+
+if __name__ == '__main__':
+    default_config = FixtureConfig()
+    parser = argparse.ArgumentParser(description="benchmark gguf conversion on synthetic fixtures")
+    parser.add_argument("--work-dir", default="bench_data", help="directory of fixtures and outputs")
+    parser.add_argument("--layers", type=int, default=default_config.n_layers, help="number of layers")
+    parser.add_argument("--hidden", type=int, default=default_config.hidden_size, help="hidden size")
+    parser.add_argument("--ffn", type=int, default=default_config.ffn_size, help="feed forward size")
+    parser.add_argument("--vocab", type=int, default=default_config.vocab_size, help="vocabulary size")
+    parser.add_argument("--ckpt-dtype", default=default_config.ckpt_dtype, choices=["Float32", "Float16", "BFloat16"],
+                        help="tensor type of ckpt")
+    parser.add_argument("--quant-types", default=",".join(default_config.quant_types),
+                        help="comma separated ggml types of 2d weights in the reference gguf")
+    parser.add_argument("--stages", default=",".join(STAGE_DICT), help="comma separated stages to run")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="runs of every stage")
+    parser.add_argument("--output", default=None, help="save results to this json file path")
+    parser.add_argument("--compare", default=None, help="results json of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="slow down ratio regarded as a regression")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    stage_names = [stage for stage in args.stages.split(",") if stage]
+    for stage_name in stage_names:
+        if stage_name not in STAGE_DICT:
+            parser.error("unknown stage {0}, choose from {1}".format(stage_name, ", ".join(STAGE_DICT)))
+    bench_config = FixtureConfig(args.layers, args.hidden, args.ffn, args.vocab, args.ckpt_dtype,
+                                 tuple(args.quant_types.split(",")))
+    bench_result = run_benchmark(bench_config, args.work_dir, stage_names, args.repeat)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(bench_result, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compared = json.load(f)
+        comparison = compare(bench_result, compared, args.threshold)
+        print("\n".join(comparison))
+        sys.exit(1 if any(line.endswith("REGRESSION") for line in comparison) else 0)
+    print(json.dumps(bench_result["stages"], indent=2))
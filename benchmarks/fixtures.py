@@ -0,0 +1,213 @@
+"""
+Synthetic llama shaped fixtures for benchmarks: a reference gguf, a MindSpore ckpt and the metadata json, they are
+generated offline from random numbers, MindSpore is not needed
+"""
+import json
+import os
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+
+import numpy as np
+from gguf import GGUFWriter, GGMLQuantizationType
+
+from models.ckpt_convert_util import LayerNameMapper
+from models.quantize_util import quant_block_and_type_size, quantize, quantized_nbytes
+
+LAYER_NAME_MAP_JSON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models",
+                                        "llama2", "configs", "llama2_layer_name_map.json")
+
+# numpy dtype of ckpt tensor types, bfloat16 is generated as the high half of float32
+CKPT_DTYPE_DICT = {"Float32": np.float32, "Float16": np.float16, "BFloat16": np.uint16}
+_SEED = 0
+# fixtures are written under a temporary name, an interrupted run never leaves a fixture to reuse
+_TEMP_SUFFIX = ".tmp"
+
+
+class FixtureConfig(NamedTuple):
+    n_layers: int = 4
+    hidden_size: int = 512
+    ffn_size: int = 1536
+    vocab_size: int = 32000
+    # ckpt tensor type, "Float32", "Float16" or "BFloat16"
+    ckpt_dtype: str = "Float32"
+    # ggml types of 2d weights in the reference gguf, used in turn tensor by tensor
+    quant_types: Tuple[str, ...] = ("Q4_K", "Q6_K", "Q8_0")
+
+    def to_dict(self) -> dict:
+        return {key: list(value) if isinstance(value, tuple) else value for key, value in self._asdict().items()}
+
+
+class FixturePaths(NamedTuple):
+    gguf_path: str
+    ckpt_path: str
+    metadata_json_path: str
+
+
+def ms_tensor_shapes(config: FixtureConfig) -> Iterator[Tuple[str, Tuple[int, ...]]]:
+    """ms tensor names and shapes of a llama model, in ckpt order"""
+    hidden, ffn = config.hidden_size, config.ffn_size
+    yield "model.tok_embeddings.embedding_weight", (config.vocab_size, hidden)
+    for layer in range(config.n_layers):
+        prefix = "model.layers.{0}.".format(layer)
+        yield prefix + "attention_norm.weight", (hidden,)
+        for name in ("wq", "wk", "wv", "wo"):
+            yield prefix + "attention.{0}.weight".format(name), (hidden, hidden)
+        yield prefix + "ffn_norm.weight", (hidden,)
+        yield prefix + "feed_forward.w1.weight", (ffn, hidden)
+        yield prefix + "feed_forward.w3.weight", (ffn, hidden)
+        yield prefix + "feed_forward.w2.weight", (hidden, ffn)
+    yield "model.norm_out.weight", (hidden,)
+    yield "lm_head.weight", (config.vocab_size, hidden)
+
+
+def gguf_tensor_shapes(config: FixtureConfig) -> Iterator[Tuple[str, Tuple[int, ...]]]:
+    """gguf tensor names and numpy shapes, same order as ckpt"""
+    mapper = LayerNameMapper.from_json(LAYER_NAME_MAP_JSON_PATH)
+    for ms_name, shape in ms_tensor_shapes(config):
+        yield mapper.rename(ms_name), shape
+
+
+def _random_weight(rng: np.random.Generator, shape: Tuple[int, ...]) -> np.ndarray:
+    return rng.standard_normal(shape, dtype=np.float32) * np.float32(0.02)
+
+
+def tokenizer_metadata(vocab_size: int) -> Dict[str, list]:
+    """tokenizer arrays shaped like a sentencepiece vocabulary, byte tokens first"""
+    tokens: List[str] = ["<unk>", "<s>", "</s>"] + ["<0x{0:02X}>".format(i) for i in range(256)]
+    tokens += ["▁tok{0}".format(i) for i in range(vocab_size - len(tokens))]
+    tokens = tokens[:vocab_size]
+    scores = [float(-i) for i in range(vocab_size)]
+    # normal 1, unknown 2, control 3, byte 6
+    token_types = [2, 3, 3] + [6] * 256 + [1] * (vocab_size - 259)
+    return {"tokenizer.ggml.tokens": tokens, "tokenizer.ggml.scores": scores,
+            "tokenizer.ggml.token_type": token_types[:vocab_size]}
+
+
+def metadata_kv_pairs(config: FixtureConfig) -> dict:
+    metadata = {
+        "general.architecture": "llama",
+        "general.name": "synthetic llama",
+        "llama.context_length": 4096,
+        "llama.embedding_length": config.hidden_size,
+        "llama.block_count": config.n_layers,
+        "llama.feed_forward_length": config.ffn_size,
+        "llama.rope.dimension_count": 128,
+        "llama.attention.head_count": max(1, config.hidden_size // 128),
+        "llama.attention.head_count_kv": max(1, config.hidden_size // 128),
+        "llama.attention.layer_norm_rms_epsilon": 1e-05,
+        "tokenizer.ggml.model": "llama",
+        "tokenizer.ggml.bos_token_id": 1,
+        "tokenizer.ggml.eos_token_id": 2,
+        "tokenizer.ggml.unknown_token_id": 0,
+    }
+    metadata.update(tokenizer_metadata(config.vocab_size))
+    return metadata
+
+
+def _varint(value: int) -> bytes:
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _length_delimited(field: int, length: int) -> bytes:
+    return _varint(field << 3 | 2) + _varint(length)
+
+
+def ckpt_value_prefix(name: str, tensor_type: str, shape: Tuple[int, ...], nbytes: int) -> bytes:
+    """
+    protobuf bytes of Checkpoint.value before the tensor content, the content follows them directly.
+    :param name: ms tensor name
+    :param tensor_type: ckpt tensor type, such as "Float32"
+    :param shape: tensor shape
+    :param nbytes: bytes of tensor content
+    :return:
+    """
+    dims = b"".join(_varint(1 << 3) + _varint(dim) for dim in shape)
+    tensor_type_bytes = tensor_type.encode("utf-8")
+    tensor_head = dims + _length_delimited(2, len(tensor_type_bytes)) + tensor_type_bytes + \
+        _length_delimited(3, nbytes)
+    tensor_length = len(tensor_head) + nbytes
+    name_bytes = name.encode("utf-8")
+    value_head = _length_delimited(1, len(name_bytes)) + name_bytes + _length_delimited(2, tensor_length) + \
+        tensor_head
+    return _length_delimited(1, len(value_head) + nbytes) + value_head
+
+
+def write_ckpt(ckpt_path: str, config: FixtureConfig):
+    """write the ckpt tensor by tensor, in the framing of mindspore.save_checkpoint"""
+    rng = np.random.default_rng(_SEED)
+    with open(ckpt_path, "wb") as f:
+        for name, shape in ms_tensor_shapes(config):
+            weight = _random_weight(rng, shape)
+            if config.ckpt_dtype == "BFloat16":
+                weight = (weight.view(np.uint32) >> 16).astype(np.uint16)
+            else:
+                weight = weight.astype(CKPT_DTYPE_DICT[config.ckpt_dtype], copy=False)
+            f.write(ckpt_value_prefix(name, config.ckpt_dtype, shape, weight.nbytes))
+            f.write(memoryview(weight.reshape(-1)).cast("B"))
+
+
+def write_reference_gguf(gguf_path: str, config: FixtureConfig, metadata: dict):
+    """write a quantized reference gguf, 1d tensors are F32, 2d weights use the quant types in turn"""
+    writer = GGUFWriter(gguf_path, "llama")
+    for key, value in metadata.items():
+        if key == "general.architecture":
+            continue
+        if isinstance(value, bool):
+            writer.add_bool(key, value)
+        elif isinstance(value, int):
+            writer.add_uint32(key, value)
+        elif isinstance(value, float):
+            writer.add_float32(key, value)
+        elif isinstance(value, str):
+            writer.add_string(key, value)
+        else:
+            writer.add_array(key, value)
+    tensor_types = []
+    for index, (name, shape) in enumerate(gguf_tensor_shapes(config)):
+        tensor_type = GGMLQuantizationType.F32
+        if len(shape) == 2:
+            tensor_type = GGMLQuantizationType[config.quant_types[index % len(config.quant_types)]]
+            if shape[-1] % quant_block_and_type_size(tensor_type)[0] != 0:
+                # as the fallback of quantize policy
+                tensor_type = GGMLQuantizationType.F16
+        writer.add_tensor_info(name, shape, np.dtype(np.float32), quantized_nbytes(shape, tensor_type),
+                               raw_dtype=tensor_type)
+        tensor_types.append(tensor_type)
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_ti_data_to_file()
+    # tensors are generated and written one by one, only one is in memory
+    rng = np.random.default_rng(_SEED)
+    for (_, shape), tensor_type in zip(gguf_tensor_shapes(config), tensor_types):
+        writer.write_tensor_data(quantize(_random_weight(rng, shape), tensor_type))
+    writer.close()
+
+
+def make_fixtures(work_dir: str, config: FixtureConfig) -> FixturePaths:
+    """
+    generate the fixtures once, they are reused when a fixture of the same config exists in work_dir.
+    :param work_dir: directory of fixtures
+    :param config:
+    :return:
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    key = "l{0}_h{1}_f{2}_v{3}_{4}_{5}".format(config.n_layers, config.hidden_size, config.ffn_size,
+                                              config.vocab_size, config.ckpt_dtype, "_".join(config.quant_types))
+    paths = FixturePaths(os.path.join(work_dir, key + ".gguf"), os.path.join(work_dir, key + ".ckpt"),
+                         os.path.join(work_dir, key + "-metadata.json"))
+    metadata = metadata_kv_pairs(config)
+    if not os.path.isfile(paths.metadata_json_path):
+        with open(paths.metadata_json_path + _TEMP_SUFFIX, "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+        os.replace(paths.metadata_json_path + _TEMP_SUFFIX, paths.metadata_json_path)
+    if not os.path.isfile(paths.ckpt_path):
+        write_ckpt(paths.ckpt_path + _TEMP_SUFFIX, config)
+        os.replace(paths.ckpt_path + _TEMP_SUFFIX, paths.ckpt_path)
+    if not os.path.isfile(paths.gguf_path):
+        write_reference_gguf(paths.gguf_path + _TEMP_SUFFIX, config, metadata)
+        os.replace(paths.gguf_path + _TEMP_SUFFIX, paths.gguf_path)
+    return paths
@@ -26,6 +26,22 @@ GGML_TENSOR_QUANTIZE_DICT = {
     "Q8_K": GGMLQuantizationType.Q8_K
 }
 
+# refer to llama_ftype of llama.cpp, value of general.file_type when most tensors use the quantization type
+GGML_FILE_TYPE_DICT = {
+    "F32": 0,
+    "F16": 1,
+    "Q4_0": 2,
+    "Q4_1": 3,
+    "Q8_0": 7,
+    "Q5_0": 8,
+    "Q5_1": 9,
+    "Q2_K": 10,
+    "Q3_K": 12,
+    "Q4_K": 15,
+    "Q5_K": 17,
+    "Q6_K": 18
+}
+
 
 class GGMLType(Enum):
     F32 = np.uint32(0)
@@ -99,7 +115,9 @@ class FormatCharacter:
 
 
 ggml_type_np_type_dict = {
-    GGMLType.F32: FormatCharacter.FLOAT32, GGMLType.F16: FormatCharacter.FLOAT16
+    GGMLType.F32: FormatCharacter.FLOAT32, GGMLType.F16: FormatCharacter.FLOAT16,
+    GGMLType.I8: FormatCharacter.INT8, GGMLType.I16: FormatCharacter.INT16, GGMLType.I32: FormatCharacter.INT32,
+    GGMLType.I64: FormatCharacter.INT64, GGMLType.F64: FormatCharacter.FLOAT64
 }
 
 FORMAT_CHARACTER_DICT = {
@@ -127,7 +145,8 @@ FORMAT_NP_TYPE_DICT = {
     "q": np.int64,
     "f": np.float32,
     "d": np.float64,
-    "?": np.bool_
+    "?": np.bool_,
+    "e": np.float16
 }
 
 
@@ -261,4 +280,9 @@ GGML_QUANT_SIZES_DICT = {
     GGMLType.Q5_K: (256, 2 + 2 + QK_K // 2 + QK_K // 8 + 12),
     GGMLType.Q6_K: (256, 2 + QK_K // 2 + QK_K // 4 + QK_K // 16),
     GGMLType.Q8_K: (256, 4 + QK_K + QK_K // 8),
+    GGMLType.I8:   (1, 1),
+    GGMLType.I16:  (1, 2),
+    GGMLType.I32:  (1, 4),
+    GGMLType.I64:  (1, 8),
+    GGMLType.F64:  (1, 8),
 }
@@ -0,0 +1,251 @@
+"""
+Vectorized numpy dequantizers which decode ggml blocks into float32, the arithmetic follows ggml-quants.c
+"""
+from typing import Callable, Dict
+
+import numpy as np
+
+from constant import GGMLType, GGUFException, GGML_QUANT_SIZES_DICT, QK_K
+
+# blocks are decoded in chunks of about this number of elements, so that temporaries stay small
+_CHUNK_ELEMENTS = 1 << 22
+
+
+def _f16(columns: np.ndarray) -> np.ndarray:
+    """(n, 2) uint8 -> (n, 1) float32"""
+    return np.ascontiguousarray(columns).view(np.float16).astype(np.float32)
+
+
+def _f32(columns: np.ndarray) -> np.ndarray:
+    """(n, 4) uint8 -> (n, 1) float32"""
+    return np.ascontiguousarray(columns).view(np.float32)
+
+
+def _nibbles(qs: np.ndarray) -> np.ndarray:
+    """(n, 16) uint8 -> (n, 32), element j is the low nibble of byte j, element j + 16 the high nibble"""
+    return np.concatenate([qs & 0xF, qs >> 4], axis=1)
+
+
+def _high_bits(qh: np.ndarray) -> np.ndarray:
+    """(n, 4) uint8 of a little endian uint32 -> (n, 32), bit j of it for element j"""
+    return np.unpackbits(qh, axis=1, bitorder="little")
+
+
+def dequantize_q4_0(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q4_0: half d, uint8 qs[16]
+    :param blocks: (n, 18) uint8
+    :return: (n, 32) float32
+    """
+    d = _f16(blocks[:, :2])
+    return d * (_nibbles(blocks[:, 2:]).astype(np.int8) - 8)
+
+
+def dequantize_q4_1(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q4_1: half d, half m, uint8 qs[16]
+    :param blocks: (n, 20) uint8
+    :return: (n, 32) float32
+    """
+    d = _f16(blocks[:, :2])
+    m = _f16(blocks[:, 2:4])
+    return d * _nibbles(blocks[:, 4:]) + m
+
+
+def dequantize_q5_0(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q5_0: half d, uint8 qh[4], uint8 qs[16]
+    :param blocks: (n, 22) uint8
+    :return: (n, 32) float32
+    """
+    d = _f16(blocks[:, :2])
+    q = _nibbles(blocks[:, 6:]) | (_high_bits(blocks[:, 2:6]) << 4)
+    return d * (q.astype(np.int8) - 16)
+
+
+def dequantize_q5_1(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q5_1: half d, half m, uint8 qh[4], uint8 qs[16]
+    :param blocks: (n, 24) uint8
+    :return: (n, 32) float32
+    """
+    d = _f16(blocks[:, :2])
+    m = _f16(blocks[:, 2:4])
+    q = _nibbles(blocks[:, 8:]) | (_high_bits(blocks[:, 4:8]) << 4)
+    return d * q + m
+
+
+def dequantize_q8_0(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q8_0: half d, int8 qs[32]
+    :param blocks: (n, 34) uint8
+    :return: (n, 32) float32
+    """
+    return _f16(blocks[:, :2]) * blocks[:, 2:].view(np.int8)
+
+
+def dequantize_q8_1(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q8_1: float d, float s, int8 qs[32], s is only used by dot products
+    :param blocks: (n, 40) uint8
+    :return: (n, 32) float32
+    """
+    return _f32(blocks[:, :4]) * blocks[:, 8:].view(np.int8)
+
+
+def dequantize_q2_k(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q2_K: uint8 scales[16], uint8 qs[64], half d, half dmin.
+    16 sub blocks of 16 elements, low 4 bits of a scale byte is the scale, high 4 bits the min.
+    :param blocks: (n, 84) uint8
+    :return: (n, 256) float32
+    """
+    n_blocks = blocks.shape[0]
+    scales = blocks[:, :16]
+    d = _f16(blocks[:, 80:82])
+    dmin = _f16(blocks[:, 82:84])
+    dl = d * (scales & 0xF)
+    ml = dmin * (scales >> 4)
+    # 2 halves of 32 bytes, 4 crumbs of every byte
+    shifts = np.array([0, 2, 4, 6], dtype=np.uint8).reshape(1, 1, 4, 1)
+    q = (blocks[:, 16:80].reshape(n_blocks, 2, 1, 32) >> shifts) & 3
+    return (dl[:, :, np.newaxis] * q.reshape(n_blocks, 16, 16) - ml[:, :, np.newaxis]).reshape(n_blocks, QK_K)
+
+
+def _unpack_q3_k_scales(scales: np.ndarray) -> np.ndarray:
+    """(n, 12) uint8 -> (n, 16) 6 bits scales, the low 4 bits are packed in bytes 0-7, high 2 bits in bytes 8-11"""
+    low = np.concatenate([scales[:, 0:8] & 0xF, scales[:, 0:8] >> 4], axis=1)
+    high = np.concatenate([(scales[:, 8:12] >> shift) & 3 for shift in (0, 2, 4, 6)], axis=1)
+    return low | (high << 4)
+
+
+def dequantize_q3_k(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q3_K: uint8 hmask[32], uint8 qs[64], uint8 scales[12], half d.
+    16 sub blocks of 16 elements, element is 2 low bits in qs minus 4 when its bit in hmask is not set.
+    :param blocks: (n, 110) uint8
+    :return: (n, 256) float32
+    """
+    n_blocks = blocks.shape[0]
+    d = _f16(blocks[:, 108:110])
+    dl = d * (_unpack_q3_k_scales(blocks[:, 96:108]).astype(np.int8) - 32)
+    shifts = np.array([0, 2, 4, 6], dtype=np.uint8).reshape(1, 1, 4, 1)
+    q = ((blocks[:, 32:96].reshape(n_blocks, 2, 1, 32) >> shifts) & 3).astype(np.int8)
+    # bit h * 4 + j of hmask byte l belongs to element l of crumb j of half h
+    hmask_shifts = np.arange(8, dtype=np.uint8).reshape(1, 2, 4, 1)
+    h = (blocks[:, 0:32].reshape(n_blocks, 1, 1, 32) >> hmask_shifts) & 1
+    q = q - ((1 - h.astype(np.int8)) << 2)
+    return (dl[:, :, np.newaxis] * q.reshape(n_blocks, 16, 16)).reshape(n_blocks, QK_K)
+
+
+def _unpack_k4_scales(scales: np.ndarray):
+    """
+    same as get_scale_min_k4 of ggml, (n, 12) uint8 -> (n, 8) scales and (n, 8) mins of 6 bits
+    """
+    sc = np.concatenate([scales[:, 0:4] & 63, (scales[:, 8:12] & 0xF) | ((scales[:, 0:4] >> 6) << 4)], axis=1)
+    m = np.concatenate([scales[:, 4:8] & 63, (scales[:, 8:12] >> 4) | ((scales[:, 4:8] >> 6) << 4)], axis=1)
+    return sc, m
+
+
+def dequantize_q4_k(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q4_K: half d, half dmin, uint8 scales[12], uint8 qs[128].
+    8 sub blocks of 32 elements, sub block 2i is the low nibbles of qs[32i:32i + 32], 2i + 1 the high nibbles.
+    :param blocks: (n, 144) uint8
+    :return: (n, 256) float32
+    """
+    n_blocks = blocks.shape[0]
+    d = _f16(blocks[:, 0:2])
+    dmin = _f16(blocks[:, 2:4])
+    sc, m = _unpack_k4_scales(blocks[:, 4:16])
+    qs = blocks[:, 16:144].reshape(n_blocks, 4, 1, 32)
+    q = (qs >> np.array([0, 4], dtype=np.uint8).reshape(1, 1, 2, 1)) & 0xF
+    return ((d * sc)[:, :, np.newaxis] * q.reshape(n_blocks, 8, 32)
+            - (dmin * m)[:, :, np.newaxis]).reshape(n_blocks, QK_K)
+
+
+def dequantize_q5_k(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q5_K: half d, half dmin, uint8 scales[12], uint8 qh[32], uint8 qs[128].
+    same as Q4_K, bit i of qh[l] is the fifth bit of element l of sub block i.
+    :param blocks: (n, 176) uint8
+    :return: (n, 256) float32
+    """
+    n_blocks = blocks.shape[0]
+    d = _f16(blocks[:, 0:2])
+    dmin = _f16(blocks[:, 2:4])
+    sc, m = _unpack_k4_scales(blocks[:, 4:16])
+    qs = blocks[:, 48:176].reshape(n_blocks, 4, 1, 32)
+    q = ((qs >> np.array([0, 4], dtype=np.uint8).reshape(1, 1, 2, 1)) & 0xF).reshape(n_blocks, 8, 32)
+    qh = (blocks[:, 16:48].reshape(n_blocks, 1, 32) >> np.arange(8, dtype=np.uint8).reshape(1, 8, 1)) & 1
+    q = q | (qh << 4)
+    return ((d * sc)[:, :, np.newaxis] * q - (dmin * m)[:, :, np.newaxis]).reshape(n_blocks, QK_K)
+
+
+def dequantize_q6_k(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q6_K: uint8 ql[128], uint8 qh[64], int8 scales[16], half d.
+    16 sub blocks of 16 elements, element is 4 low bits in ql and 2 high bits in qh minus 32.
+    :param blocks: (n, 210) uint8
+    :return: (n, 256) float32
+    """
+    n_blocks = blocks.shape[0]
+    d = _f16(blocks[:, 208:210])
+    scales = blocks[:, 192:208].view(np.int8)
+    # every half of 128 elements: low nibbles of ql[0:32], ql[32:64], then high nibbles of them
+    ql = blocks[:, 0:128].reshape(n_blocks, 2, 1, 2, 32)
+    low = ((ql >> np.array([0, 4], dtype=np.uint8).reshape(1, 1, 2, 1, 1)) & 0xF).reshape(n_blocks, 2, 4, 32)
+    qh = blocks[:, 128:192].reshape(n_blocks, 2, 1, 32)
+    high = (qh >> np.array([0, 2, 4, 6], dtype=np.uint8).reshape(1, 1, 4, 1)) & 3
+    q = (low | (high << 4)).astype(np.int8) - 32
+    return ((d * scales)[:, :, np.newaxis] * q.reshape(n_blocks, 16, 16)).reshape(n_blocks, QK_K)
+
+
+def dequantize_q8_k(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q8_K: float d, int8 qs[256], int16 bsums[16], bsums are only used by dot products
+    :param blocks: (n, 292) uint8
+    :return: (n, 256) float32
+    """
+    return _f32(blocks[:, :4]) * blocks[:, 4:260].view(np.int8)
+
+
+DEQUANTIZE_FUNC_DICT: Dict[GGMLType, Callable[[np.ndarray], np.ndarray]] = {
+    GGMLType.Q4_0: dequantize_q4_0,
+    GGMLType.Q4_1: dequantize_q4_1,
+    GGMLType.Q5_0: dequantize_q5_0,
+    GGMLType.Q5_1: dequantize_q5_1,
+    GGMLType.Q8_0: dequantize_q8_0,
+    GGMLType.Q8_1: dequantize_q8_1,
+    GGMLType.Q2_K: dequantize_q2_k,
+    GGMLType.Q3_K: dequantize_q3_k,
+    GGMLType.Q4_K: dequantize_q4_k,
+    GGMLType.Q5_K: dequantize_q5_k,
+    GGMLType.Q6_K: dequantize_q6_k,
+    GGMLType.Q8_K: dequantize_q8_k,
+}
+
+
+def dequantize(data: np.ndarray, ggml_type: GGMLType) -> np.ndarray:
+    """
+    decode rows of a tensor.
+    :param data: tensor laid out as GGUFLoader.tensor_layout, quantized rows are uint8 whose last axis is the bytes
+        of a row, other types are typed ndarray
+    :param ggml_type:
+    :return: float32 ndarray, the last axis of quantized rows becomes the elements of a row
+    """
+    if ggml_type not in DEQUANTIZE_FUNC_DICT:
+        if ggml_type not in GGML_QUANT_SIZES_DICT or GGML_QUANT_SIZES_DICT[ggml_type][0] != 1:
+            raise GGUFException("unsupported dequantization type: {0}".format(ggml_type.name))
+        return data.astype(np.float32)
+    block_size, type_size = GGML_QUANT_SIZES_DICT[ggml_type]
+    if data.dtype != np.uint8 or data.ndim == 0 or data.shape[-1] % type_size != 0:
+        raise GGUFException("rows of {0} should be uint8 of a multiple of {1} bytes, got {2} {3}".format(
+            ggml_type.name, type_size, data.dtype, data.shape))
+    dequantize_func = DEQUANTIZE_FUNC_DICT[ggml_type]
+    blocks = data.reshape(-1, type_size)
+    result = np.empty((blocks.shape[0], block_size), dtype=np.float32)
+    chunk_blocks = max(1, _CHUNK_ELEMENTS // block_size)
+    for start in range(0, blocks.shape[0], chunk_blocks):
+        result[start:start + chunk_blocks] = dequantize_func(blocks[start:start + chunk_blocks])
+    return result.reshape(data.shape[:-1] + (data.shape[-1] // type_size * block_size,))
@@ -0,0 +1,331 @@
+"""
+Parse the GGUF header (metadata kv pairs and tensors info) from large buffered chunks with a moving cursor
+"""
+import fnmatch
+import re
+import struct
+from typing import BinaryIO, List, Any, Callable, Optional, Sequence
+
+import numpy as np
+
+from constant import GGUFException, GGUFString, GGUFMetadataKV, GGUFMetadataValueType, GGUFTensorInfo, GGMLType
+from gguf_tensor_table import GGML_MAX_DIMS, GGUFTensorTable
+
+ENCODING = "utf-8"
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+_UINT32 = struct.Struct("<I")
+_UINT64 = struct.Struct("<Q")
+# special characters of fnmatch patterns
+_WILDCARD_CHARS = "*?["
+# dimensions, type and offset of a tensor info, by number of dimensions
+_TENSOR_INFO_TAIL_STRUCTS = [struct.Struct("<{0}QIQ".format(n_dimensions)) for n_dimensions in range(GGML_MAX_DIMS + 1)]
+_DIMENSION_PADDINGS = [(1,) * (GGML_MAX_DIMS - n_dimensions) for n_dimensions in range(GGML_MAX_DIMS + 1)]
+
+# scalar struct of numeric metadata value types, gguf is little endian
+METADATA_SCALAR_STRUCT_DICT = {
+    GGUFMetadataValueType.UINT8: struct.Struct("<B"),
+    GGUFMetadataValueType.INT8: struct.Struct("<b"),
+    GGUFMetadataValueType.UINT16: struct.Struct("<H"),
+    GGUFMetadataValueType.INT16: struct.Struct("<h"),
+    GGUFMetadataValueType.UINT32: struct.Struct("<I"),
+    GGUFMetadataValueType.INT32: struct.Struct("<i"),
+    GGUFMetadataValueType.FLOAT32: struct.Struct("<f"),
+    GGUFMetadataValueType.BOOL: struct.Struct("<?"),
+    GGUFMetadataValueType.UINT64: struct.Struct("<Q"),
+    GGUFMetadataValueType.INT64: struct.Struct("<q"),
+    GGUFMetadataValueType.FLOAT64: struct.Struct("<d"),
+}
+
+# numpy dtype of numeric metadata value types, used to decode arrays in bulk
+METADATA_NP_DTYPE_DICT = {
+    GGUFMetadataValueType.UINT8: np.dtype("<u1"),
+    GGUFMetadataValueType.INT8: np.dtype("<i1"),
+    GGUFMetadataValueType.UINT16: np.dtype("<u2"),
+    GGUFMetadataValueType.INT16: np.dtype("<i2"),
+    GGUFMetadataValueType.UINT32: np.dtype("<u4"),
+    GGUFMetadataValueType.INT32: np.dtype("<i4"),
+    GGUFMetadataValueType.FLOAT32: np.dtype("<f4"),
+    GGUFMetadataValueType.BOOL: np.dtype(np.bool_),
+    GGUFMetadataValueType.UINT64: np.dtype("<u8"),
+    GGUFMetadataValueType.INT64: np.dtype("<i8"),
+    GGUFMetadataValueType.FLOAT64: np.dtype("<f8"),
+}
+
+
+def _compile_patterns(patterns: Sequence[str]) -> Callable[[str], Any]:
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns)).match
+
+
+class MetadataKeyFilter:
+    def __init__(self, include: Optional[Sequence[str]] = None, exclude: Optional[Sequence[str]] = None):
+        """
+        select metadata keys by fnmatch patterns, such as "llama.*"
+        :param include: patterns of keys to read, default None means every key
+        :param exclude: patterns of keys to skip even if included
+        """
+        self._include = _compile_patterns(include) if include else None
+        self._exclude = _compile_patterns(exclude) if exclude else None
+        # when every include pattern is an exact key, reading can stop once all of them are found
+        self._pending: Optional[set] = None
+        if include and not any(char in pattern for pattern in include for char in _WILDCARD_CHARS):
+            self._pending = {key for key in include if self.match(key)}
+
+    def match(self, key: str) -> bool:
+        if self._include is not None and not self._include(key):
+            return False
+        return self._exclude is None or not self._exclude(key)
+
+    def found(self, key: str):
+        if self._pending is not None:
+            self._pending.discard(key)
+
+    @property
+    def done(self) -> bool:
+        """whether every exact key is found, always False for wildcard patterns"""
+        return self._pending is not None and not self._pending
+
+
+class GGUFHeaderParser:
+    def __init__(self, f: BinaryIO, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        :param f: gguf file opened in binary mode, parsing starts at its current position
+        :param chunk_size: bytes number read from file every time the buffer runs out
+        """
+        self.f = f
+        self.chunk_size = chunk_size
+        self._buffer: bytes = b""
+        self._view = memoryview(self._buffer)
+        # position of the cursor in buffer
+        self._cursor = 0
+        # file offset of the first byte of buffer
+        self._buffer_offset = f.tell()
+
+    def tell(self) -> int:
+        """file offset of the cursor"""
+        return self._buffer_offset + self._cursor
+
+    def _ensure(self, n_bytes: int):
+        """make sure at least n_bytes bytes are buffered after the cursor"""
+        if self._cursor + n_bytes <= len(self._buffer):
+            return
+        remaining = self._view[self._cursor:].tobytes()
+        data = self.f.read(max(self.chunk_size, n_bytes - len(remaining)))
+        if len(remaining) + len(data) < n_bytes:
+            raise GGUFException("unexpected end of file at offset {0}".format(self.tell()))
+        self._view.release()
+        self._buffer_offset += self._cursor
+        self._buffer = remaining + data
+        self._view = memoryview(self._buffer)
+        self._cursor = 0
+
+    def skip_bytes(self, n_bytes: int):
+        """move the cursor forward, bytes beyond the buffer are skipped by seeking the file instead of reading"""
+        if self._cursor + n_bytes <= len(self._buffer):
+            self._cursor += n_bytes
+            return
+        target = self.tell() + n_bytes
+        self._view.release()
+        self._buffer = b""
+        self._view = memoryview(self._buffer)
+        self._cursor = 0
+        self._buffer_offset = target
+        self.f.seek(target)
+
+    def read_bytes(self, n_bytes: int) -> bytes:
+        self._ensure(n_bytes)
+        value = self._view[self._cursor:self._cursor + n_bytes].tobytes()
+        self._cursor += n_bytes
+        return value
+
+    def read_uint32(self) -> int:
+        self._ensure(4)
+        value = _UINT32.unpack_from(self._view, self._cursor)[0]
+        self._cursor += 4
+        return value
+
+    def read_uint64(self) -> int:
+        self._ensure(8)
+        value = _UINT64.unpack_from(self._view, self._cursor)[0]
+        self._cursor += 8
+        return value
+
+    def read_string(self) -> str:
+        length = self.read_uint64()
+        self._ensure(length)
+        value = str(self._view[self._cursor:self._cursor + length], ENCODING)
+        self._cursor += length
+        return value
+
+    def read_gguf_string(self) -> GGUFString:
+        string = self.read_string()
+        return GGUFString(length=len(string.encode(ENCODING)), string=string)
+
+    def read_metadata_value(self, value_type: GGUFMetadataValueType) -> Any:
+        """
+        numeric values are returned as plain python scalars, numeric arrays as numpy arrays
+        :param value_type:
+        :return:
+        """
+        scalar_struct = METADATA_SCALAR_STRUCT_DICT.get(value_type)
+        if scalar_struct is not None:
+            self._ensure(scalar_struct.size)
+            value = scalar_struct.unpack_from(self._view, self._cursor)[0]
+            self._cursor += scalar_struct.size
+            return value
+        if value_type == GGUFMetadataValueType.STRING:
+            return self.read_string()
+        if value_type == GGUFMetadataValueType.ARRAY:
+            array_value_type = GGUFMetadataValueType(self.read_uint32())
+            array_length = self.read_uint64()
+            return self.read_metadata_array(array_value_type, array_length)
+        raise GGUFException("unexpected metadata value type.")
+
+    def read_metadata_array(self, value_type: GGUFMetadataValueType, length: int) -> Any:
+        dtype = METADATA_NP_DTYPE_DICT.get(value_type)
+        if dtype is not None:
+            n_bytes = dtype.itemsize * length
+            self._ensure(n_bytes)
+            value = np.frombuffer(self._view, dtype=dtype, count=length, offset=self._cursor).copy()
+            self._cursor += n_bytes
+            return value
+        if value_type == GGUFMetadataValueType.STRING:
+            return self._read_string_array(length)
+        return [self.read_metadata_value(value_type) for _ in range(length)]
+
+    def _read_string_array(self, length: int) -> List[str]:
+        strings = []
+        append = strings.append
+        unpack_from = _UINT64.unpack_from
+        for _ in range(length):
+            cursor = self._cursor
+            if cursor + 8 > len(self._buffer):
+                self._ensure(8)
+                cursor = self._cursor
+            string_length = unpack_from(self._buffer, cursor)[0]
+            cursor += 8
+            if cursor + string_length > len(self._buffer):
+                self._cursor = cursor
+                self._ensure(string_length)
+                cursor = self._cursor
+            append(self._buffer[cursor:cursor + string_length].decode(ENCODING))
+            self._cursor = cursor + string_length
+        return strings
+
+    def skip_metadata_value(self, value_type: GGUFMetadataValueType):
+        """
+        move past a value without decoding it, numeric arrays are skipped by their byte length,
+        string arrays by walking their length prefixes
+        :param value_type:
+        :return:
+        """
+        scalar_struct = METADATA_SCALAR_STRUCT_DICT.get(value_type)
+        if scalar_struct is not None:
+            self.skip_bytes(scalar_struct.size)
+            return
+        if value_type == GGUFMetadataValueType.STRING:
+            self.skip_bytes(self.read_uint64())
+            return
+        if value_type == GGUFMetadataValueType.ARRAY:
+            array_value_type = GGUFMetadataValueType(self.read_uint32())
+            array_length = self.read_uint64()
+            dtype = METADATA_NP_DTYPE_DICT.get(array_value_type)
+            if dtype is not None:
+                self.skip_bytes(dtype.itemsize * array_length)
+            elif array_value_type == GGUFMetadataValueType.STRING:
+                self._skip_string_array(array_length)
+            else:
+                for _ in range(array_length):
+                    self.skip_metadata_value(array_value_type)
+            return
+        raise GGUFException("unexpected metadata value type.")
+
+    def _skip_string_array(self, length: int):
+        unpack_from = _UINT64.unpack_from
+        cursor = self._cursor
+        buffer_length = len(self._buffer)
+        for _ in range(length):
+            if cursor + 8 > buffer_length:
+                self._cursor = cursor
+                self._ensure(8)
+                cursor = self._cursor
+                buffer_length = len(self._buffer)
+            cursor += 8 + unpack_from(self._view, cursor)[0]
+            if cursor > buffer_length:
+                # the string runs past the buffer, the rest of it is skipped by seeking
+                self._cursor = buffer_length
+                self.skip_bytes(cursor - buffer_length)
+                cursor = self._cursor
+                buffer_length = len(self._buffer)
+        self._cursor = cursor
+
+    def read_selected_metadata_kvs(self, metadata_kv_count: int, key_filter: MetadataKeyFilter) \
+            -> List[GGUFMetadataKV]:
+        """
+        read the kv pairs selected by key_filter and skip the others, it stops once key_filter is done,
+        then the cursor is left inside the metadata section.
+        :param metadata_kv_count: number of kv pairs in file
+        :param key_filter:
+        :return:
+        """
+        metadata = []
+        for _ in range(metadata_kv_count):
+            key = self.read_string()
+            value_type = GGUFMetadataValueType(self.read_uint32())
+            if not key_filter.match(key):
+                self.skip_metadata_value(value_type)
+                continue
+            value = self.read_metadata_value(value_type)
+            metadata.append(GGUFMetadataKV(GGUFString(length=len(key.encode(ENCODING)), string=key), value_type,
+                                           value))
+            key_filter.found(key)
+            if key_filter.done:
+                break
+        return metadata
+
+    def read_metadata_kv(self) -> GGUFMetadataKV:
+        key = self.read_gguf_string()
+        value_type = GGUFMetadataValueType(self.read_uint32())
+        value = self.read_metadata_value(value_type)
+        return GGUFMetadataKV(key, value_type, value)
+
+    def read_tensor_info(self) -> GGUFTensorInfo:
+        name = self.read_gguf_string()
+        n_dimensions = self.read_uint32()
+        self._ensure(8 * n_dimensions)
+        dimensions = list(struct.unpack_from("<{0}Q".format(n_dimensions), self._view, self._cursor))
+        self._cursor += 8 * n_dimensions
+        type_ = GGMLType(self.read_uint32())
+        offset = self.read_uint64()
+        return GGUFTensorInfo(name, n_dimensions, dimensions, type_, offset)
+
+    def read_tensor_table(self, tensor_count: int) -> GGUFTensorTable:
+        """
+        read tensors info into columns, no object is created per tensor except its name
+        :param tensor_count:
+        :return:
+        """
+        names = []
+        n_dimensions_list = []
+        dimensions_list = []
+        types = []
+        offsets = []
+        for _ in range(tensor_count):
+            names.append(self.read_string())
+            n_dimensions = self.read_uint32()
+            if n_dimensions > GGML_MAX_DIMS:
+                raise GGUFException("tensor {0} has {1} dimensions, at most {2} are supported".format(
+                    names[-1], n_dimensions, GGML_MAX_DIMS))
+            # dimensions, type and offset are unpacked together
+            tail_struct = _TENSOR_INFO_TAIL_STRUCTS[n_dimensions]
+            self._ensure(tail_struct.size)
+            values = tail_struct.unpack_from(self._view, self._cursor)
+            self._cursor += tail_struct.size
+            n_dimensions_list.append(n_dimensions)
+            dimensions_list.append(values[:n_dimensions] + _DIMENSION_PADDINGS[n_dimensions])
+            types.append(values[n_dimensions])
+            offsets.append(values[n_dimensions + 1])
+        return GGUFTensorTable.from_columns(names, n_dimensions_list, dimensions_list, types, offsets)
+
+    def close(self):
+        self._view.release()
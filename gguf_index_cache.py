@@ -0,0 +1,178 @@
+"""
+Persistent sidecar index of parsed GGUF headers, so that unchanged files are not parsed again
+"""
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from typing import Optional
+
+from gguf_tensor_table import GGUFTensorTable
+
+DEFAULT_INDEX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gguf-mindspore", "index")
+INDEX_FILE_SUFFIX = ".idx"
+# bump it when the layout of index entry changes
+INDEX_FORMAT_VERSION = 2
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+class GGUFIndexEntry:
+    def __init__(self, gguf_file_path: str, file_size: int, mtime_ns: int, header_hash: str, data_offset: int,
+                 alignment: int, tensor_count: int, metadata_kv_count: int, metadata: list,
+                 tensor_infos: GGUFTensorTable):
+        """
+        :param gguf_file_path: absolute gguf file path
+        :param file_size: gguf file size in bytes
+        :param mtime_ns: gguf file modify time in nanoseconds
+        :param header_hash: hash of the header bytes, from the beginning of file to data_offset
+        :param data_offset: absolute offset of tensor data section
+        :param alignment: gguf alignment
+        :param tensor_count:
+        :param metadata_kv_count:
+        :param metadata: List[GGUFMetadataKV]
+        :param tensor_infos: columnar tensors info, offsets are absolute
+        """
+        self.version = INDEX_FORMAT_VERSION
+        self.gguf_file_path = gguf_file_path
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.header_hash = header_hash
+        self.data_offset = data_offset
+        self.alignment = alignment
+        self.tensor_count = tensor_count
+        self.metadata_kv_count = metadata_kv_count
+        self.metadata = metadata
+        self.tensor_infos = tensor_infos
+
+
+class GGUFIndexCache:
+    def __init__(self, cache_dir: str = DEFAULT_INDEX_CACHE_DIR, max_entries: int = 64, max_bytes: int = 1 << 30,
+                 strict: bool = False):
+        """
+        index entries are evicted from the least recently used one when a limit is exceeded.
+        :param cache_dir: folder to save index files
+        :param max_entries: max number of index entries, 0 means no limit
+        :param max_bytes: max total size of index files, 0 means no limit
+        :param strict: whether to hash the header on every hit, default False means an entry whose file size and
+            modify time match is used at once, the header is hashed only when they differ
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.strict = strict
+
+    @staticmethod
+    def header_hash(gguf_file_path: str, header_size: int) -> str:
+        """hash the first header_size bytes of the file"""
+        digest = hashlib.blake2b(digest_size=20)
+        with open(gguf_file_path, "rb") as f:
+            remaining = header_size
+            while remaining > 0:
+                data = f.read(min(_HASH_CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                digest.update(data)
+                remaining -= len(data)
+        return digest.hexdigest()
+
+    def _index_file_path(self, gguf_file_path: str) -> str:
+        name = hashlib.sha1(os.path.abspath(gguf_file_path).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, name + INDEX_FILE_SUFFIX)
+
+    def load(self, gguf_file_path: str) -> Optional[GGUFIndexEntry]:
+        """
+        get index entry of the gguf file, None if there is no entry or the file has changed.
+        :param gguf_file_path:
+        :return:
+        """
+        index_file_path = self._index_file_path(gguf_file_path)
+        if not os.path.isfile(index_file_path):
+            return None
+        try:
+            with open(index_file_path, "rb") as f:
+                entry: GGUFIndexEntry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            logging.warning("drop broken index file %s: %s", index_file_path, e)
+            self._remove(index_file_path)
+            return None
+        stat = os.stat(gguf_file_path)
+        if getattr(entry, "version", None) != INDEX_FORMAT_VERSION \
+                or entry.gguf_file_path != os.path.abspath(gguf_file_path):
+            self._remove(index_file_path)
+            return None
+        unchanged = entry.file_size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns
+        if not unchanged or self.strict:
+            # the file was touched or rewritten, the entry is still valid if its header bytes are the same
+            if entry.header_hash != GGUFIndexCache.header_hash(gguf_file_path, entry.data_offset):
+                self._remove(index_file_path)
+                return None
+            if not unchanged:
+                entry.file_size = stat.st_size
+                entry.mtime_ns = stat.st_mtime_ns
+                self._write(entry, index_file_path)
+                return entry
+        # bump the modify time of the index file, eviction removes the index files of the oldest modify time first
+        os.utime(index_file_path)
+        return entry
+
+    def save(self, gguf_file_path: str, data_offset: int, alignment: int, tensor_count: int, metadata_kv_count: int,
+             metadata: list, tensor_infos: GGUFTensorTable):
+        """
+        save parsed header of the gguf file, then evict old entries.
+        :return:
+        """
+        stat = os.stat(gguf_file_path)
+        entry = GGUFIndexEntry(os.path.abspath(gguf_file_path), stat.st_size, stat.st_mtime_ns,
+                               GGUFIndexCache.header_hash(gguf_file_path, data_offset), data_offset, alignment,
+                               tensor_count, metadata_kv_count, metadata, tensor_infos)
+        self._write(entry, self._index_file_path(gguf_file_path))
+        self.evict()
+
+    def _write(self, entry: GGUFIndexEntry, index_file_path: str):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write to a temp file first, concurrent jobs never see half written index
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, index_file_path)
+        except OSError:
+            self._remove(temp_path)
+            raise
+
+    def evict(self):
+        """remove least recently used entries until both limits are satisfied"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(INDEX_FILE_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        entries.sort()
+        total_bytes = sum(entry[1] for entry in entries)
+        while entries and ((self.max_entries and len(entries) > self.max_entries)
+                           or (self.max_bytes and total_bytes > self.max_bytes)):
+            _, size, path = entries.pop(0)
+            self._remove(path)
+            total_bytes -= size
+
+    def clear(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(INDEX_FILE_SUFFIX):
+                self._remove(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
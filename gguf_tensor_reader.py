@@ -0,0 +1,82 @@
+"""
+Positional reads of a file by absolute offsets. A read does not move a shared cursor, so one reader serves many
+threads at once, and os.preadv releases the GIL while the disk is read.
+"""
+import os
+import threading
+from typing import BinaryIO, Optional
+
+import numpy as np
+
+from constant import GGUFException
+
+
+class PositionalReader:
+    def __init__(self, file_path: str):
+        """
+        :param file_path: file to read, it is opened at once and kept open until close
+        """
+        self.file_path = file_path
+        self._fd: Optional[int] = os.open(file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        self.size = os.fstat(self._fd).st_size
+        # where neither preadv nor pread exists, such as Windows, reads seek a shared file under a lock
+        self._f: Optional[BinaryIO] = None
+        self._lock = threading.Lock()
+        if not hasattr(os, "preadv") and not hasattr(os, "pread"):
+            self._f = os.fdopen(self._fd, "rb", buffering=0)
+
+    def read_into(self, buffer: memoryview, offset: int) -> int:
+        """
+        fill buffer with the bytes from offset.
+        :param buffer: writable buffer
+        :param offset: absolute file offset
+        :return: bytes read, less than len(buffer) only at the end of file
+        """
+        if self._fd is None:
+            raise GGUFException("{0} is closed".format(self.file_path))
+        buffer = memoryview(buffer).cast("B")
+        n_read = 0
+        while n_read < len(buffer):
+            n = self._read_once(buffer[n_read:], offset + n_read)
+            if n == 0:
+                break
+            n_read += n
+        return n_read
+
+    def _read_once(self, buffer: memoryview, offset: int) -> int:
+        if hasattr(os, "preadv"):
+            return os.preadv(self._fd, [buffer], offset)
+        if self._f is None:
+            data = os.pread(self._fd, len(buffer), offset)
+            buffer[:len(data)] = data
+            return len(data)
+        with self._lock:
+            self._f.seek(offset)
+            return self._f.readinto(buffer)
+
+    def read(self, offset: int, n_bytes: int) -> np.ndarray:
+        """
+        :param offset: absolute file offset
+        :param n_bytes: bytes to read
+        :return: uint8 ndarray of n_bytes, GGUFException if the file ends before
+        """
+        buffer = np.empty(n_bytes, dtype=np.uint8)
+        if self.read_into(memoryview(buffer), offset) != n_bytes:
+            raise GGUFException("{0} bytes at offset {1} exceed the size {2} of {3}".format(
+                n_bytes, offset, self.size, self.file_path))
+        return buffer
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        elif self._fd is not None:
+            os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self) -> "PositionalReader":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
@@ -0,0 +1,237 @@
+"""
+Tensors info of a GGUF file stored by column in one numpy structured array. Offsets and sizes of all tensors are
+computed at once, tensors are located by a name to row index, and a small view object per row keeps the
+attributes of GGUFTensorInfo for callers.
+"""
+from typing import Dict, Iterator, List, Sequence
+
+import numpy as np
+
+from constant import GGUFException, GGUFString, GGUFTensorInfo, GGMLType, GGML_QUANT_SIZES_DICT
+
+ENCODING = "utf-8"
+# refer to GGML_MAX_DIMS of ggml, unused dimensions are padded with 1
+GGML_MAX_DIMS = 4
+
+TENSOR_INFO_DTYPE = np.dtype([
+    # position of the tensor name in GGUFTensorTable.names
+    ("name_index", "<u4"),
+    ("n_dimensions", "<u4"),
+    # from the innermost dimension, as stored in gguf
+    ("dimensions", "<u8", (GGML_MAX_DIMS,)),
+    ("type", "<u4"),
+    # absolute once the loader adds the data section offset
+    ("offset", "<u8"),
+    # 0 for types whose block size is unknown
+    ("n_bytes", "<u8"),
+])
+
+_GGML_TYPE_DICT: Dict[int, GGMLType] = {int(ggml_type.value): ggml_type for ggml_type in GGMLType}
+_MAX_TYPE_ID = max(_GGML_TYPE_DICT)
+# block size and type size indexed by type id, 0 for types without known sizes
+_BLOCK_SIZES = np.zeros(_MAX_TYPE_ID + 1, dtype=np.uint64)
+_TYPE_SIZES = np.zeros(_MAX_TYPE_ID + 1, dtype=np.uint64)
+for _ggml_type, (_block_size, _type_size) in GGML_QUANT_SIZES_DICT.items():
+    _BLOCK_SIZES[int(_ggml_type.value)] = _block_size
+    _TYPE_SIZES[int(_ggml_type.value)] = _type_size
+
+
+def padded_offsets(offsets: np.ndarray, alignment: int) -> np.ndarray:
+    """round every offset up to a multiple of alignment"""
+    offsets = np.asarray(offsets, dtype=np.uint64)
+    alignment = np.uint64(alignment)
+    return (offsets + alignment - np.uint64(1)) // alignment * alignment
+
+
+def tensors_nbytes(dimensions: np.ndarray, types: np.ndarray) -> np.ndarray:
+    """
+    bytes of every tensor, rows whose innermost dimension is not a multiple of the block size are rounded down,
+    tensor_layout reports them when the tensor is accessed.
+    :param dimensions: (n, GGML_MAX_DIMS) uint64, padded with 1
+    :param types: (n,) type ids
+    :return: (n,) uint64
+    """
+    types = np.asarray(types, dtype=np.intp)
+    block_sizes = _BLOCK_SIZES[types]
+    known = block_sizes != 0
+    n_elements = np.prod(dimensions, axis=1, dtype=np.uint64)
+    n_bytes = np.zeros(len(types), dtype=np.uint64)
+    n_bytes[known] = n_elements[known] // block_sizes[known] * _TYPE_SIZES[types[known]]
+    return n_bytes
+
+
+class GGUFTensorInfoView:
+    """one row of GGUFTensorTable with the attributes of GGUFTensorInfo, it stays valid while the table lives"""
+    __slots__ = ("_table", "_row")
+
+    def __init__(self, table: "GGUFTensorTable", row: int):
+        self._table = table
+        self._row = row
+
+    @property
+    def row(self) -> int:
+        """position of the tensor in the table"""
+        return self._row
+
+    @property
+    def name(self) -> GGUFString:
+        string = self._table.names[self._table.name_indexes[self._row]]
+        return GGUFString(length=len(string.encode(ENCODING)), string=string)
+
+    @property
+    def n_dimensions(self) -> int:
+        return int(self._table.n_dimensions[self._row])
+
+    @property
+    def dimensions(self) -> List[int]:
+        return self._table.dimensions[self._row, :self._table.n_dimensions[self._row]].tolist()
+
+    @property
+    def type(self) -> GGMLType:
+        return _GGML_TYPE_DICT[int(self._table.types[self._row])]
+
+    @property
+    def offset(self) -> int:
+        return int(self._table.offsets[self._row])
+
+    @offset.setter
+    def offset(self, value: int):
+        self._table.offsets[self._row] = value
+
+    @property
+    def n_bytes(self) -> int:
+        return int(self._table.n_bytes[self._row])
+
+    def __str__(self):
+        return "name: {0}, n_dimensions: {1}, dimensions: {2}, type: {3}, offset: {4}".format(str(self.name),
+                                                                                              self.n_dimensions,
+                                                                                              self.dimensions,
+                                                                                              str(self.type),
+                                                                                              self.offset)
+
+
+class GGUFTensorTable:
+    def __init__(self, names: List[str], rows: np.ndarray):
+        """
+        :param names: tensor names in file order
+        :param rows: structured array of TENSOR_INFO_DTYPE, one row per tensor in file order
+        """
+        self.names = names
+        self.rows = rows
+        self._index: Dict[str, int] = {}
+        self._build_index()
+
+    def _build_index(self):
+        # column views share memory with rows, a field of a structured array is slow to look up per access
+        self.name_indexes = self.rows["name_index"]
+        self.n_dimensions = self.rows["n_dimensions"]
+        self.dimensions = self.rows["dimensions"]
+        self.types = self.rows["type"]
+        self.offsets = self.rows["offset"]
+        self.n_bytes = self.rows["n_bytes"]
+        # a later tensor of the same name wins, as a dict built in file order
+        self._index = {self.names[name_index]: row for row, name_index in enumerate(self.name_indexes.tolist())}
+
+    @classmethod
+    def from_columns(cls, names: List[str], n_dimensions: Sequence[int], dimensions: Sequence[Sequence[int]],
+                     types: Sequence[int], offsets: Sequence[int]) -> "GGUFTensorTable":
+        """
+        :param names: tensor names
+        :param n_dimensions: number of dimensions of every tensor
+        :param dimensions: dimensions of every tensor padded to GGML_MAX_DIMS with 1
+        :param types: type id of every tensor
+        :param offsets: offset of every tensor
+        :return:
+        """
+        rows = np.empty(len(names), dtype=TENSOR_INFO_DTYPE)
+        rows["name_index"] = np.arange(len(names), dtype=np.uint32)
+        rows["n_dimensions"] = n_dimensions
+        rows["dimensions"] = np.asarray(dimensions, dtype=np.uint64).reshape(len(names), GGML_MAX_DIMS)
+        rows["type"] = types
+        rows["offset"] = offsets
+        unknown = ~np.isin(rows["type"], list(_GGML_TYPE_DICT))
+        if unknown.any():
+            row = int(np.flatnonzero(unknown)[0])
+            raise GGUFException("unknown tensor type {0} of {1}".format(int(rows["type"][row]), names[row]))
+        rows["n_bytes"] = tensors_nbytes(rows["dimensions"], rows["type"])
+        return cls(names, rows)
+
+    @classmethod
+    def concat(cls, tables: Sequence["GGUFTensorTable"]) -> "GGUFTensorTable":
+        """rows of all tables in order, such as the tensors of the shards of a split gguf"""
+        names = []
+        rows_list = []
+        for table in tables:
+            rows = table.rows.copy()
+            rows["name_index"] += np.uint32(len(names))
+            names.extend(table.names)
+            rows_list.append(rows)
+        return cls(names, np.concatenate(rows_list) if rows_list else np.empty(0, dtype=TENSOR_INFO_DTYPE))
+
+    @classmethod
+    def from_tensor_infos(cls, tensor_infos: Sequence[GGUFTensorInfo]) -> "GGUFTensorTable":
+        dimensions = []
+        for tensor_info in tensor_infos:
+            if len(tensor_info.dimensions) > GGML_MAX_DIMS:
+                raise GGUFException("tensor {0} has more than {1} dimensions".format(str(tensor_info.name),
+                                                                                     GGML_MAX_DIMS))
+            dimensions.append([int(dim) for dim in tensor_info.dimensions] +
+                              [1] * (GGML_MAX_DIMS - len(tensor_info.dimensions)))
+        return cls.from_columns([str(tensor_info.name) for tensor_info in tensor_infos],
+                                [int(tensor_info.n_dimensions) for tensor_info in tensor_infos], dimensions,
+                                [int(tensor_info.type.value) for tensor_info in tensor_infos],
+                                [int(tensor_info.offset) for tensor_info in tensor_infos])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, row: int) -> GGUFTensorInfoView:
+        if row < 0:
+            row += len(self.rows)
+        if not 0 <= row < len(self.rows):
+            raise IndexError(row)
+        return GGUFTensorInfoView(self, row)
+
+    def __iter__(self) -> Iterator[GGUFTensorInfoView]:
+        for row in range(len(self.rows)):
+            yield GGUFTensorInfoView(self, row)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def row(self, name: str) -> int:
+        """row of the tensor, KeyError if there is no such tensor"""
+        return self._index[name]
+
+    def info(self, name: str) -> GGUFTensorInfoView:
+        return GGUFTensorInfoView(self, self._index[name])
+
+    def tensor_names(self) -> List[str]:
+        """distinct tensor names in file order"""
+        return list(self._index)
+
+    def shift_offsets(self, delta: int):
+        """add delta to every offset, such as the data section offset"""
+        self.offsets += np.uint64(delta)
+
+    def misaligned(self, alignment: int) -> List[str]:
+        """names of tensors whose offset is not a multiple of alignment"""
+        rows = np.flatnonzero(padded_offsets(self.offsets, alignment) != self.offsets)
+        return [self.names[self.name_indexes[row]] for row in rows]
+
+    def exceeding(self, file_size: int) -> List[str]:
+        """names of tensors ending beyond file_size"""
+        rows = np.flatnonzero(self.offsets + self.n_bytes > np.uint64(file_size))
+        return [self.names[self.name_indexes[row]] for row in rows]
+
+    def total_bytes(self) -> int:
+        return int(self.n_bytes.sum())
+
+    def __getstate__(self) -> dict:
+        # the name index is rebuilt on load, it is not worth its pickled size
+        return {"names": self.names, "rows": self.rows}
+
+    def __setstate__(self, state: dict):
+        self.names = state["names"]
+        self.rows = state["rows"]
+        self._build_index()
@@ -0,0 +1,267 @@
+"""
+Metadata kv pairs of a GGUF file saved as json with the GGUFMetadataValueType of every key, so that a written file
+has the metadata of the reference byte for byte. Numeric arrays are numpy arrays of their exact dtype, long ones such
+as the tokenizer scores are saved in an npz file next to the json, and a kv pair is encoded in one piece instead of
+one array item at a time.
+"""
+import json
+import logging
+import os
+import struct
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from constant import GGUFException, GGUFMetadataKV, GGUFMetadataValueType
+from gguf_header_parser import METADATA_NP_DTYPE_DICT, METADATA_SCALAR_STRUCT_DICT
+
+ENCODING = "utf-8"
+TYPED_METADATA_FORMAT = "gguf-typed-metadata"
+TYPED_METADATA_VERSION = 1
+SIDECAR_SUFFIX = ".npz"
+# numeric arrays longer than it are saved in the npz file, shorter ones stay readable in json
+INLINE_ARRAY_MAX_LENGTH = 64
+
+_NP_DTYPE_VALUE_TYPE_DICT = {dtype: value_type for value_type, dtype in METADATA_NP_DTYPE_DICT.items()}
+_UINT32_STRUCT = struct.Struct("<I")
+_UINT64_STRUCT = struct.Struct("<Q")
+
+
+class TypedMetadataValue(NamedTuple):
+    value_type: GGUFMetadataValueType
+    # python scalar or str, for an array a numpy array of numeric items or a list of str or TypedMetadataValue
+    value: Any
+    # type of array items, None unless value_type is ARRAY
+    item_type: Optional[GGUFMetadataValueType] = None
+
+
+def _typed_array(items) -> TypedMetadataValue:
+    if isinstance(items, np.ndarray):
+        item_type = _NP_DTYPE_VALUE_TYPE_DICT.get(items.dtype)
+        if item_type is None:
+            raise GGUFException("unsupported metadata array dtype {0}".format(items.dtype))
+        return TypedMetadataValue(GGUFMetadataValueType.ARRAY, items, item_type)
+    if all(isinstance(item, str) for item in items):
+        # numeric arrays are decoded to numpy arrays even when empty, an empty list is taken as a string array
+        return TypedMetadataValue(GGUFMetadataValueType.ARRAY, list(items), GGUFMetadataValueType.STRING)
+    return TypedMetadataValue(GGUFMetadataValueType.ARRAY, [_typed_array(item) for item in items],
+                              GGUFMetadataValueType.ARRAY)
+
+
+def from_metadata_kv(metadata_kv: GGUFMetadataKV) -> TypedMetadataValue:
+    """typed value of a metadata kv pair read by GGUFLoader"""
+    if metadata_kv.value_type == GGUFMetadataValueType.ARRAY:
+        return _typed_array(metadata_kv.value)
+    return TypedMetadataValue(metadata_kv.value_type, metadata_kv.value)
+
+
+def _python_value_type(value) -> Optional[GGUFMetadataValueType]:
+    # the order of GGUFValueType.get_type of gguf, bool before int
+    if isinstance(value, str):
+        return GGUFMetadataValueType.STRING
+    if isinstance(value, list):
+        return GGUFMetadataValueType.ARRAY
+    if isinstance(value, float):
+        return GGUFMetadataValueType.FLOAT32
+    if isinstance(value, bool):
+        return GGUFMetadataValueType.BOOL
+    if isinstance(value, int):
+        return GGUFMetadataValueType.INT32
+    return None
+
+
+def _python_array(items: list, key: str) -> TypedMetadataValue:
+    if not items:
+        raise GGUFException("metadata array {0} is empty, its item type is unknown".format(key))
+    item_type = _python_value_type(items[0])
+    if item_type is None or any(_python_value_type(item) != item_type for item in items[1:]):
+        raise GGUFException("items of metadata array {0} are not of one supported type".format(key))
+    if item_type == GGUFMetadataValueType.STRING:
+        return TypedMetadataValue(GGUFMetadataValueType.ARRAY, items, item_type)
+    if item_type == GGUFMetadataValueType.ARRAY:
+        return TypedMetadataValue(GGUFMetadataValueType.ARRAY, [_python_array(item, key) for item in items],
+                                  item_type)
+    return TypedMetadataValue(GGUFMetadataValueType.ARRAY,
+                              np.array(items, dtype=METADATA_NP_DTYPE_DICT[item_type]), item_type)
+
+
+def from_python(value, key: str) -> Optional[TypedMetadataValue]:
+    """
+    typed value of a plain json value, of the types the writer has always written: int as UINT32, float as FLOAT32,
+    and array items by the type of the first item as gguf does, such as INT32 for int.
+    :param value: json value
+    :param key: metadata key, for error messages
+    :return: None for values of other types
+    """
+    if isinstance(value, bool):
+        return TypedMetadataValue(GGUFMetadataValueType.BOOL, value)
+    if isinstance(value, int):
+        return TypedMetadataValue(GGUFMetadataValueType.UINT32, value)
+    if isinstance(value, float):
+        return TypedMetadataValue(GGUFMetadataValueType.FLOAT32, value)
+    if isinstance(value, str):
+        return TypedMetadataValue(GGUFMetadataValueType.STRING, value)
+    if isinstance(value, list):
+        return _python_array(value, key)
+    return None
+
+
+def _array_to_json(value: TypedMetadataValue, key: str, arrays: Optional[Dict[str, np.ndarray]],
+                   inline_max_length: int) -> dict:
+    entry: Dict[str, Any] = {"item_type": value.item_type.name}
+    if value.item_type == GGUFMetadataValueType.ARRAY:
+        # nested arrays are always inline
+        entry["value"] = [_array_to_json(item, key, None, inline_max_length) for item in value.value]
+    elif value.item_type == GGUFMetadataValueType.STRING:
+        entry["value"] = list(value.value)
+    elif arrays is not None and len(value.value) > inline_max_length:
+        arrays[key] = value.value
+        entry["length"] = len(value.value)
+        entry["sidecar"] = True
+    else:
+        entry["value"] = value.value.tolist()
+    return entry
+
+
+def _array_from_json(entry: dict, key: str, arrays) -> TypedMetadataValue:
+    item_type = GGUFMetadataValueType[entry["item_type"]]
+    if item_type == GGUFMetadataValueType.ARRAY:
+        return TypedMetadataValue(GGUFMetadataValueType.ARRAY,
+                                  [_array_from_json(item, key, None) for item in entry["value"]], item_type)
+    if item_type == GGUFMetadataValueType.STRING:
+        return TypedMetadataValue(GGUFMetadataValueType.ARRAY, list(entry["value"]), item_type)
+    dtype = METADATA_NP_DTYPE_DICT[item_type]
+    if entry.get("sidecar"):
+        if arrays is None or key not in arrays:
+            raise GGUFException("array of metadata {0} is not in the npz file".format(key))
+        items = np.asarray(arrays[key], dtype=dtype)
+    else:
+        items = np.array(entry["value"], dtype=dtype)
+    return TypedMetadataValue(GGUFMetadataValueType.ARRAY, items, item_type)
+
+
+def save_typed_metadata(metadata: Dict[str, TypedMetadataValue], json_path: str,
+                        inline_max_length: int = INLINE_ARRAY_MAX_LENGTH):
+    """
+    save metadata to json, numeric arrays longer than inline_max_length to an npz file of the same name.
+    :param metadata: metadata key to typed value, in file order
+    :param json_path: json file path
+    :param inline_max_length: numeric arrays up to this length stay in json, -1 keeps all of them in json
+    :return:
+    """
+    arrays: Optional[Dict[str, np.ndarray]] = {} if inline_max_length >= 0 else None
+    entries = {}
+    for key, value in metadata.items():
+        if value.value_type == GGUFMetadataValueType.ARRAY:
+            entries[key] = {"type": value.value_type.name}
+            entries[key].update(_array_to_json(value, key, arrays, inline_max_length))
+        else:
+            entries[key] = {"type": value.value_type.name, "value": value.value}
+    content: Dict[str, Any] = {"format": TYPED_METADATA_FORMAT, "version": TYPED_METADATA_VERSION}
+    if arrays:
+        sidecar_path = os.path.splitext(json_path)[0] + SIDECAR_SUFFIX
+        with open(sidecar_path, "wb") as f:
+            np.savez(f, **arrays)
+        content["arrays"] = os.path.basename(sidecar_path)
+    content["metadata"] = entries
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(content, f, ensure_ascii=False)
+
+
+def is_typed_metadata(content: dict) -> bool:
+    return content.get("format") == TYPED_METADATA_FORMAT and isinstance(content.get("metadata"), dict)
+
+
+def load_metadata_json(json_path: str) -> Dict[str, TypedMetadataValue]:
+    """
+    metadata of a json saved by save_typed_metadata, or of a plain json object of key to value whose values get the
+    types of from_python, values of other types are skipped.
+    :param json_path: json file path
+    :return: metadata key to typed value, in file order
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        content = json.load(f)
+    metadata: Dict[str, TypedMetadataValue] = {}
+    if not is_typed_metadata(content):
+        for key, value in content.items():
+            typed_value = from_python(value, key)
+            if typed_value is None:
+                logging.error("Unexpected metadata key type: %s of key :%s", type(value), key)
+                continue
+            metadata[key] = typed_value
+        return metadata
+    if content.get("version", TYPED_METADATA_VERSION) > TYPED_METADATA_VERSION:
+        raise GGUFException("metadata json {0} is of version {1}, newer than {2}".format(
+            json_path, content["version"], TYPED_METADATA_VERSION))
+    arrays = None
+    if content.get("arrays"):
+        sidecar_path = os.path.join(os.path.dirname(json_path), content["arrays"])
+        with np.load(sidecar_path, allow_pickle=False) as npz:
+            arrays = {key: npz[key] for key in npz.files}
+    for key, entry in content["metadata"].items():
+        value_type = GGUFMetadataValueType[entry["type"]]
+        if value_type == GGUFMetadataValueType.ARRAY:
+            metadata[key] = _array_from_json(entry, key, arrays)
+        else:
+            metadata[key] = TypedMetadataValue(value_type, entry["value"])
+    return metadata
+
+
+def _string_bytes(value: str) -> List[bytes]:
+    encoded = value.encode(ENCODING)
+    return [_UINT64_STRUCT.pack(len(encoded)), encoded]
+
+
+def _string_array_bytes(items: List[str]) -> bytes:
+    """length prefixes and strings interleaved by numpy, instead of packing every string"""
+    encoded = [item.encode(ENCODING) for item in items]
+    lengths = np.fromiter(map(len, encoded), dtype="<u8", count=len(encoded))
+    strings = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    buffer = np.empty(len(encoded) * _UINT64_STRUCT.size + len(strings), dtype=np.uint8)
+    # every string follows its 8 byte length prefix
+    prefix_starts = np.arange(len(encoded), dtype=np.int64) * _UINT64_STRUCT.size
+    prefix_starts[1:] += np.cumsum(lengths[:-1], dtype=np.int64)
+    prefix_indexes = (prefix_starts[:, None] + np.arange(_UINT64_STRUCT.size)).ravel()
+    is_string = np.ones(len(buffer), dtype=bool)
+    is_string[prefix_indexes] = False
+    buffer[prefix_indexes] = lengths.view(np.uint8)
+    buffer[is_string] = strings
+    return buffer.tobytes()
+
+
+def _array_bytes(value: TypedMetadataValue, parts: List[bytes]):
+    items = value.value
+    parts.append(_UINT32_STRUCT.pack(int(value.item_type.value)))
+    parts.append(_UINT64_STRUCT.pack(len(items)))
+    dtype = METADATA_NP_DTYPE_DICT.get(value.item_type)
+    if dtype is not None:
+        # a numeric array is packed by numpy at once
+        parts.append(np.ascontiguousarray(items, dtype=dtype).tobytes())
+    elif value.item_type == GGUFMetadataValueType.STRING:
+        parts.append(_string_array_bytes(items))
+    elif value.item_type == GGUFMetadataValueType.ARRAY:
+        for item in items:
+            _array_bytes(item, parts)
+    else:
+        raise GGUFException("unsupported metadata array item type {0}".format(value.item_type))
+
+
+def encode_metadata_kv(key: str, value: TypedMetadataValue) -> bytes:
+    """
+    bytes of a metadata kv pair as stored in gguf, the key, the value type and the value.
+    :param key: metadata key
+    :param value: typed value
+    :return:
+    """
+    parts = _string_bytes(key)
+    parts.append(_UINT32_STRUCT.pack(int(value.value_type.value)))
+    scalar_struct = METADATA_SCALAR_STRUCT_DICT.get(value.value_type)
+    if scalar_struct is not None:
+        parts.append(scalar_struct.pack(value.value))
+    elif value.value_type == GGUFMetadataValueType.STRING:
+        parts.extend(_string_bytes(value.value))
+    elif value.value_type == GGUFMetadataValueType.ARRAY:
+        _array_bytes(value, parts)
+    else:
+        raise GGUFException("unsupported metadata type {0} of {1}".format(value.value_type, key))
+    return b"".join(parts)
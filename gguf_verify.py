@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Integrity check of a gguf file, such as a freshly written one. The data region of every tensor is checked against
+the sizes of its type, the alignment and the file size, then hashed. Tensors are read by positional reads and
+hashed by a thread pool, os.preadv and hashlib release the GIL, so many tensors are read and hashed at once.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from constant import GGML_QUANT_SIZES_DICT
+from gguf_index_cache import GGUFIndexCache
+from gguf_tensor_reader import PositionalReader
+from gguf_tensor_table import GGUFTensorInfoView
+from instrumentation import NULL_INSTRUMENTATION, Instrumentation
+from read_gguf import GGUFLoader
+
+DEFAULT_HASH_NAME = "sha256"
+# bytes read and hashed at a time, every thread keeps a buffer of this size
+DEFAULT_CHUNK_BYTES = 8 << 20
+
+
+class TensorCheck:
+    def __init__(self, name: str, file_path: str, tensor_type: str, offset: int, n_bytes: int):
+        """
+        :param name: gguf tensor name
+        :param file_path: file holding the tensor, a shard of a split gguf
+        :param tensor_type: ggml type name
+        :param offset: absolute offset of tensor data in file
+        :param n_bytes: bytes of the tensor computed from its type and dimensions
+        """
+        self.name = name
+        self.file_path = file_path
+        self.type = tensor_type
+        self.offset = offset
+        self.n_bytes = n_bytes
+        self.digest: Optional[str] = None
+        self.errors: List[str] = []
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class VerifyReport:
+    def __init__(self, gguf_file_path: str, hash_name: str, checks: List[TensorCheck], seconds: float,
+                 missing: Optional[List[str]] = None):
+        """
+        :param gguf_file_path: gguf file path, the first shard of a split gguf
+        :param hash_name: hashlib algorithm of digests
+        :param checks: one per tensor in file order
+        :param seconds: seconds of the check
+        :param missing: expected tensors which the file does not have
+        """
+        self.gguf_file_path = gguf_file_path
+        self.hash_name = hash_name
+        self.checks = checks
+        self.seconds = seconds
+        self.missing = missing or []
+
+    @property
+    def ok(self) -> bool:
+        return not self.missing and not any(check.errors for check in self.checks)
+
+    def digests(self) -> Dict[str, str]:
+        return {check.name: check.digest for check in self.checks if check.digest is not None}
+
+    def summary(self) -> dict:
+        n_bytes = sum(check.n_bytes for check in self.checks if check.digest is not None)
+        return {"gguf": self.gguf_file_path, "ok": self.ok, "tensors": len(self.checks),
+                "failed": sum(1 for check in self.checks if check.errors), "missing": len(self.missing),
+                "hash": self.hash_name, "bytes": n_bytes, "seconds": self.seconds,
+                "mb_per_second": n_bytes / (1 << 20) / self.seconds if self.seconds else None}
+
+    def to_dict(self) -> dict:
+        return {"summary": self.summary(), "missing": self.missing,
+                "tensors": [check.to_dict() for check in self.checks]}
+
+
+def load_digests(json_path: str) -> Dict[str, str]:
+    """tensor name to digest, from a saved report or a json object of the same mapping"""
+    with open(json_path, "r", encoding="utf-8") as f:
+        content = json.load(f)
+    if "tensors" in content and isinstance(content["tensors"], list):
+        return {entry["name"]: entry["digest"] for entry in content["tensors"] if entry.get("digest")}
+    return dict(content)
+
+
+def _check_layout(checks: List[TensorCheck], tensor_infos: List[GGUFTensorInfoView],
+                  readers: List[PositionalReader], alignment: int):
+    """type sizes, alignment, file size, and that tensors of a file neither overlap nor leave gaps"""
+    for check, tensor_info in zip(checks, tensor_infos):
+        if tensor_info.type not in GGML_QUANT_SIZES_DICT:
+            check.errors.append("type {0} has no known block size".format(check.type))
+            continue
+        block_size, _ = GGML_QUANT_SIZES_DICT[tensor_info.type]
+        if tensor_info.dimensions and tensor_info.dimensions[0] % block_size != 0:
+            check.errors.append("row size {0} is not a multiple of block size {1}".format(
+                tensor_info.dimensions[0], block_size))
+        if check.offset % alignment != 0:
+            check.errors.append("offset {0} is not aligned to {1} bytes".format(check.offset, alignment))
+    by_file: Dict[str, List[int]] = {}
+    for index, check in enumerate(checks):
+        by_file.setdefault(check.file_path, []).append(index)
+    sizes = {reader.file_path: reader.size for reader in readers}
+    for file_path, indexes in by_file.items():
+        indexes.sort(key=lambda i: checks[i].offset)
+        for index, next_index in zip(indexes, indexes[1:] + [None]):
+            check = checks[index]
+            end = check.offset + check.n_bytes
+            if end > sizes[file_path]:
+                check.errors.append("data ends at {0} beyond the file size {1}".format(end, sizes[file_path]))
+            if next_index is None:
+                continue
+            next_offset = checks[next_index].offset
+            if end > next_offset:
+                check.errors.append("data ends at {0} inside {1}".format(end, checks[next_index].name))
+            elif next_offset - end >= alignment:
+                check.errors.append("data is followed by {0} unused bytes, its type or dimensions may be "
+                                    "wrong".format(next_offset - end))
+
+
+class _Hasher:
+    def __init__(self, hash_name: str, chunk_bytes: int, instrumentation: Instrumentation):
+        self.hash_name = hash_name
+        self.chunk_bytes = chunk_bytes
+        self.instrumentation = instrumentation
+        # buffer of every thread, reused for all tensors it hashes
+        self._local = threading.local()
+
+    def _buffer(self) -> memoryview:
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = memoryview(np.empty(self.chunk_bytes, dtype=np.uint8))
+        return buffer
+
+    def hash(self, check: TensorCheck, reader: PositionalReader):
+        buffer = self._buffer()
+        digest = hashlib.new(self.hash_name)
+        with self.instrumentation.tensor(check.name, "hash", check.n_bytes):
+            start = 0
+            while start < check.n_bytes:
+                length = min(self.chunk_bytes, check.n_bytes - start)
+                try:
+                    n_read = reader.read_into(buffer[:length], check.offset + start)
+                except OSError as e:
+                    check.errors.append("read failed: {0}".format(e))
+                    return
+                if n_read != length:
+                    check.errors.append("file ends at {0} inside the data".format(check.offset + start + n_read))
+                    return
+                digest.update(buffer[:length])
+                start += length
+        check.digest = digest.hexdigest()
+
+    def hash_all(self, tasks: List[Tuple[TensorCheck, PositionalReader]], workers: int):
+        """every thread takes tensors in order until none is left, a task per tensor costs more than small ones"""
+        pending = deque(tasks)
+
+        def work():
+            while True:
+                try:
+                    check, reader = pending.popleft()
+                except IndexError:
+                    return
+                self.hash(check, reader)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gguf-verify") as executor:
+            futures = [executor.submit(work) for _ in range(min(workers, len(tasks)))]
+            for future in futures:
+                future.result()
+
+
+def verify_gguf(gguf_file_path: str, workers: Optional[int] = None, hash_name: str = DEFAULT_HASH_NAME,
+                expected_digests: Optional[Dict[str, str]] = None, chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                index_cache: Optional[GGUFIndexCache] = None,
+                instrumentation: Optional[Instrumentation] = None) -> VerifyReport:
+    """
+    check and hash every tensor of a gguf file, the first shard of a split gguf checks all shards.
+    :param gguf_file_path: gguf file path
+    :param workers: threads reading and hashing tensors, default None means one per CPU, more threads keep more
+        reads in flight on fast disks
+    :param hash_name: hashlib algorithm, such as sha256 or blake2b
+    :param expected_digests: tensor name to digest, such as load_digests of an earlier report, tensors whose
+        digest differs and expected tensors missing from the file fail the check
+    :param chunk_bytes: bytes read and hashed at a time
+    :param index_cache: optional index cache of the gguf header
+    :param instrumentation: receiver of stage and tensor events, default None
+    :return:
+    """
+    # an unknown algorithm fails before anything is read
+    hashlib.new(hash_name)
+    instrumentation = instrumentation or NULL_INSTRUMENTATION
+    start = time.perf_counter()
+    loader = GGUFLoader(gguf_file_path, index_cache=index_cache, tensor_cache_bytes=0,
+                        instrumentation=instrumentation)
+    try:
+        with instrumentation.stage("verify", path=gguf_file_path) as span:
+            loader.load()
+            tensor_infos = list(loader.tensor_infos)
+            names = [str(tensor_info.name) for tensor_info in tensor_infos]
+            tensor_readers = [loader.tensor_reader(name) for name in names]
+            checks = [TensorCheck(name, reader.file_path, str(tensor_info.type.name), tensor_info.offset,
+                                  tensor_info.n_bytes)
+                      for name, tensor_info, reader in zip(names, tensor_infos, tensor_readers)]
+            readers = list({id(reader): reader for reader in tensor_readers}.values())
+            _check_layout(checks, tensor_infos, readers, loader.alignment)
+            # largest tensors first, so that a large tensor does not start last and keep one thread busy alone
+            order = sorted((index for index, check in enumerate(checks) if not check.errors),
+                           key=lambda i: checks[i].n_bytes, reverse=True)
+            _Hasher(hash_name, chunk_bytes, instrumentation).hash_all(
+                [(checks[index], tensor_readers[index]) for index in order], workers or os.cpu_count() or 1)
+            missing = []
+            if expected_digests is not None:
+                for check in checks:
+                    expected = expected_digests.get(check.name)
+                    if expected is not None and check.digest is not None and check.digest != expected:
+                        check.errors.append("digest {0} differs from the expected {1}".format(check.digest,
+                                                                                              expected))
+                names = {check.name for check in checks}
+                missing = [name for name in expected_digests if name not in names]
+            span.set(tensors=len(checks), files=len(readers))
+    finally:
+        loader.close()
+    return VerifyReport(gguf_file_path, hash_name, checks, time.perf_counter() - start, missing)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="check and hash every tensor of a gguf file")
+    parser.add_argument("--gguf", required=True, help="gguf file path, the first shard of a split gguf")
+    parser.add_argument("--workers", type=int, default=None, help="threads reading and hashing tensors")
+    parser.add_argument("--hash", default=DEFAULT_HASH_NAME, help="hashlib algorithm, such as sha256 or blake2b")
+    parser.add_argument("--expect", default=None, help="report json of an earlier check to compare digests with")
+    parser.add_argument("--output", default=None, help="save the report to this json file path")
+    args = parser.parse_args()
+    report = verify_gguf(args.gguf, args.workers, args.hash,
+                         load_digests(args.expect) if args.expect else None)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report.to_dict(), f, indent=2)
+    for check in report.checks:
+        for error in check.errors:
+            print("{0}: {1}".format(check.name, error))
+    for name in report.missing:
+        print("{0}: missing".format(name))
+    print(json.dumps(report.summary()))
+    sys.exit(0 if report.ok else 1)
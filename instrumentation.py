@@ -0,0 +1,226 @@
+"""
+Stage and tensor timing, RSS snapshots and progress of conversion. Writer and GGUFLoader report to an
+Instrumentation, the default one does nothing, a Recorder keeps the events and exports them as json or as a
+Chrome trace, which can be opened by chrome://tracing or https://ui.perfetto.dev
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+STAGE_KIND = "stage"
+TENSOR_KIND = "tensor"
+# tensor spans of this stage mean a tensor is finished, they drive the progress
+PROGRESS_STAGE = "write"
+
+
+def current_rss_kb() -> Optional[int]:
+    """current resident set size of this process in KiB, None where it is not available"""
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class Progress(NamedTuple):
+    done_tensors: int
+    total_tensors: int
+    done_bytes: int
+    total_bytes: int
+    elapsed_seconds: float
+    # None until the first tensor is done
+    eta_seconds: Optional[float]
+
+
+def log_progress(progress: Progress):
+    """progress callback logging a line per tensor"""
+    eta = "-" if progress.eta_seconds is None else "{0:.0f}s".format(progress.eta_seconds)
+    logging.info("%d/%d tensors, %.1f/%.1f MiB, elapsed %.0fs, eta %s", progress.done_tensors,
+                 progress.total_tensors, progress.done_bytes / (1 << 20), progress.total_bytes / (1 << 20),
+                 progress.elapsed_seconds, eta)
+
+
+class _NullSpan:
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Instrumentation:
+    """
+    receiver of instrumentation events, this one ignores them and costs a method call per event.
+    subclass it to receive them.
+    """
+    enabled = False
+
+    def stage(self, name: str, **args):
+        """
+        context manager around a stage, such as "set_up" or "write_tensors".
+        :param name: stage name
+        :param args: details of the stage
+        :return: span, more details can be added by span.set(key=value)
+        """
+        return _NULL_SPAN
+
+    def tensor(self, name: str, stage: str, nbytes: int = 0):
+        """
+        context manager around the work on one tensor.
+        :param name: tensor name
+        :param stage: such as "convert" or "write"
+        :param nbytes: bytes the stage produces
+        :return: span
+        """
+        return _NULL_SPAN
+
+    def start_progress(self, total_tensors: int, total_bytes: int):
+        """called before tensors are written, with the number and bytes of tensors to write"""
+
+
+NULL_INSTRUMENTATION = Instrumentation()
+
+
+class _Span:
+    def __init__(self, recorder: "Recorder", kind: str, name: str, args: dict):
+        self.recorder = recorder
+        self.kind = kind
+        self.name = name
+        self.args = args
+        self.start = 0.0
+        self.rss_kb: Optional[int] = None
+
+    def __enter__(self) -> "_Span":
+        if self.kind == STAGE_KIND and self.recorder.record_rss:
+            self.rss_kb = current_rss_kb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.recorder.record(self, end)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class Recorder(Instrumentation):
+    enabled = True
+
+    def __init__(self, progress_callback: Optional[Callable[[Progress], None]] = None, record_rss: bool = True):
+        """
+        keep every event in memory, a few hundred bytes per tensor.
+        :param progress_callback: called after every tensor is written, such as log_progress
+        :param record_rss: whether to snapshot RSS at the start and end of every stage
+        """
+        self.progress_callback = progress_callback
+        self.record_rss = record_rss
+        self.events: List[dict] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._progress_start = self._origin
+        self._total_tensors = 0
+        self._total_bytes = 0
+        self._done_tensors = 0
+        self._done_bytes = 0
+
+    def stage(self, name: str, **args) -> _Span:
+        return _Span(self, STAGE_KIND, name, args)
+
+    def tensor(self, name: str, stage: str, nbytes: int = 0) -> _Span:
+        return _Span(self, TENSOR_KIND, name, {"stage": stage, "bytes": nbytes})
+
+    def start_progress(self, total_tensors: int, total_bytes: int):
+        with self._lock:
+            self._progress_start = time.perf_counter()
+            self._total_tensors = total_tensors
+            self._total_bytes = total_bytes
+            self._done_tensors = 0
+            self._done_bytes = 0
+
+    def record(self, span: _Span, end: float):
+        event = {"kind": span.kind, "name": span.name, "start": span.start - self._origin,
+                 "seconds": end - span.start, "thread": threading.current_thread().name}
+        event.update(span.args)
+        if span.kind == STAGE_KIND and self.record_rss:
+            event["rss_start_kb"] = span.rss_kb
+            event["rss_end_kb"] = current_rss_kb()
+        progress = None
+        with self._lock:
+            self.events.append(event)
+            if span.kind == TENSOR_KIND and span.args.get("stage") == PROGRESS_STAGE:
+                self._done_tensors += 1
+                self._done_bytes += span.args.get("bytes", 0)
+                progress = self._progress(end)
+        if progress is not None and self.progress_callback is not None:
+            self.progress_callback(progress)
+
+    def _progress(self, now: float) -> Progress:
+        elapsed = now - self._progress_start
+        eta = None
+        if self._total_bytes and self._done_bytes:
+            eta = elapsed * (self._total_bytes - self._done_bytes) / self._done_bytes
+        elif self._total_tensors and self._done_tensors:
+            eta = elapsed * (self._total_tensors - self._done_tensors) / self._done_tensors
+        return Progress(self._done_tensors, self._total_tensors, self._done_bytes, self._total_bytes, elapsed, eta)
+
+    def summary(self) -> dict:
+        """seconds of every stage, seconds and bytes of every tensor stage summed over tensors, peak RSS seen"""
+        stages: Dict[str, float] = {}
+        tensor_stages: Dict[str, Dict[str, float]] = {}
+        peak_rss_kb = None
+        for event in self.events:
+            if event["kind"] == STAGE_KIND:
+                stages[event["name"]] = stages.get(event["name"], 0.0) + event["seconds"]
+                for rss in (event.get("rss_start_kb"), event.get("rss_end_kb")):
+                    if rss is not None and (peak_rss_kb is None or rss > peak_rss_kb):
+                        peak_rss_kb = rss
+            else:
+                totals = tensor_stages.setdefault(event["stage"], {"tensors": 0, "seconds": 0.0, "bytes": 0})
+                totals["tensors"] += 1
+                totals["seconds"] += event["seconds"]
+                totals["bytes"] += event["bytes"]
+        return {"stages": stages, "tensor_stages": tensor_stages, "peak_rss_kb": peak_rss_kb}
+
+    def to_dict(self) -> dict:
+        return {"summary": self.summary(), "events": list(self.events)}
+
+    def save_json(self, json_path: str):
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def chrome_trace(self) -> dict:
+        """trace event format, spans are complete events, RSS snapshots are counters"""
+        pid = os.getpid()
+        thread_ids: Dict[str, int] = {}
+        trace_events = []
+        for event in self.events:
+            tid = thread_ids.setdefault(event["thread"], len(thread_ids))
+            args = {key: value for key, value in event.items()
+                    if key not in ("kind", "name", "start", "seconds", "thread")}
+            trace_events.append({"name": event["name"], "cat": event["kind"], "ph": "X", "pid": pid, "tid": tid,
+                                 "ts": event["start"] * 1e6, "dur": event["seconds"] * 1e6, "args": args})
+            for key, ts in (("rss_start_kb", event["start"]), ("rss_end_kb", event["start"] + event["seconds"])):
+                if event.get(key) is not None:
+                    trace_events.append({"name": "rss", "ph": "C", "pid": pid, "ts": ts * 1e6,
+                                         "args": {"rss_mb": event[key] / 1024}})
+        for thread_name, tid in thread_ids.items():
+            trace_events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                                 "args": {"name": thread_name}})
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, trace_path: str):
+        with open(trace_path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Convert many ckpt files in one warm process. Jobs run on a bounded thread pool and share parsed metadata,
+compiled layer name maps, policies and the index cache of reference gguf headers. Every job reports its status
+and throughput.
+
+python -m models.batch_convert --jobs jobs.json --workers 2 --report report.json
+python -m models.batch_convert --watch spool --workers 2
+
+jobs.json is a list of jobs, or {"jobs": [...]}. ckpt, output, reference and config_dir are relative to the job
+file, metadata, name_map, quantize_policy and transpose_map_json_path are relative to the config folder, which is
+models/<model>/configs or config_dir. quantize_policy true means the one in the config folder, a job with a
+reference gguf splices the ckpt into it:
+[
+    {"ckpt": "llama2_7b.ckpt", "model": "llama2", "output": "llama2_7b.gguf",
+     "quantize_policy": true, "options": {"pipeline": true}},
+    {"ckpt": "qwen_7b.ckpt", "config_dir": "qwen/configs", "metadata": "qwen-7b-gguf-metadata.json",
+     "arch": "qwen", "output": "qwen_7b.gguf", "reference": "qwen-7b.Q4_K.gguf"}
+]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+from constant import GGUFException
+from gguf_index_cache import DEFAULT_INDEX_CACHE_DIR, GGUFIndexCache
+from models.config_cache import ConfigCache
+from models.main_writer import Writer
+from models.splice_writer import SpliceWriter
+
+MODELS_DIR = os.path.dirname(os.path.abspath(__file__))
+METADATA_SUFFIX = "-gguf-metadata.json"
+NAME_MAP_SUFFIX = "_layer_name_map.json"
+QUANTIZE_POLICY_SUFFIX = "_quantize_policy.json"
+REPORT_SUFFIX = ".report.json"
+# a job file in the spool folder is renamed with these suffixes while it runs and after it is done
+RUNNING_SUFFIX = ".running"
+DONE_SUFFIX = ".done"
+# keyword arguments of Writer and SpliceWriter a job may set in "options"
+WRITER_OPTIONS = ("need_transpose", "streaming", "workers", "max_in_flight", "float_type",
+                  "transpose_map_json_path", "incremental", "pipeline", "max_shard_bytes", "shard_workers")
+SPLICE_OPTIONS = ("need_transpose", "transpose_map_json_path", "keep_patterns")
+_PATH_OPTIONS = ("transpose_map_json_path",)
+DEFAULT_POLL_SECONDS = 10.0
+
+
+class ConversionJob(NamedTuple):
+    name: str
+    ckpt_path: str
+    output_path: str
+    # None for splice jobs
+    metadata_json_path: Optional[str]
+    layer_name_map_json_path: str
+    # None means general.architecture of the metadata
+    arch: Optional[str]
+    quantize_policy_json_path: Optional[str]
+    # splice the ckpt into this gguf instead of writing a new one
+    reference_gguf_path: Optional[str]
+    options: dict
+
+
+class JobResult(NamedTuple):
+    name: str
+    output_path: str
+    # "ok" or "failed"
+    status: str
+    seconds: float
+    ckpt_bytes: int
+    output_bytes: int
+    error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        result = self._asdict()
+        seconds = self.seconds if self.seconds > 0 else None
+        result["ckpt_mb_per_second"] = self.ckpt_bytes / (1 << 20) / seconds if seconds else None
+        result["output_mb_per_second"] = self.output_bytes / (1 << 20) / seconds if seconds else None
+        return result
+
+
+def find_config(config_dir: str, suffix: str) -> str:
+    """the only file in config_dir ending with suffix"""
+    names = sorted(name for name in os.listdir(config_dir) if name.endswith(suffix))
+    if len(names) != 1:
+        raise GGUFException("expected one *{0} in {1}, found {2}, set it in the job".format(suffix, config_dir,
+                                                                                         len(names)))
+    return os.path.join(config_dir, names[0])
+
+
+def parse_job(job: dict, base_dir: str, index: int) -> ConversionJob:
+    """
+    :param job: one entry of the job list
+    :param base_dir: relative paths in the job are relative to it
+    :param index: position of the job in the list, used in error messages
+    :return:
+    """
+    def resolve(path: Optional[str], directory: str = base_dir) -> Optional[str]:
+        return None if path is None else os.path.normpath(os.path.join(directory, os.path.expanduser(path)))
+
+    if not isinstance(job, dict):
+        raise GGUFException("job {0} should be an object, got {1}".format(index, type(job).__name__))
+    for key in ("ckpt", "output"):
+        if key not in job:
+            raise GGUFException("job {0} has no {1}".format(index, key))
+    if "config_dir" in job:
+        config_dir = resolve(job["config_dir"])
+    elif "model" in job:
+        config_dir = os.path.join(MODELS_DIR, job["model"], "configs")
+    else:
+        config_dir = None
+    if config_dir is not None and not os.path.isdir(config_dir):
+        raise GGUFException("config folder {0} of job {1} does not exist".format(config_dir, index))
+
+    def config_path(key: str, suffix: str) -> str:
+        if job.get(key):
+            return resolve(job[key], config_dir or base_dir)
+        if config_dir is None:
+            raise GGUFException("job {0} needs {1}, model or config_dir".format(index, key))
+        return find_config(config_dir, suffix)
+
+    quantize_policy_json_path = None
+    if job.get("quantize_policy") is True:
+        if config_dir is None:
+            raise GGUFException("job {0} needs model or config_dir to find its quantize policy".format(index))
+        quantize_policy_json_path = find_config(config_dir, QUANTIZE_POLICY_SUFFIX)
+    elif job.get("quantize_policy"):
+        quantize_policy_json_path = config_path("quantize_policy", QUANTIZE_POLICY_SUFFIX)
+    reference_gguf_path = resolve(job.get("reference"))
+    if not isinstance(job.get("options", {}), dict):
+        raise GGUFException("options of job {0} should be an object".format(index))
+    options = dict(job.get("options", {}))
+    allowed_options = SPLICE_OPTIONS if reference_gguf_path else WRITER_OPTIONS
+    for key in options:
+        if key not in allowed_options:
+            raise GGUFException("unknown option {0} of job {1}, choose from {2}".format(key, index,
+                                                                                      ", ".join(allowed_options)))
+    for key in _PATH_OPTIONS:
+        if options.get(key):
+            options[key] = resolve(options[key], config_dir or base_dir)
+    return ConversionJob(name=job.get("name") or os.path.basename(job["output"]),
+                         ckpt_path=resolve(job["ckpt"]),
+                         output_path=resolve(job["output"]),
+                         # splice keeps the metadata of the reference
+                         metadata_json_path=None if reference_gguf_path else config_path("metadata", METADATA_SUFFIX),
+                         layer_name_map_json_path=config_path("name_map", NAME_MAP_SUFFIX),
+                         arch=job.get("arch"),
+                         quantize_policy_json_path=quantize_policy_json_path,
+                         reference_gguf_path=reference_gguf_path,
+                         options=options)
+
+
+def load_jobs(jobs_json_path: str) -> List[ConversionJob]:
+    """parse and check every job before any of them runs"""
+    with open(jobs_json_path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    if isinstance(entries, dict):
+        entries = entries.get("jobs", [])
+    if not isinstance(entries, list):
+        raise GGUFException("{0} should hold a list of jobs".format(jobs_json_path))
+    base_dir = os.path.dirname(os.path.abspath(jobs_json_path))
+    jobs = [parse_job(entry, base_dir, index) for index, entry in enumerate(entries)]
+    output_paths = set()
+    for job in jobs:
+        if job.output_path in output_paths:
+            raise GGUFException("more than one job writes {0}".format(job.output_path))
+        output_paths.add(job.output_path)
+    return jobs
+
+
+class BatchConverter:
+    def __init__(self, workers: int = 1, config_cache: Optional[ConfigCache] = None,
+                 index_cache: Optional[GGUFIndexCache] = None):
+        """
+        :param workers: number of jobs running at the same time, every job holds about its largest tensor
+            in memory, or more with job options such as pipeline
+        :param config_cache: shared by jobs, default None means a new one
+        :param index_cache: index cache of reference gguf headers used by splice jobs, default None means no cache
+        """
+        if workers < 1:
+            raise ValueError("workers should be at least 1, got {0}".format(workers))
+        self.workers = workers
+        self.config_cache = config_cache or ConfigCache()
+        self.index_cache = index_cache
+
+    def _arch(self, job: ConversionJob) -> str:
+        if job.arch:
+            return job.arch
+        arch = self.config_cache.metadata(job.metadata_json_path).get("general.architecture")
+        arch = arch.value if arch is not None else None
+        if not arch:
+            raise GGUFException("set arch of job {0}, {1} has no general.architecture".format(
+                job.name, job.metadata_json_path))
+        return arch
+
+    def run_job(self, job: ConversionJob) -> JobResult:
+        """run one job, errors are reported in the result instead of raised"""
+        logging.info("job %s starts: %s -> %s", job.name, job.ckpt_path, job.output_path)
+        start = time.perf_counter()
+        output_paths = [job.output_path]
+        try:
+            if job.reference_gguf_path:
+                SpliceWriter(job.reference_gguf_path, job.layer_name_map_json_path, job.ckpt_path,
+                             job.output_path, index_cache=self.index_cache, **job.options).write()
+            else:
+                writer = Writer(metadata_json_path=job.metadata_json_path,
+                                layer_name_map_json_path=job.layer_name_map_json_path,
+                                ckpt_file_path=job.ckpt_path,
+                                arch=self._arch(job),
+                                quantize_policy_json_path=job.quantize_policy_json_path,
+                                output_path=job.output_path,
+                                config_cache=self.config_cache,
+                                **job.options)
+                writer.write()
+                # a sharded output is written as files named after output_path
+                output_paths = writer.shard_paths or output_paths
+        except Exception as e:
+            seconds = time.perf_counter() - start
+            logging.error("job %s failed after %.1fs: %s", job.name, seconds, e, exc_info=True)
+            return JobResult(job.name, job.output_path, "failed", seconds, _file_size(job.ckpt_path), 0,
+                             "{0}: {1}".format(type(e).__name__, e))
+        seconds = time.perf_counter() - start
+        result = JobResult(job.name, job.output_path, "ok", seconds, _file_size(job.ckpt_path),
+                           sum(_file_size(path) for path in output_paths))
+        logging.info("job %s done in %.1fs, %.1f MiB/s of ckpt", job.name, seconds,
+                     result.to_dict()["ckpt_mb_per_second"] or 0.0)
+        return result
+
+    def run(self, jobs: List[ConversionJob]) -> List[JobResult]:
+        """run the jobs on the pool, results are in the order of jobs"""
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gguf-batch") as executor:
+            return list(executor.map(self.run_job, jobs))
+
+    def report(self, results: List[JobResult], seconds: float) -> dict:
+        return {
+            "jobs": [result.to_dict() for result in results],
+            "ok": sum(result.status == "ok" for result in results),
+            "failed": sum(result.status != "ok" for result in results),
+            "seconds": seconds,
+            "config_cache": {"hits": self.config_cache.hits, "misses": self.config_cache.misses},
+        }
+
+    def run_file(self, jobs_json_path: str, report_json_path: Optional[str] = None) -> dict:
+        """run the jobs of a job file, the report is saved when report_json_path is given"""
+        start = time.perf_counter()
+        jobs = load_jobs(jobs_json_path)
+        report = self.report(self.run(jobs), time.perf_counter() - start)
+        if report_json_path:
+            with open(report_json_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        return report
+
+    def watch(self, spool_dir: str, poll_seconds: float = DEFAULT_POLL_SECONDS):
+        """
+        run job files put in spool_dir until interrupted, jobs.json is renamed to jobs.json.running while it
+        runs, then to jobs.json.done next to its jobs.json.report.json
+        """
+        while True:
+            names = sorted(name for name in os.listdir(spool_dir) if name.endswith(".json")
+                           and not name.endswith(REPORT_SUFFIX))
+            for name in names:
+                jobs_json_path = os.path.join(spool_dir, name)
+                running_path = jobs_json_path + RUNNING_SUFFIX
+                try:
+                    # another watcher may have taken it
+                    os.rename(jobs_json_path, running_path)
+                except FileNotFoundError:
+                    continue
+                try:
+                    report = self.run_file(running_path, jobs_json_path + REPORT_SUFFIX)
+                    logging.info("%s: %d ok, %d failed", name, report["ok"], report["failed"])
+                except (OSError, ValueError, GGUFException) as e:
+                    logging.error("job file %s is invalid: %s", name, e)
+                    with open(jobs_json_path + REPORT_SUFFIX, "w", encoding="utf-8") as f:
+                        json.dump({"error": "{0}: {1}".format(type(e).__name__, e)}, f, indent=2)
+                os.rename(running_path, jobs_json_path + DONE_SUFFIX)
+            time.sleep(poll_seconds)
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="convert many MindSpore ckpt files to gguf in one process")
+    parser.add_argument("--jobs", default=None, help="job list json file path")
+    parser.add_argument("--watch", default=None, help="run job files put in this folder until interrupted")
+    parser.add_argument("--poll-seconds", type=float, default=DEFAULT_POLL_SECONDS,
+                        help="interval of checking the watched folder")
+    parser.add_argument("--workers", type=int, default=1, help="number of jobs running at the same time")
+    parser.add_argument("--report", default=None, help="save the report to this json file path")
+    parser.add_argument("--index-cache-dir", default=DEFAULT_INDEX_CACHE_DIR,
+                        help="folder of the index cache of reference gguf headers")
+    args = parser.parse_args()
+    if bool(args.jobs) == bool(args.watch):
+        parser.error("set one of --jobs and --watch")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(message)s")
+    converter = BatchConverter(args.workers, index_cache=GGUFIndexCache(args.index_cache_dir))
+    if args.watch:
+        converter.watch(args.watch, args.poll_seconds)
+        sys.exit(0)
+    batch_report = converter.run_file(args.jobs, args.report)
+    print(json.dumps(batch_report, indent=2))
+    sys.exit(1 if batch_report["failed"] else 0)
@@ -1,63 +1,241 @@
 """
 Utils to load MindSpore ckpt file and convert to numpy ndArray
 """
-import copy
 import json
 import logging
+import re
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Tuple, Union
 
-import mindspore as ms
 import numpy as np
-from mindspore import ops
+
+from constant import GGUFException
+from instrumentation import NULL_INSTRUMENTATION, Instrumentation
+from models.ckpt_reader import BFLOAT16_TYPE_NAME, CkptTensor, CkptTensorInfo, MsCkptReader
+from models.transpose_util import TransposePolicy, permuted_shape
+
+if TYPE_CHECKING:
+    import mindspore as ms
+
+_BF16_EXPONENT_BIAS = 127
+_F16_EXPONENT_BIAS = 15
+
+
+def bf16_to_float32(bits: np.ndarray) -> np.ndarray:
+    """
+    bfloat16 is the high half of float32, so the conversion is exact.
+    :param bits: uint16 ndarray of bfloat16 bits
+    :return: float32 ndarray
+    """
+    return (bits.astype(np.uint32) << 16).view(np.float32)
+
+
+def bf16_to_float16(bits: np.ndarray) -> np.ndarray:
+    """
+    convert bfloat16 to float16 by rebiasing the exponent and widening the mantissa, 7 bits mantissa always fits
+    in 10 bits, so normal numbers are exact. values too large become inf, values in float16 subnormal range are
+    rounded through float32.
+    :param bits: uint16 ndarray of bfloat16 bits
+    :return: float16 ndarray
+    """
+    bits = np.ascontiguousarray(bits, dtype=np.uint16)
+    sign = bits & 0x8000
+    exponent = ((bits >> 7) & 0xFF).astype(np.int16)
+    mantissa = bits & 0x7F
+    f16_exponent = exponent - (_BF16_EXPONENT_BIAS - _F16_EXPONENT_BIAS)
+    result = sign | (np.clip(f16_exponent, 0, 31).astype(np.uint16) << 10) | (mantissa << 3)
+    # inf and nan
+    result = np.where(exponent == 0xFF, sign | 0x7C00 | (mantissa << 3), result)
+    overflow = (f16_exponent >= 31) & (exponent != 0xFF)
+    if overflow.any():
+        logging.warning("%d bfloat16 values overflow float16, they become inf", int(overflow.sum()))
+        result = np.where(overflow, sign | 0x7C00, result)
+    subnormal = f16_exponent <= 0
+    if subnormal.any():
+        result[subnormal] = bf16_to_float32(bits[subnormal]).astype(np.float16).view(np.uint16)
+    return result.view(np.float16)
+
+
+class LayerNameMapper:
+    def __init__(self, name_map: Dict[str, str]):
+        """
+        rename ms layer names to gguf names in one pass with a precompiled regex.
+        keys are compiled as a character trie, so matching cost does not grow with the size of the map,
+        and at the same position the longest key wins, so the result does not depend on the order of the map.
+        :param name_map: ms to gguf layer name map, such as {"model.layers": "blk", "feed_forward.w1": "ffn_gate"}
+        """
+        self.name_map = dict(name_map)
+        # capturing group, split returns [text, key, text, key, ..., text]
+        self._pattern = re.compile("(" + LayerNameMapper._trie_regex(self.name_map) + ")") if self.name_map else None
+        self._memo: Dict[str, str] = {}
+
+    @staticmethod
+    def _trie_regex(keys: Iterable[str]) -> str:
+        trie: dict = {}
+        for key in keys:
+            node = trie
+            for char in key:
+                node = node.setdefault(char, {})
+            # empty string marks the end of a key
+            node[""] = {}
+
+        def to_regex(node: dict) -> str:
+            branches = [re.escape(char) + to_regex(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ""
+            regex = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            # greedy optional, longer keys are tried first
+            return "(?:" + regex + ")?" if "" in node else regex
+
+        return to_regex(trie)
+
+    @staticmethod
+    def from_json(name_map_path: str) -> "LayerNameMapper":
+        with open(name_map_path, encoding="utf-8", mode="r") as f:
+            return LayerNameMapper(json.load(f))
+
+    def rename(self, name: str) -> str:
+        renamed = self._memo.get(name)
+        if renamed is None:
+            if self._pattern is None:
+                renamed = name
+            else:
+                parts = self._pattern.split(name)
+                parts[1::2] = [self.name_map[key] for key in parts[1::2]]
+                renamed = "".join(parts)
+            self._memo[name] = renamed
+        return renamed
+
+    def rename_all(self, names: Iterable[str]) -> Dict[str, str]:
+        """
+        :param names: ms layer names
+        :return: ms name to gguf name dict
+        """
+        full_name_map = {name: self.rename(name) for name in names}
+        if len(set(full_name_map.values())) != len(full_name_map):
+            seen: Dict[str, str] = {}
+            for name, renamed in full_name_map.items():
+                if renamed in seen:
+                    raise GGUFException("layer {0} and {1} are both renamed to {2}".format(seen[renamed], name,
+                                                                                         renamed))
+                seen[renamed] = name
+        return full_name_map
 
 
 class MsCkptRefactorHelper:
 
     @staticmethod
-    def convert_ms_tensor_to_ndarray(ms_tensor: ms.Tensor, tensor_name: str) -> np.ndarray:
+    def _convert_bf16_bits(bits: np.ndarray, dtype: Optional[np.dtype]) -> np.ndarray:
+        if dtype is not None and np.dtype(dtype) == np.float16:
+            return bf16_to_float16(bits)
+        return bf16_to_float32(bits).astype(dtype or np.float32, copy=False)
+
+    @staticmethod
+    def convert_ms_tensor_to_ndarray(ms_tensor: Union[CkptTensor, "ms.Tensor"], tensor_name: str,
+                                     dtype: Optional[np.dtype] = np.float32) -> np.ndarray:
         """
         converts ms tensor to ndarray.
-        :param ms_tensor:
+        :param ms_tensor: tensor read by MsCkptReader, or ms tensor
         :param tensor_name:
-        :return:
+        :param dtype: float32 or float16, None means keeping the precision, float16 stays float16 and
+            bfloat16 becomes float32
+        :return: ndarray, it may be a read only view of the ckpt file
         """
-        logging.info("now convert ms tensor name is: {0}", tensor_name)
-        return ms_tensor.asnumpy().astype(np.float32)
+        logging.info("now convert ms tensor name is: %s", tensor_name)
+        if isinstance(ms_tensor, CkptTensor):
+            ndarray = ms_tensor.array()
+            if ms_tensor.dtype == BFLOAT16_TYPE_NAME:
+                return MsCkptRefactorHelper._convert_bf16_bits(ndarray, dtype)
+        else:
+            # MindSpore is only needed for tensors loaded by itself
+            import mindspore as ms
+            if ms_tensor.dtype == ms.bfloat16:
+                try:
+                    bits = ms_tensor.asnumpy().view(np.uint16)
+                except TypeError:
+                    # numpy has no bfloat16 in old MindSpore versions
+                    return ms_tensor.astype(ms.float32).asnumpy().astype(dtype or np.float32, copy=False)
+                return MsCkptRefactorHelper._convert_bf16_bits(bits, dtype)
+            ndarray = ms_tensor.asnumpy()
+        if dtype is None:
+            return ndarray
+        return ndarray.astype(dtype, copy=False)
+
+    @staticmethod
+    def is_half_precision(ms_tensor: Union[CkptTensor, "ms.Tensor"]) -> bool:
+        """whether the tensor is float16 or bfloat16"""
+        if isinstance(ms_tensor, CkptTensor):
+            return ms_tensor.dtype in ("Float16", BFLOAT16_TYPE_NAME)
+        import mindspore as ms
+        return ms_tensor.dtype in (ms.float16, ms.bfloat16)
 
-    def __init__(self, ms_ckpt_path: str, name_map_path: str, transpose: bool = False):
+    def __init__(self, ms_ckpt_path: str, name_map_path: str, transpose: bool = False,
+                 transpose_policy: Optional[TransposePolicy] = None,
+                 instrumentation: Optional[Instrumentation] = None, name_mapper: Optional[LayerNameMapper] = None):
         """
         :param ms_ckpt_path: ms ckpt file path
         :param name_map_path: ms to gguf layer name map path
-        :param transpose: default False, means transpose the tensor
+        :param transpose: default False, kept for callers passing it by position, it only builds the default
+            TransposePolicy(transpose_2d=transpose) when transpose_policy is None
+        :param transpose_policy: axes permutation of tensors, it decides every transpose, default None means
+            transposing 2d tensors when transpose is True
+        :param instrumentation: receiver of stage events, default None means no instrumentation
+        :param name_mapper: compiled name map shared by conversions, default None means it is read from
+            name_map_path
         """
-        self.ckpt_dict = ms.load_checkpoint(ms_ckpt_path)
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        # tensors are views of the mapped ckpt file, they are read when converted
+        with self.instrumentation.stage("ckpt_scan", path=ms_ckpt_path) as span:
+            self._reader = MsCkptReader(ms_ckpt_path)
+            # offsets of tensors in file, so that worker processes can map tensors themselves
+            self.ckpt_infos: Dict[str, CkptTensorInfo] = dict(self._reader.tensor_infos)
+            self.ckpt_dict: Dict[str, CkptTensor] = {name: self._reader.read(info)
+                                                     for name, info in self.ckpt_infos.items()}
+            span.set(tensors=len(self.ckpt_dict))
         self._name_map_path = name_map_path
         self._ms_to_gguf_map: dict = {}
+        self._name_mapper: Optional[LayerNameMapper] = name_mapper
         self.full_name_ms_to_gguf_map: dict = {}
-        self.need_transpose = transpose
+        self.transpose_policy = transpose_policy or TransposePolicy(transpose_2d=transpose)
+        # gguf name to axes permutation, tensors are transposed lazily when they are written
+        self.transpose_plan: Dict[str, Tuple[int, ...]] = {}
 
     def _read_name_map_json(self):
+        if self._name_mapper is not None:
+            self._ms_to_gguf_map = self._name_mapper.name_map
+            return
         with open(self._name_map_path, encoding="utf-8", mode="r") as f:
             self._ms_to_gguf_map = json.load(f)
+        self._name_mapper = LayerNameMapper(self._ms_to_gguf_map)
 
     def _layer_rename(self):
-        ckpt_layer_names = list(self.ckpt_dict.keys())
-        ckpt_layer_names_copy = copy.deepcopy(ckpt_layer_names)
-        for i in range(len(ckpt_layer_names)):
-            for map_key in self._ms_to_gguf_map:
-                if map_key in self._ms_to_gguf_map:
-                    ckpt_layer_names[i] = ckpt_layer_names[i].replace(map_key, self._ms_to_gguf_map[map_key])
-            self.full_name_ms_to_gguf_map[ckpt_layer_names_copy[i]] = ckpt_layer_names[i]
-        for rename_layer in self.full_name_ms_to_gguf_map:
-            self.ckpt_dict[self.full_name_ms_to_gguf_map[rename_layer]] = self.ckpt_dict.pop(rename_layer)
+        self.full_name_ms_to_gguf_map = self._name_mapper.rename_all(self.ckpt_dict)
+        self.ckpt_dict = {self.full_name_ms_to_gguf_map[name]: tensor for name, tensor in self.ckpt_dict.items()}
+        self.ckpt_infos = {self.full_name_ms_to_gguf_map[name]: info for name, info in self.ckpt_infos.items()}
 
     def _layer_tensor_transpose(self):
-        if self.need_transpose:
-            for layer in self.ckpt_dict:
-                # todo: now only support 2d
-                if self.ckpt_dict[layer].dim() == 2:
-                    self.ckpt_dict[layer] = ops.transpose(self.ckpt_dict[layer], (1, 0))
+        """plan the transpose only, a full transposed copy of every tensor would double the memory"""
+        self.transpose_plan = {}
+        for layer, tensor in self.ckpt_dict.items():
+            axes = self.transpose_policy.axes(layer, tuple(tensor.shape))
+            if axes is not None:
+                self.transpose_plan[layer] = axes
+
+    def transpose_axes(self, layer: str) -> Optional[Tuple[int, ...]]:
+        """axes permutation of the gguf layer, None means it is written as it is"""
+        return self.transpose_plan.get(layer)
+
+    def tensor_shape(self, layer: str) -> Tuple[int, ...]:
+        """numpy shape of the gguf layer after transpose"""
+        return permuted_shape(tuple(self.ckpt_dict[layer].shape), self.transpose_plan.get(layer))
+
+    def close(self):
+        self.ckpt_dict = {}
+        self.ckpt_infos = {}
+        self._reader.close()
 
     def do_refactor(self):
         self._read_name_map_json()
-        self._layer_rename()
-        self._layer_tensor_transpose()
+        with self.instrumentation.stage("rename"):
+            self._layer_rename()
+        with self.instrumentation.stage("transpose_plan"):
+            self._layer_tensor_transpose()
@@ -0,0 +1,299 @@
+"""
+Read MindSpore ckpt files tensor by tensor from the protobuf framing, without loading the MindSpore runtime
+"""
+import logging
+import mmap
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from constant import GGUFException
+
+# Checkpoint {repeated Value value = 1}, every entry is the field key 0x0a and the length of a Value message
+_CHECKPOINT_VALUE_KEY = 0x0a
+# appended after the messages when the ckpt is saved with crc_check=True
+_CRC_RECORD_PREFIX = b"crc_num"
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_LENGTH_DELIMITED = 2
+_WIRE_FIXED32 = 5
+
+BFLOAT16_TYPE_NAME = "BFloat16"
+STRING_TYPE_NAME = "str"
+# numpy has no bfloat16, its bits are read as uint16
+CKPT_NP_DTYPE_DICT = {
+    "Int8": np.dtype(np.int8),
+    "UInt8": np.dtype(np.uint8),
+    "Int16": np.dtype("<i2"),
+    "UInt16": np.dtype("<u2"),
+    "Int32": np.dtype("<i4"),
+    "UInt32": np.dtype("<u4"),
+    "Int64": np.dtype("<i8"),
+    "UInt64": np.dtype("<u8"),
+    "Float16": np.dtype("<f2"),
+    "Float32": np.dtype("<f4"),
+    "Float64": np.dtype("<f8"),
+    "Bool": np.dtype(np.bool_),
+    BFLOAT16_TYPE_NAME: np.dtype("<u2"),
+}
+
+
+class CkptTensorInfo(NamedTuple):
+    name: str
+    # ckpt tensor type, such as "Float32", "BFloat16"
+    dtype: str
+    shape: Tuple[int, ...]
+    # (offset, length) of every slice of tensor content in file, large tensors are saved in several slices
+    chunks: List[Tuple[int, int]]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(length for _, length in self.chunks)
+
+
+class CkptTensor(NamedTuple):
+    name: str
+    # ckpt tensor type, such as "Float32", "BFloat16"
+    dtype: str
+    shape: Tuple[int, ...]
+    # memory mapped views of file, one for every slice of tensor content, they are never joined here
+    chunks: List[memoryview]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(chunk.nbytes for chunk in self.chunks)
+
+    def _copy_bytes(self, start: int, stop: int, out: np.ndarray):
+        """copy content bytes [start, stop) into the uint8 ndarray out, only the slices holding them are read"""
+        chunk_start = 0
+        for chunk in self.chunks:
+            chunk_stop = chunk_start + chunk.nbytes
+            if chunk_stop > start and chunk_start < stop:
+                begin, end = max(start, chunk_start), min(stop, chunk_stop)
+                out[begin - start:end - start] = np.frombuffer(chunk, dtype=np.uint8)[
+                    begin - chunk_start:end - chunk_start]
+            chunk_start = chunk_stop
+
+    def array(self) -> np.ndarray:
+        """
+        ndarray of the tensor, bfloat16 is returned as uint16 bits.
+        :return: read only view of the mapped file when the tensor is saved in one slice, else a new array the
+            slices are copied into, it is not kept by the tensor
+        """
+        np_dtype = CKPT_NP_DTYPE_DICT[self.dtype]
+        if len(self.chunks) == 1:
+            return np.frombuffer(self.chunks[0], dtype=np_dtype).reshape(self.shape)
+        result = np.empty(self.shape, dtype=np_dtype)
+        self._copy_bytes(0, self.nbytes, result.reshape(-1).view(np.uint8))
+        return result
+
+    def take(self, indices: np.ndarray) -> np.ndarray:
+        """
+        elements at flat indices of the tensor, only these elements are read from the mapped slices.
+        :param indices: int ndarray of flat indices in C order
+        :return: new ndarray of the shape of indices
+        """
+        np_dtype = CKPT_NP_DTYPE_DICT[self.dtype]
+        result = np.empty(indices.shape, dtype=np_dtype)
+        chunk_start = 0
+        for chunk in self.chunks:
+            if chunk.nbytes % np_dtype.itemsize != 0:
+                raise GGUFException("slice of tensor {0} is not a whole number of elements".format(self.name))
+            chunk_stop = chunk_start + chunk.nbytes // np_dtype.itemsize
+            selected = (indices >= chunk_start) & (indices < chunk_stop)
+            if selected.any():
+                result[selected] = np.frombuffer(chunk, dtype=np_dtype)[indices[selected] - chunk_start]
+            chunk_start = chunk_stop
+        return result
+
+
+def _read_varint(buffer, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _skip_field(buffer, pos: int, wire_type: int) -> int:
+    if wire_type == _WIRE_VARINT:
+        return _read_varint(buffer, pos)[1]
+    if wire_type == _WIRE_FIXED64:
+        return pos + 8
+    if wire_type == _WIRE_LENGTH_DELIMITED:
+        length, pos = _read_varint(buffer, pos)
+        return pos + length
+    if wire_type == _WIRE_FIXED32:
+        return pos + 4
+    raise GGUFException("unexpected protobuf wire type {0} at offset {1}".format(wire_type, pos))
+
+
+class MsCkptReader:
+    def __init__(self, ckpt_path: str):
+        """
+        scan the ckpt file lazily, only the framing of messages is parsed, tensor contents are not touched
+        until they are used.
+        :param ckpt_path: ms ckpt file path, encrypted ckpt is not supported
+        """
+        self.ckpt_path = ckpt_path
+        self._f = open(ckpt_path, "rb")
+        self._mmap: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+        if self._file_size() > 0:
+            self._mmap = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        self._tensor_infos: Optional[Dict[str, CkptTensorInfo]] = None
+
+    def _file_size(self) -> int:
+        self._f.seek(0, 2)
+        size = self._f.tell()
+        self._f.seek(0)
+        return size
+
+    def __enter__(self) -> "MsCkptReader":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _parse_tensor(self, start: int, end: int) -> Tuple[str, List[int], int, int]:
+        """parse TensorProto {repeated int64 dims = 1; string tensor_type = 2; bytes tensor_content = 3}"""
+        buffer = self._mmap
+        dims = []
+        tensor_type = ""
+        content_offset, content_length = start, 0
+        pos = start
+        while pos < end:
+            key, pos = _read_varint(buffer, pos)
+            field, wire_type = key >> 3, key & 7
+            if field == 1 and wire_type == _WIRE_VARINT:
+                dim, pos = _read_varint(buffer, pos)
+                dims.append(dim)
+            elif field == 1 and wire_type == _WIRE_LENGTH_DELIMITED:
+                # packed dims
+                length, pos = _read_varint(buffer, pos)
+                packed_end = pos + length
+                while pos < packed_end:
+                    dim, pos = _read_varint(buffer, pos)
+                    dims.append(dim)
+            elif field == 2 and wire_type == _WIRE_LENGTH_DELIMITED:
+                length, pos = _read_varint(buffer, pos)
+                tensor_type = str(self._view[pos:pos + length], "utf-8")
+                pos += length
+            elif field == 3 and wire_type == _WIRE_LENGTH_DELIMITED:
+                content_length, pos = _read_varint(buffer, pos)
+                content_offset = pos
+                pos += content_length
+            else:
+                pos = _skip_field(buffer, pos, wire_type)
+        return tensor_type, dims, content_offset, content_length
+
+    def _iter_values(self) -> Iterator[Tuple[str, Optional[Tuple[str, List[int], int, int]]]]:
+        """
+        parse Value {string tag = 1; oneof {TensorProto tensor = 2; MapTensorProto maptensor = 3}} one by one
+        :return: iterator of (tag, parsed tensor), tensor is None for map tensors
+        """
+        if self._mmap is None:
+            return
+        buffer = self._mmap
+        file_size = len(buffer)
+        pos = 0
+        while pos < file_size:
+            if buffer[pos] != _CHECKPOINT_VALUE_KEY:
+                if buffer[pos:pos + len(_CRC_RECORD_PREFIX)] == _CRC_RECORD_PREFIX:
+                    return
+                raise GGUFException("{0} is not a plain MindSpore ckpt, unexpected byte at offset {1}".format(
+                    self.ckpt_path, pos))
+            length, pos = _read_varint(buffer, pos + 1)
+            end = pos + length
+            if end > file_size:
+                raise GGUFException("{0} is truncated at offset {1}".format(self.ckpt_path, pos))
+            tag = ""
+            tensor = None
+            while pos < end:
+                key, pos = _read_varint(buffer, pos)
+                field, wire_type = key >> 3, key & 7
+                if field == 1 and wire_type == _WIRE_LENGTH_DELIMITED:
+                    tag_length, pos = _read_varint(buffer, pos)
+                    tag = str(self._view[pos:pos + tag_length], "utf-8")
+                    pos += tag_length
+                elif field == 2 and wire_type == _WIRE_LENGTH_DELIMITED:
+                    tensor_length, pos = _read_varint(buffer, pos)
+                    tensor = self._parse_tensor(pos, pos + tensor_length)
+                    pos += tensor_length
+                else:
+                    pos = _skip_field(buffer, pos, wire_type)
+            yield tag, tensor
+
+    def iter_tensor_infos(self) -> Iterator[CkptTensorInfo]:
+        """
+        scan the file incrementally, consecutive slices of the same tag are coalesced into one tensor.
+        string values and map tensors are skipped.
+        :return:
+        """
+        current: Optional[CkptTensorInfo] = None
+        for tag, tensor in self._iter_values():
+            if tensor is None:
+                logging.warning("skip map tensor %s of ckpt", tag)
+                continue
+            tensor_type, dims, content_offset, content_length = tensor
+            if current is not None and current.name == tag:
+                current.chunks.append((content_offset, content_length))
+                continue
+            if current is not None:
+                yield current
+                current = None
+            if tensor_type == STRING_TYPE_NAME:
+                logging.info("skip string value %s of ckpt", tag)
+                continue
+            if tensor_type not in CKPT_NP_DTYPE_DICT:
+                raise GGUFException("unsupported tensor type {0} of {1}".format(tensor_type, tag))
+            # MindSpore saves the shape of scalars as [0]
+            shape = () if dims == [0] else tuple(dims)
+            current = CkptTensorInfo(tag, tensor_type, shape, [(content_offset, content_length)])
+        if current is not None:
+            yield current
+
+    @property
+    def tensor_infos(self) -> Dict[str, CkptTensorInfo]:
+        """tensor name to info, in file order"""
+        if self._tensor_infos is None:
+            self._tensor_infos = {info.name: info for info in self.iter_tensor_infos()}
+        return self._tensor_infos
+
+    def read(self, info: CkptTensorInfo) -> CkptTensor:
+        """tensor over the mapped slices, nothing is read or copied until its content is used"""
+        chunks = [self._view[offset:offset + length] for offset, length in info.chunks]
+        expected = int(np.prod(info.shape, dtype=np.int64)) * CKPT_NP_DTYPE_DICT[info.dtype].itemsize
+        if info.nbytes != expected:
+            raise GGUFException("tensor {0} of shape {1} should have {2} bytes, got {3}".format(
+                info.name, info.shape, expected, info.nbytes))
+        return CkptTensor(info.name, info.dtype, info.shape, chunks)
+
+    def tensor(self, name: str) -> CkptTensor:
+        return self.read(self.tensor_infos[name])
+
+    def __iter__(self) -> Iterator[CkptTensor]:
+        for info in self.iter_tensor_infos():
+            yield self.read(info)
+
+    def close(self):
+        """
+        release the mapping, it is kept alive by buffers still referenced by caller.
+        :return:
+        """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # some views are still exported, the mapping is released when they are collected
+                pass
+            self._mmap = None
+        self._f.close()
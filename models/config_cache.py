@@ -0,0 +1,55 @@
+"""
+In-process cache of parsed model configs, so that conversions in one process share the metadata, the compiled
+layer name map and the policies instead of reading them again. An entry is reloaded when its file changes.
+"""
+import os
+import threading
+from typing import Any, Callable, Dict, Tuple
+
+from gguf_typed_metadata import TypedMetadataValue, load_metadata_json
+from models.ckpt_convert_util import LayerNameMapper
+from models.quantize_util import QuantizePolicy
+from models.transpose_util import TransposePolicy
+
+
+class ConfigCache:
+    def __init__(self):
+        """thread safe, entries are keyed by absolute path and validated by modify time and size"""
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], Tuple[Tuple[int, int], Any]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, kind: str, path: str, load: Callable[[str], Any]) -> Any:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get((kind, path))
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+        # loaded outside the lock, two threads may both load a new entry, the later one is kept
+        value = load(path)
+        with self._lock:
+            self._entries[(kind, path)] = (version, value)
+            self.misses += 1
+        return value
+
+    def metadata(self, metadata_json_path: str) -> Dict[str, TypedMetadataValue]:
+        """a copy of the typed metadata kv pairs, the writer adds keys to it, arrays are shared and not modified"""
+        return dict(self._get("metadata", metadata_json_path, load_metadata_json))
+
+    def name_mapper(self, layer_name_map_json_path: str) -> LayerNameMapper:
+        return self._get("name_map", layer_name_map_json_path, LayerNameMapper.from_json)
+
+    def quantize_policy(self, quantize_policy_json_path: str) -> QuantizePolicy:
+        return self._get("quantize_policy", quantize_policy_json_path, QuantizePolicy.from_json)
+
+    def transpose_policy(self, transpose_map_json_path: str, transpose_2d: bool = False) -> TransposePolicy:
+        return self._get("transpose_policy_{0}".format(int(transpose_2d)), transpose_map_json_path,
+                         lambda path: TransposePolicy.from_json(path, transpose_2d))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,147 @@
+"""
+Manifest of per tensor content hashes written next to the output gguf, so that a later conversion only
+converts the tensors changed since then
+"""
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+from typing import Dict, NamedTuple, Optional, Sequence
+
+import numpy as np
+from gguf import GGUF_MAGIC, GGUF_VERSION, GGUFWriter, GGMLQuantizationType
+
+from models.ckpt_reader import CkptTensor
+
+MANIFEST_SUFFIX = ".manifest.json"
+# the new file is written next to the output and replaces it at the end, the output is never left half written
+PARTIAL_SUFFIX = ".partial"
+# bump it when the layout of manifest changes
+MANIFEST_FORMAT_VERSION = 1
+
+
+def _digest():
+    return hashlib.blake2b(digest_size=20)
+
+
+def tensor_digest(tensor: CkptTensor) -> str:
+    """hash of the raw ckpt content, the mapped slices are hashed in order without copy"""
+    digest = _digest()
+    for chunk in tensor.chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tensor_recipe(tensor: CkptTensor, tensor_type: GGMLQuantizationType, axes: Optional[Sequence[int]]) -> str:
+    """everything besides the content deciding the encoded bytes of a tensor"""
+    return "{0}:{1}:{2}:{3}".format(tensor.dtype, list(tensor.shape), tensor_type.name,
+                                    list(axes) if axes is not None else None)
+
+
+def gguf_header_bytes(gguf_writer: GGUFWriter) -> bytes:
+    """
+    bytes written by write_header_to_file, write_kv_data_to_file and write_ti_data_to_file, padded to alignment,
+    they are computed before anything is written.
+    :param gguf_writer: gguf writer whose kv data and tensors info are added
+    :return:
+    """
+    header = struct.pack("<IIQQ", GGUF_MAGIC, GGUF_VERSION, gguf_writer.ti_data_count, gguf_writer.kv_data_count)
+    header += bytes(gguf_writer.kv_data) + bytes(gguf_writer.ti_data)
+    return header + bytes(GGUFWriter.ggml_pad(len(header), gguf_writer.data_alignment) - len(header))
+
+
+def header_hash(header: bytes) -> str:
+    digest = _digest()
+    digest.update(header)
+    return digest.hexdigest()
+
+
+def pwrite_all(fd: int, data: np.ndarray, offset: int):
+    """write all bytes of a C contiguous ndarray at offset, pwrite may write less than asked"""
+    view = memoryview(np.ascontiguousarray(data).reshape(-1).view(np.uint8))
+    while view:
+        n_written = os.pwrite(fd, view, offset)
+        view = view[n_written:]
+        offset += n_written
+
+
+class TensorRecord(NamedTuple):
+    digest: str
+    recipe: str
+    # absolute offset of tensor data in output file
+    offset: int
+    nbytes: int
+
+
+class ConversionManifest:
+    def __init__(self, output_path: str, header_hash_: str, tensors: Dict[str, TensorRecord],
+                 output_size: int = 0, output_mtime_ns: int = 0):
+        """
+        :param output_path: output gguf file path
+        :param header_hash_: hash of the output header bytes, from the beginning of file to tensor data
+        :param tensors: gguf tensor name to record
+        :param output_size: output file size in bytes, when the manifest is saved
+        :param output_mtime_ns: output file modify time in nanoseconds, when the manifest is saved
+        """
+        self.output_path = output_path
+        self.header_hash = header_hash_
+        self.tensors = tensors
+        self.output_size = output_size
+        self.output_mtime_ns = output_mtime_ns
+
+    @staticmethod
+    def manifest_path(output_path: str) -> str:
+        return output_path + MANIFEST_SUFFIX
+
+    @staticmethod
+    def load(output_path: str) -> Optional["ConversionManifest"]:
+        """
+        get the manifest of the output, None if there is no manifest or the output is changed by someone else.
+        :param output_path:
+        :return:
+        """
+        manifest_path = ConversionManifest.manifest_path(output_path)
+        if not os.path.isfile(manifest_path) or not os.path.isfile(output_path):
+            return None
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                content = json.load(f)
+            if content.get("version") != MANIFEST_FORMAT_VERSION:
+                return None
+            tensors = {name: TensorRecord(*record) for name, record in content["tensors"].items()}
+            manifest = ConversionManifest(output_path, content["header_hash"], tensors, content["output_size"],
+                                          content["output_mtime_ns"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("drop broken manifest %s: %s", manifest_path, e)
+            return None
+        stat = os.stat(output_path)
+        if stat.st_size != manifest.output_size or stat.st_mtime_ns != manifest.output_mtime_ns:
+            logging.info("%s is changed since the manifest is saved", output_path)
+            return None
+        return manifest
+
+    def save(self):
+        """save the manifest with the current size and modify time of output"""
+        stat = os.stat(self.output_path)
+        self.output_size = stat.st_size
+        self.output_mtime_ns = stat.st_mtime_ns
+        content = {"version": MANIFEST_FORMAT_VERSION, "header_hash": self.header_hash,
+                   "output_size": self.output_size, "output_mtime_ns": self.output_mtime_ns,
+                   "tensors": {name: list(record) for name, record in self.tensors.items()}}
+        manifest_path = ConversionManifest.manifest_path(self.output_path)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifest_path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(content, f)
+            os.replace(temp_path, manifest_path)
+        except OSError:
+            os.remove(temp_path)
+            raise
+
+    def unchanged(self, name: str, record: TensorRecord) -> bool:
+        """whether the encoded bytes of the tensor in output are still the same"""
+        old_record = self.tensors.get(name)
+        return old_record is not None and old_record.digest == record.digest \
+            and old_record.recipe == record.recipe and old_record.nbytes == record.nbytes
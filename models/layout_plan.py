@@ -0,0 +1,224 @@
+"""
+Dry-run estimate of a conversion: offsets and sizes of the output and the memory the chosen writer options need,
+computed from ckpt shapes and dtypes only, no tensor data is read. Writer.plan builds it.
+"""
+import heapq
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from gguf import GGMLQuantizationType
+
+from models.ckpt_reader import BFLOAT16_TYPE_NAME, CKPT_NP_DTYPE_DICT
+from models.pipeline import DEFAULT_PIPELINE_DEPTH
+from models.quantize_util import FLOAT_TYPE_NP_DICT, QUANTIZE_CHUNK_ELEMENTS
+
+MODE_IN_MEMORY = "in_memory"
+MODE_STREAMING = "streaming"
+MODE_WORKERS = "workers"
+MODE_PIPELINE = "pipeline"
+MODE_SHARDED = "sharded"
+MODE_INCREMENTAL = "incremental"
+
+# temporaries of quantizing one chunk, measured up to about 6.5 float32 chunks for Q8_0 and the K-quants
+_QUANTIZE_SCRATCH_CHUNKS = 8
+# peak bytes per element of converting bfloat16 to float16 with its temporaries, the result is 2 of them
+_BF16_TO_F16_BYTES_PER_ELEMENT = 15
+# resident size of a spawned worker process once numpy and the quantizers are imported, measured about 37 MiB
+_WORKER_PROCESS_BYTES = 40 << 20
+
+
+class TensorPlan(NamedTuple):
+    name: str
+    # ckpt tensor type, such as "Float32", "BFloat16"
+    ckpt_dtype: str
+    # numpy shape written, after transpose
+    shape: Tuple[int, ...]
+    type: GGMLQuantizationType
+    transposed: bool
+    # index of the output file, 0 unless the output is sharded
+    file_index: int
+    # absolute offset of tensor data in its file
+    offset: int
+    # bytes of the encoded tensor
+    n_bytes: int
+    # bytes of the tensor in ckpt
+    source_bytes: int
+    # saved in several slices, reading it joins them into one ndarray
+    sliced: bool = False
+
+    @property
+    def n_elements(self) -> int:
+        return int(np.prod(self.shape, dtype=np.int64))
+
+    def joined_bytes(self) -> int:
+        """bytes of the copy the slices of a sliced tensor are joined into, 0 when it is a view of ckpt"""
+        return self.source_bytes if self.sliced else 0
+
+    def converted_bytes(self) -> int:
+        """bytes of the ndarray a ckpt tensor is converted to before it is encoded, 0 when it is a view of ckpt"""
+        ckpt_dtype = CKPT_NP_DTYPE_DICT.get(self.ckpt_dtype, np.dtype(np.float32))
+        joined_bytes = self.joined_bytes()
+        if self.type in FLOAT_TYPE_NP_DICT and not self.transposed:
+            # cast to the type to write at once, the encoded tensor is this ndarray
+            target = np.dtype(FLOAT_TYPE_NP_DICT[self.type])
+            if self.ckpt_dtype == BFLOAT16_TYPE_NAME and target == np.float16:
+                return joined_bytes + self.n_elements * _BF16_TO_F16_BYTES_PER_ELEMENT
+            if self.ckpt_dtype != BFLOAT16_TYPE_NAME and ckpt_dtype == target:
+                # the joined copy is the encoded tensor
+                return joined_bytes
+            return joined_bytes + self.n_elements * target.itemsize
+        # the precision of ckpt is kept, bfloat16 becomes float32
+        return joined_bytes + (self.n_elements * 4 if self.ckpt_dtype == BFLOAT16_TYPE_NAME else 0)
+
+    def encoded_bytes(self) -> int:
+        """bytes allocated for the encoded tensor, 0 when the converted ndarray is written as it is"""
+        if self.type in FLOAT_TYPE_NP_DICT and not self.transposed:
+            return 0 if self.converted_bytes() == 0 else self.n_bytes
+        return self.n_bytes
+
+    def scratch_bytes(self) -> int:
+        """temporaries of encoding, quantization runs in chunks, floats are copied tile by tile"""
+        if self.type in FLOAT_TYPE_NP_DICT:
+            return 0
+        chunk_bytes = min(self.n_elements, QUANTIZE_CHUNK_ELEMENTS) * 4
+        float32_source = self.ckpt_dtype in ("Float32", BFLOAT16_TYPE_NAME) and not self.transposed
+        return chunk_bytes * _QUANTIZE_SCRATCH_CHUNKS + (0 if float32_source else chunk_bytes)
+
+    def conversion_bytes(self) -> int:
+        """memory held while this tensor is converted and encoded, the mapped ckpt aside"""
+        if self.type in FLOAT_TYPE_NP_DICT and not self.transposed:
+            return self.converted_bytes()
+        return self.converted_bytes() + self.n_bytes + self.scratch_bytes()
+
+
+class FilePlan(NamedTuple):
+    path: str
+    # header, metadata and tensors info padded to alignment
+    header_bytes: int
+    # tensor data, every tensor padded to alignment
+    data_bytes: int
+    tensors: int
+
+    @property
+    def file_bytes(self) -> int:
+        return self.header_bytes + self.data_bytes
+
+
+def _largest_sum(values, n: int) -> int:
+    return sum(heapq.nlargest(n, values)) if n > 0 else 0
+
+
+def node_memory() -> Optional[Dict[str, int]]:
+    """total and available memory of this node in bytes, None where /proc/meminfo is not available"""
+    fields = {}
+    try:
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                fields[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        return None
+    if "MemTotal" not in fields:
+        return None
+    return {"total_bytes": fields["MemTotal"], "available_bytes": fields.get("MemAvailable", fields["MemFree"])}
+
+
+class LayoutPlan:
+    def __init__(self, mode: str, files: List[FilePlan], tensors: List[TensorPlan], alignment: int,
+                 ckpt_bytes: int, base_rss_bytes: int, workers: int = 0, max_in_flight: int = 0,
+                 shard_workers: int = 1, pipeline_depth: int = DEFAULT_PIPELINE_DEPTH):
+        """
+        :param mode: how tensors are written, one of the MODE_ constants
+        :param files: output files, several when sharded
+        :param tensors: tensors in file order
+        :param alignment: alignment of tensor data
+        :param ckpt_bytes: size of the ckpt file
+        :param base_rss_bytes: resident size of the process before tensors are converted
+        :param workers: worker processes of MODE_WORKERS
+        :param max_in_flight: tensors submitted to workers but not written yet
+        :param shard_workers: shards written at the same time in MODE_SHARDED
+        :param pipeline_depth: tensors buffered between two stages in MODE_PIPELINE
+        """
+        self.mode = mode
+        self.files = files
+        self.tensors = tensors
+        self.alignment = alignment
+        self.ckpt_bytes = ckpt_bytes
+        self.base_rss_bytes = base_rss_bytes
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.shard_workers = shard_workers
+        self.pipeline_depth = pipeline_depth
+
+    def working_bytes(self) -> int:
+        """memory needed on top of the base resident size by the tensors being converted"""
+        tensors = self.tensors
+        if not tensors:
+            return 0
+        if self.mode == MODE_IN_MEMORY:
+            # gguf writer keeps every encoded tensor until all of them are converted
+            return sum(tensor.encoded_bytes() for tensor in tensors) + max(
+                tensor.conversion_bytes() - tensor.encoded_bytes() for tensor in tensors)
+        if self.mode == MODE_WORKERS:
+            # float tensors which are not transposed are converted here, workers read and encode the others and
+            # pickle the result back, results wait in order
+            in_flight = _largest_sum((tensor.n_bytes for tensor in tensors), self.max_in_flight)
+            here = max((tensor.conversion_bytes() for tensor in tensors
+                        if tensor.type in FLOAT_TYPE_NP_DICT and not tensor.transposed), default=0)
+            per_worker = max((tensor.conversion_bytes() + tensor.n_bytes for tensor in tensors
+                              if tensor.type not in FLOAT_TYPE_NP_DICT or tensor.transposed), default=0)
+            return in_flight + here + self.workers * (_WORKER_PROCESS_BYTES + per_worker)
+        if self.mode == MODE_PIPELINE:
+            # reusable read and write buffers grow to the largest tensor, slices are read into them, conversion
+            # encodes into them
+            return self.pipeline_depth * (max(tensor.source_bytes for tensor in tensors) +
+                                          max(tensor.n_bytes for tensor in tensors)) + max(
+                tensor.converted_bytes() - tensor.joined_bytes() + tensor.scratch_bytes() for tensor in tensors)
+        if self.mode == MODE_SHARDED:
+            largest_of_files: Dict[int, int] = {}
+            for tensor in tensors:
+                largest_of_files[tensor.file_index] = max(largest_of_files.get(tensor.file_index, 0),
+                                                          tensor.conversion_bytes())
+            return _largest_sum(largest_of_files.values(), self.shard_workers)
+        return max(tensor.conversion_bytes() for tensor in tensors)
+
+    def stage_bytes(self) -> Dict[str, int]:
+        """bytes read from ckpt, bytes of encoded tensors and bytes written to the output files"""
+        return {"read": sum(tensor.source_bytes for tensor in self.tensors),
+                "convert": sum(tensor.n_bytes for tensor in self.tensors),
+                "write": sum(file.file_bytes for file in self.files)}
+
+    def memory(self) -> dict:
+        working_bytes = self.working_bytes()
+        peak_rss_bytes = self.base_rss_bytes + working_bytes
+        memory = {"base_rss_bytes": self.base_rss_bytes, "working_bytes": working_bytes,
+                  "peak_rss_bytes": peak_rss_bytes,
+                  # pages of the mapped ckpt count in RSS once read, the kernel reclaims them under pressure
+                  "peak_rss_with_ckpt_pages_bytes": peak_rss_bytes + self.ckpt_bytes}
+        node = node_memory()
+        if node is not None:
+            memory["node"] = node
+            memory["fits"] = peak_rss_bytes <= node["available_bytes"]
+        return memory
+
+    def to_dict(self, with_tensors: bool = True) -> dict:
+        """
+        :param with_tensors: whether to list the layout of every tensor
+        :return:
+        """
+        result = {"mode": self.mode, "alignment": self.alignment,
+                  "file_bytes": sum(file.file_bytes for file in self.files),
+                  "files": [{"path": file.path, "header_bytes": file.header_bytes, "data_bytes": file.data_bytes,
+                             "file_bytes": file.file_bytes, "tensors": file.tensors} for file in self.files],
+                  "stages": self.stage_bytes(), "memory": self.memory()}
+        if self.mode == MODE_WORKERS:
+            result["workers"] = self.workers
+            result["max_in_flight"] = self.max_in_flight
+        elif self.mode == MODE_SHARDED:
+            result["shard_workers"] = self.shard_workers
+        if with_tensors:
+            result["tensors"] = [{"name": tensor.name, "type": tensor.type.name, "shape": list(tensor.shape),
+                                  "ckpt_dtype": tensor.ckpt_dtype, "file": tensor.file_index,
+                                  "offset": tensor.offset, "n_bytes": tensor.n_bytes,
+                                  "conversion_bytes": tensor.conversion_bytes()} for tensor in self.tensors]
+        return result
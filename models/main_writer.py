@@ -1,26 +1,109 @@
 #!/usr/bin/env python3
+import argparse
 import json
 import logging
+import multiprocessing
+import os
 import sys
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
+
+from constant import GGUFException, GGUFMetadataValueType
+from gguf_typed_metadata import TypedMetadataValue, encode_metadata_kv, load_metadata_json
+from instrumentation import NULL_INSTRUMENTATION, Instrumentation, Recorder, current_rss_kb, log_progress
 from models.ckpt_convert_util import MsCkptRefactorHelper
+from models.ckpt_reader import CkptTensorInfo, MsCkptReader
+from models.config_cache import ConfigCache
+from models.incremental import ConversionManifest, TensorRecord, PARTIAL_SUFFIX, gguf_header_bytes, header_hash, \
+    pwrite_all, tensor_digest, tensor_recipe
+from models.layout_plan import FilePlan, LayoutPlan, TensorPlan, MODE_IN_MEMORY, MODE_INCREMENTAL, MODE_PIPELINE, \
+    MODE_SHARDED, MODE_STREAMING, MODE_WORKERS
+from models.pipeline import PipelineTask, run_pipeline
+from models.quantize_util import QuantizePolicy, quantize, quantized_nbytes, encoded_layout, FILE_TYPE_KEY, \
+    QUANTIZATION_VERSION_KEY, GGML_QUANTIZATION_VERSION, FLOAT_TYPE_NP_DICT, AUTO_TYPE_NAME
+from models.transpose_util import TransposePolicy, permuted_shape
+from read_gguf import ALIGNMENT_KEY, SPLIT_COUNT_KEY, SPLIT_NO_KEY, SPLIT_TENSORS_COUNT_KEY, split_path
 
 # Necessary to load the local gguf package
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from gguf import GGUFWriter, GGMLQuantizationType  # noqa: E402
+from gguf import GGUFWriter, GGMLQuantizationType, GGUF_DEFAULT_ALIGNMENT  # noqa: E402
+
+GGUF_SUFFIX = ".gguf"
+# ckpt files mapped by a worker process, tensors are read there by their offsets instead of being sent by the parent
+_WORKER_READERS: Dict[str, MsCkptReader] = {}
+
+
+def parse_size(size: str) -> int:
+    """bytes of a size such as "4G", "500M" or "1024", units are powers of 1024"""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = size.strip().upper()
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def _convert_in_worker(ckpt_path: str, info: CkptTensorInfo, dtype: Optional[np.dtype],
+                       tensor_type: GGMLQuantizationType, axes: Optional[Tuple[int, ...]]) -> np.ndarray:
+    """entry of worker processes, read the tensor from the mapped ckpt, convert and encode it"""
+    reader = _WORKER_READERS.get(ckpt_path)
+    if reader is None:
+        reader = _WORKER_READERS[ckpt_path] = MsCkptReader(ckpt_path)
+    ndarray_tensor = MsCkptRefactorHelper.convert_ms_tensor_to_ndarray(reader.read(info), info.name, dtype)
+    return quantize(ndarray_tensor, tensor_type, axes)
 
 
 class Writer:
     def __init__(self, metadata_json_path: str, layer_name_map_json_path: str,
-                 ckpt_file_path: str, arch: str, need_transpose: bool = False):
+                 ckpt_file_path: str, arch: str, need_transpose: bool = False, streaming: bool = True,
+                 quantize_policy_json_path: Optional[str] = None, workers: int = 0,
+                 max_in_flight: Optional[int] = None, float_type: str = AUTO_TYPE_NAME,
+                 transpose_map_json_path: Optional[str] = None, output_path: str = "example.gguf",
+                 incremental: bool = False, pipeline: bool = False,
+                 instrumentation: Optional[Instrumentation] = None, config_cache: Optional[ConfigCache] = None,
+                 max_shard_bytes: Optional[int] = None, shard_workers: Optional[int] = None):
         """
-        :param metadata_json_path: metadata_kv_pairs json file path
+        :param metadata_json_path: metadata_kv_pairs json file path, typed json of make_gguf_meta_data_json.py
+            --typed keeps the type of every key, a plain json object writes int as UINT32 and float as FLOAT32
         :param layer_name_map_json_path: layer name map json file path
         :param ckpt_file_path: MindSpore json file path
         :param arch: model arch, such as "baichuan", "llama"
         :param need_transpose: whether you need transpose, default False
+        :param streaming: default True, write tensor infos first, then convert, write and free tensors one by one,
+            so that peak memory is about the largest tensor instead of the whole model
+        :param quantize_policy_json_path: quantize policy json file path, such as
+            "llama2/configs/llama2_quantize_policy.json", default None means every tensor is written as F32
+        :param workers: number of worker processes converting tensors in parallel when streaming, they read
+            tensors from the mapped ckpt themselves, float tensors which are not transposed are still converted in
+            the main process, so only quantizing and transposing scale with workers. default 0 means converting in
+            the main process
+        :param max_in_flight: max number of tensors submitted to workers but not written yet, it bounds memory,
+            default None means twice the workers
+        :param float_type: "auto", "F32" or "F16", float type of tensors which are not quantized, default "auto"
+            keeps the precision of ckpt, float16 and bfloat16 tensors are written as F16, others as F32
+        :param transpose_map_json_path: transpose json file path, axes permutation of tensors by gguf name pattern,
+            tensors matching no rule are transposed as need_transpose, default None
+        :param output_path: output gguf file path, default "example.gguf"
+        :param incremental: default False, save a manifest of tensor hashes next to the output, a later run only
+            converts the tensors changed since then, the output is patched in place when its layout is the same,
+            else rewritten reusing the unchanged tensor bytes. it needs streaming
+        :param pipeline: default False, read ckpt tensors, convert them and write them in three overlapped stages
+            connected by reusable buffers, the output is preallocated. it needs streaming, it is exclusive with
+            workers and incremental
+        :param instrumentation: receiver of stage and tensor events, such as instrumentation.Recorder,
+            default None means no instrumentation
+        :param config_cache: parsed metadata, name map and policies shared by conversions in one process,
+            default None means they are read from their json files
+        :param max_shard_bytes: split the output into shards of at most this many tensor bytes, as gguf-split of
+            llama.cpp does, "model.gguf" is written as "model-00001-of-00003.gguf" and so on, only the first shard
+            has the metadata, a tensor larger than it has a shard of its own. default None means one file.
+            it needs streaming, it is exclusive with workers, incremental and pipeline
+        :param shard_workers: number of shards written at the same time, every one holds about its largest tensor
+            in memory, default None means one per shard up to the number of CPUs
         """
         self.metadata_json_path = metadata_json_path
         self.layer_name_map_json_path = layer_name_map_json_path
@@ -28,52 +111,405 @@ class Writer:
         # ms ckpt helper
         self.ms_helper: MsCkptRefactorHelper
         # gguf_metadata kv pairs
-        self.metadata_kv_pairs: dict = {}
+        self.metadata_kv_pairs: Dict[str, TypedMetadataValue] = {}
         # gguf writer
         self.gguf_writer: GGUFWriter
         # arch
         self.arch = arch
         # whether you need transpose
         self.transpose = need_transpose
+        self.transpose_map_json_path = transpose_map_json_path
+        # whether tensors are written one by one
+        self.streaming = streaming
+        # quantize policy
+        self.quantize_policy_json_path = quantize_policy_json_path
+        self.quantize_policy: QuantizePolicy
+        # ggml type of every tensor to write
+        self.tensor_types: Dict[str, GGMLQuantizationType] = {}
+        # encoded bytes of every tensor to write
+        self.tensor_nbytes: Dict[str, int] = {}
+        # worker pool
+        self.workers = workers
+        self.max_in_flight = max_in_flight if max_in_flight else 2 * workers
+        if float_type not in (AUTO_TYPE_NAME, GGMLQuantizationType.F32.name, GGMLQuantizationType.F16.name):
+            raise ValueError("float_type should be auto, F32 or F16, got {0}".format(float_type))
+        self.float_type = float_type
+        self.output_path = output_path
+        if incremental and not streaming:
+            raise ValueError("incremental conversion needs streaming")
+        self.incremental = incremental
+        if pipeline and (not streaming or workers > 0 or incremental):
+            raise ValueError("pipeline needs streaming, and can not be used with workers or incremental")
+        self.pipeline = pipeline
+        if max_shard_bytes is not None and (max_shard_bytes <= 0 or not streaming or workers > 0 or incremental
+                                            or pipeline):
+            raise ValueError("max_shard_bytes should be positive, it needs streaming, and can not be used with "
+                             "workers, incremental or pipeline")
+        self.max_shard_bytes = max_shard_bytes
+        self.shard_workers = shard_workers
+        # output file paths and gguf writers of shards, tensor name to its shard
+        self.shard_paths: List[str] = []
+        self.shard_writers: List[GGUFWriter] = []
+        self.tensor_shards: Dict[str, int] = {}
+        # absolute offset of tensor data in output file, it is known after tensors info are added
+        self.tensor_offsets: Dict[str, int] = {}
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        self.config_cache = config_cache
+        # gguf writers of a dry run write to os.devnull
+        self.__dry_run = False
+
+    def __data_alignment(self) -> int:
+        """general.alignment of the metadata, tensor data is padded to it"""
+        alignment = self.metadata_kv_pairs.get(ALIGNMENT_KEY)
+        if alignment is None:
+            return GGUF_DEFAULT_ALIGNMENT
+        alignment = int(alignment.value)
+        if alignment == 0 or alignment % 8 != 0:
+            raise GGUFException("Invalid alignment: {0}".format(alignment))
+        return alignment
+
+    def __open_gguf_writer(self, path: str) -> GGUFWriter:
+        gguf_writer = GGUFWriter(os.devnull if self.__dry_run else path, self.arch)
+        # the key itself is written with the other metadata
+        gguf_writer.data_alignment = self.__data_alignment()
+        return gguf_writer
 
     def __set_up(self):
         # init ms helper
-        self.ms_helper = MsCkptRefactorHelper(self.ckpt_file_path, self.layer_name_map_json_path, self.transpose)
+        transpose_policy = None
+        if self.transpose_map_json_path and self.config_cache is not None:
+            transpose_policy = self.config_cache.transpose_policy(self.transpose_map_json_path, self.transpose)
+        elif self.transpose_map_json_path:
+            transpose_policy = TransposePolicy.from_json(self.transpose_map_json_path, self.transpose)
+        name_mapper = None
+        if self.config_cache is not None:
+            name_mapper = self.config_cache.name_mapper(self.layer_name_map_json_path)
+        self.ms_helper = MsCkptRefactorHelper(self.ckpt_file_path, self.layer_name_map_json_path, self.transpose,
+                                              transpose_policy, self.instrumentation, name_mapper)
         self.ms_helper.do_refactor()
         # init metadata kv pairs
-        with open(self.metadata_json_path, "r", encoding="utf-8") as f:
-            self.metadata_kv_pairs = json.load(f)
-        # init gguf writer
-        self.gguf_writer = GGUFWriter("example.gguf", self.arch)
+        if self.config_cache is not None:
+            self.metadata_kv_pairs = self.config_cache.metadata(self.metadata_json_path)
+        else:
+            self.metadata_kv_pairs = load_metadata_json(self.metadata_json_path)
+        # init quantize policy
+        if self.quantize_policy_json_path and self.config_cache is not None:
+            self.quantize_policy = self.config_cache.quantize_policy(self.quantize_policy_json_path)
+        elif self.quantize_policy_json_path:
+            self.quantize_policy = QuantizePolicy.from_json(self.quantize_policy_json_path)
+        else:
+            self.quantize_policy = QuantizePolicy(default_type=AUTO_TYPE_NAME)
+        # init gguf writer, writers of shards are opened once the tensor sizes are known
+        # incremental conversion writes a partial file, the last output is still read while writing
+        if self.max_shard_bytes is None:
+            self.gguf_writer = self.__open_gguf_writer(self.output_path + PARTIAL_SUFFIX if self.incremental
+                                                       else self.output_path)
+
+    def __plan_shards(self):
+        """divide tensors in order into shards, then open a gguf writer for every shard"""
+        shards: List[List[str]] = [[]]
+        shard_bytes = 0
+        alignment = self.__data_alignment()
+        for tensor_name in self.ms_helper.ckpt_dict:
+            nbytes = GGUFWriter.ggml_pad(self.tensor_nbytes[tensor_name], alignment)
+            if shards[-1] and shard_bytes + nbytes > self.max_shard_bytes:
+                shards.append([])
+                shard_bytes = 0
+            shards[-1].append(tensor_name)
+            shard_bytes += nbytes
+        path_prefix = self.output_path[:-len(GGUF_SUFFIX)] if self.output_path.endswith(GGUF_SUFFIX) \
+            else self.output_path
+        self.shard_paths = [split_path(path_prefix, split_no, len(shards)) for split_no in range(len(shards))]
+        self.tensor_shards = {tensor_name: split_no for split_no, tensor_names in enumerate(shards)
+                              for tensor_name in tensor_names}
+        self.shard_writers = []
+        for split_no, shard_path in enumerate(self.shard_paths):
+            gguf_writer = self.__open_gguf_writer(shard_path)
+            gguf_writer.add_uint16(SPLIT_NO_KEY, split_no)
+            gguf_writer.add_uint16(SPLIT_COUNT_KEY, len(self.shard_paths))
+            gguf_writer.add_int32(SPLIT_TENSORS_COUNT_KEY, len(self.tensor_shards))
+            if split_no > 0 and alignment != GGUF_DEFAULT_ALIGNMENT:
+                # every shard is read by itself, so the alignment of its data is set in all of them
+                gguf_writer.add_uint32(ALIGNMENT_KEY, alignment)
+            self.shard_writers.append(gguf_writer)
+        # metadata is written to the first shard only
+        self.gguf_writer = self.shard_writers[0]
+        logging.info("split %d tensors into %d shards", len(self.tensor_shards), len(self.shard_paths))
 
     def __write_metadata(self):
-        for metadata_key in self.metadata_kv_pairs:
-            if metadata_key == "general.architecture":
-                # we have set the arch in __set_up method
-                continue
-            # we should check if it is bool first, because isinstance(True, int) is also True
-            if isinstance(self.metadata_kv_pairs[metadata_key], bool):
-                self.gguf_writer.add_bool(metadata_key, self.metadata_kv_pairs[metadata_key])
-            elif isinstance(self.metadata_kv_pairs[metadata_key], int):
-                self.gguf_writer.add_uint32(metadata_key, self.metadata_kv_pairs[metadata_key])
-            elif isinstance(self.metadata_kv_pairs[metadata_key], float):
-                self.gguf_writer.add_float32(metadata_key, self.metadata_kv_pairs[metadata_key])
-            elif isinstance(self.metadata_kv_pairs[metadata_key], str):
-                self.gguf_writer.add_string(metadata_key, self.metadata_kv_pairs[metadata_key])
-            elif isinstance(self.metadata_kv_pairs[metadata_key], list):
-                self.gguf_writer.add_array(metadata_key, self.metadata_kv_pairs[metadata_key])
-            else:
-                logging.error("Unexpected metadata key type: {0} of key :{1}", type(
-                    self.metadata_kv_pairs[metadata_key]), metadata_key)
+        # kv pairs are encoded with their own types and appended at once, numeric arrays are packed by numpy
+        kv_pairs = [(metadata_key, value) for metadata_key, value in self.metadata_kv_pairs.items()
+                    # we have set the arch in __set_up method
+                    if metadata_key != "general.architecture"]
+        self.gguf_writer.kv_data += b"".join(encode_metadata_kv(metadata_key, value)
+                                             for metadata_key, value in kv_pairs)
+        self.gguf_writer.kv_data_count += len(kv_pairs)
+
+    def __set_metadata(self, metadata_key: str, value: int):
+        """set an integer key, keeping its type in the metadata json, UINT32 for a new key"""
+        current = self.metadata_kv_pairs.get(metadata_key)
+        value_type = GGUFMetadataValueType.UINT32 if current is None else current.value_type
+        self.metadata_kv_pairs[metadata_key] = TypedMetadataValue(value_type, value)
+
+    def __source_float_type(self, ms_tensor) -> GGMLQuantizationType:
+        if self.float_type != AUTO_TYPE_NAME:
+            return GGMLQuantizationType[self.float_type]
+        if MsCkptRefactorHelper.is_half_precision(ms_tensor):
+            return GGMLQuantizationType.F16
+        return GGMLQuantizationType.F32
+
+    def __resolve_tensor_types(self):
+        """
+        decide the ggml type of every tensor from its shape and dtype, then set the file type,
+        file type copied from the reference gguf no longer matches the tensors.
+        """
+        n_elements_of_types: Dict[GGMLQuantizationType, int] = {}
+        for tensor_name in self.ms_helper.ckpt_dict:
+            ms_tensor = self.ms_helper.ckpt_dict[tensor_name]
+            shape = self.ms_helper.tensor_shape(tensor_name)
+            tensor_type = self.quantize_policy.tensor_type(tensor_name, shape, self.__source_float_type(ms_tensor))
+            self.tensor_types[tensor_name] = tensor_type
+            self.tensor_nbytes[tensor_name] = quantized_nbytes(shape, tensor_type)
+            n_elements_of_types[tensor_type] = n_elements_of_types.get(tensor_type, 0) + int(np.prod(shape))
+        float_type = GGMLQuantizationType.F32
+        if n_elements_of_types.get(GGMLQuantizationType.F16, 0) > n_elements_of_types.get(float_type, 0):
+            float_type = GGMLQuantizationType.F16
+        self.__set_metadata(FILE_TYPE_KEY, self.quantize_policy.file_type(float_type))
+        if self.quantize_policy.quantized:
+            self.__set_metadata(QUANTIZATION_VERSION_KEY, GGML_QUANTIZATION_VERSION)
+        else:
+            self.metadata_kv_pairs.pop(QUANTIZATION_VERSION_KEY, None)
+
+    def __convert_dtype(self, tensor_name: str) -> Optional[np.dtype]:
+        """float tensors to write are converted to their dtype directly,
+        tensors to quantize or transpose keep the precision of ckpt, they are cast while transposed"""
+        if self.ms_helper.transpose_axes(tensor_name) is None:
+            return FLOAT_TYPE_NP_DICT.get(self.tensor_types[tensor_name])
+        return None
+
+    def __convert_ms_tensor(self, tensor_name: str, ms_tensor) -> np.ndarray:
+        """convert ms tensor to ndarray of the dtype given by __convert_dtype"""
+        return MsCkptRefactorHelper.convert_ms_tensor_to_ndarray(ms_tensor, tensor_name,
+                                                                 self.__convert_dtype(tensor_name))
+
+    def __convert_tensor(self, tensor_name: str, ms_tensor) -> np.ndarray:
+        """convert ms tensor to ndarray, then transpose and encode it as its ggml type"""
+        with self.instrumentation.tensor(tensor_name, "convert", self.tensor_nbytes[tensor_name]):
+            ndarray_tensor = self.__convert_ms_tensor(tensor_name, ms_tensor)
+            return quantize(ndarray_tensor, self.tensor_types[tensor_name],
+                            self.ms_helper.transpose_axes(tensor_name))
+
+    def __write_tensor_data(self, tensor_name: str, ndarray_tensor: np.ndarray,
+                            gguf_writer: Optional[GGUFWriter] = None):
+        with self.instrumentation.tensor(tensor_name, "write", ndarray_tensor.nbytes):
+            (gguf_writer or self.gguf_writer).write_tensor_data(ndarray_tensor)
+
+    def __start_progress(self, tensor_names):
+        self.instrumentation.start_progress(len(tensor_names),
+                                            sum(self.tensor_nbytes[tensor_name] for tensor_name in tensor_names))
 
     def __write_tensors(self):
+        self.__start_progress(self.ms_helper.ckpt_dict)
+        for tensor_name in self.ms_helper.ckpt_dict:
+            shape = self.ms_helper.tensor_shape(tensor_name)
+            ndarray_tensor = self.__convert_tensor(tensor_name, self.ms_helper.ckpt_dict[tensor_name])
+            # tensors are kept by gguf writer, they are written when tearing down
+            logging.info("ndarray tensor type: %s", ndarray_tensor.dtype)
+            with self.instrumentation.tensor(tensor_name, "write", ndarray_tensor.nbytes):
+                self.gguf_writer.add_tensor(tensor_name, ndarray_tensor, raw_shape=shape,
+                                            raw_dtype=self.tensor_types[tensor_name])
+
+    def __write_tensors_info(self):
+        """add every tensor info by its shape only, offsets are computed by gguf writer"""
+        for tensor_name in self.ms_helper.ckpt_dict:
+            shape = self.ms_helper.tensor_shape(tensor_name)
+            tensor_type = self.tensor_types[tensor_name]
+            gguf_writer = self.shard_writers[self.tensor_shards[tensor_name]] if self.shard_writers \
+                else self.gguf_writer
+            self.tensor_offsets[tensor_name] = gguf_writer.offset_tensor
+            gguf_writer.add_tensor_info(tensor_name, shape, np.dtype(np.float32),
+                                        quantized_nbytes(shape, tensor_type), raw_dtype=tensor_type)
+
+    def __stream_tensors(self):
+        """write header and tensors info, then convert, write and free tensors one by one"""
+        self.gguf_writer.write_header_to_file()
+        self.gguf_writer.write_kv_data_to_file()
+        self.gguf_writer.write_ti_data_to_file()
+        self.__start_progress(self.ms_helper.ckpt_dict)
+        for tensor_name, ndarray_tensor in self.__converted_tensors(list(self.ms_helper.ckpt_dict)):
+            self.__write_tensor_data(tensor_name, ndarray_tensor)
+            del ndarray_tensor
+        self.gguf_writer.flush()
+        self.gguf_writer.close()
+
+    def __stream_tensors_sharded(self):
+        """shards are independent files, every one is written by a thread of its own"""
+        shard_tensor_names: List[List[str]] = [[] for _ in self.shard_writers]
         for tensor_name in self.ms_helper.ckpt_dict:
-            # convert ms tensor to ndarray
-            ndarray_tensor = MsCkptRefactorHelper.convert_ms_tensor_to_ndarray(
-                self.ms_helper.ckpt_dict[tensor_name], tensor_name)
-            # write
-            logging.info("ndarray tensor type: {0}", ndarray_tensor.dtype)
-            self.gguf_writer.add_tensor(tensor_name, ndarray_tensor, raw_dtype=GGMLQuantizationType.F32)
+            shard_tensor_names[self.tensor_shards[tensor_name]].append(tensor_name)
+        self.__start_progress(self.ms_helper.ckpt_dict)
+        n_threads = self.shard_workers or min(len(self.shard_writers), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="gguf-shard") as executor:
+            futures = [executor.submit(self.__write_shard, gguf_writer, tensor_names)
+                       for gguf_writer, tensor_names in zip(self.shard_writers, shard_tensor_names)]
+            for future in futures:
+                future.result()
+
+    def __write_shard(self, gguf_writer: GGUFWriter, tensor_names: List[str]):
+        with self.instrumentation.stage("write_shard", path=gguf_writer.fout.name, tensors=len(tensor_names)):
+            gguf_writer.write_header_to_file()
+            gguf_writer.write_kv_data_to_file()
+            gguf_writer.write_ti_data_to_file()
+            for tensor_name, ndarray_tensor in self.__converted_tensors(tensor_names):
+                self.__write_tensor_data(tensor_name, ndarray_tensor, gguf_writer)
+                del ndarray_tensor
+            gguf_writer.flush()
+            gguf_writer.close()
+
+    def __stream_tensors_pipelined(self):
+        """write header and tensors info, then tensors are written at their offsets by the pipeline"""
+        header_size = len(gguf_header_bytes(self.gguf_writer))
+        self.gguf_writer.write_header_to_file()
+        self.gguf_writer.write_kv_data_to_file()
+        self.gguf_writer.write_ti_data_to_file()
+        self.gguf_writer.flush()
+        self.__start_progress(self.ms_helper.ckpt_dict)
+        run_pipeline(self.gguf_writer.fout.fileno(), self.__pipeline_tasks(header_size), self.__convert_tensor_into,
+                     file_size=header_size + self.gguf_writer.offset_tensor, instrumentation=self.instrumentation)
+        self.gguf_writer.close()
+
+    def __pipeline_tasks(self, header_size: int) -> Iterator[PipelineTask]:
+        for tensor_name in list(self.ms_helper.ckpt_dict):
+            shape = self.ms_helper.tensor_shape(tensor_name)
+            yield PipelineTask(tensor_name, self.ms_helper.ckpt_dict.pop(tensor_name),
+                               header_size + self.tensor_offsets[tensor_name], self.tensor_nbytes[tensor_name])
+
+    def __convert_tensor_into(self, task: PipelineTask, ms_tensor, buffer: np.ndarray) -> np.ndarray:
+        """the precision of ckpt is kept, tensors are cast while they are encoded into the buffer"""
+        axes = self.ms_helper.transpose_axes(task.name)
+        tensor_type = self.tensor_types[task.name]
+        dtype, shape = encoded_layout(permuted_shape(ms_tensor.shape, axes), tensor_type)
+        with self.instrumentation.tensor(task.name, "convert", task.nbytes):
+            ndarray_tensor = MsCkptRefactorHelper.convert_ms_tensor_to_ndarray(ms_tensor, task.name, None)
+            return quantize(ndarray_tensor, tensor_type, axes, out=buffer.view(dtype).reshape(shape))
+
+    def __converted_tensors(self, tensor_names) -> Iterator[Tuple[str, np.ndarray]]:
+        """
+        convert tensors in order, the ms tensors are popped, so that they are freed as soon as they are converted.
+        :param tensor_names: names of tensors to convert, in tensor info order
+        :return: iterator of (tensor name, encoded ndarray)
+        """
+        if self.workers > 0:
+            yield from self.__converted_tensors_parallel(tensor_names)
+            return
+        for tensor_name in tensor_names:
+            ms_tensor = self.ms_helper.ckpt_dict.pop(tensor_name)
+            ndarray_tensor = self.__convert_tensor(tensor_name, ms_tensor)
+            del ms_tensor
+            yield tensor_name, ndarray_tensor
+
+    def __converted_tensors_parallel(self, tensor_names) -> Iterator[Tuple[str, np.ndarray]]:
+        """
+        tensors are converted and encoded by a process pool, results are yielded in order.
+        workers map the ckpt and read tensors by their offsets, only the encoded result is sent back.
+        float tensors which are not transposed are only cast, they are converted here, a worker would add two
+        copies through pipes. at most max_in_flight tensors are pending, so memory stays bounded.
+        """
+        # spawn, forking a process which has started MindSpore runtime threads is not safe
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            pending = deque()
+            for tensor_name in tensor_names:
+                ms_tensor = self.ms_helper.ckpt_dict.pop(tensor_name)
+                tensor_type = self.tensor_types[tensor_name]
+                axes = self.ms_helper.transpose_axes(tensor_name)
+                if tensor_type in FLOAT_TYPE_NP_DICT and axes is None:
+                    future = Future()
+                    future.set_result(self.__convert_tensor(tensor_name, ms_tensor))
+                else:
+                    future = executor.submit(_convert_in_worker, self.ckpt_file_path,
+                                             self.ms_helper.ckpt_infos[tensor_name],
+                                             self.__convert_dtype(tensor_name), tensor_type, axes)
+                del ms_tensor
+                pending.append((tensor_name, future))
+                del future
+                if len(pending) >= self.max_in_flight:
+                    name, future = pending.popleft()
+                    yield name, future.result()
+            while pending:
+                name, future = pending.popleft()
+                yield name, future.result()
+
+    def __tensor_records(self, header_size: int) -> Dict[str, TensorRecord]:
+        """hash every ckpt tensor and the way it is encoded"""
+        records = {}
+        for tensor_name, ms_tensor in self.ms_helper.ckpt_dict.items():
+            shape = self.ms_helper.tensor_shape(tensor_name)
+            tensor_type = self.tensor_types[tensor_name]
+            records[tensor_name] = TensorRecord(
+                tensor_digest(ms_tensor),
+                tensor_recipe(ms_tensor, tensor_type, self.ms_helper.transpose_axes(tensor_name)),
+                header_size + self.tensor_offsets[tensor_name], quantized_nbytes(shape, tensor_type))
+        return records
+
+    def __stream_tensors_incremental(self):
+        """
+        compare tensors with the manifest of last run, only the changed tensors are converted.
+        when the header is the same, every tensor keeps its offset and the output is patched in place,
+        else a new file is written, unchanged tensors are copied from the last output.
+        """
+        header = gguf_header_bytes(self.gguf_writer)
+        with self.instrumentation.stage("hash_tensors"):
+            records = self.__tensor_records(len(header))
+        manifest = ConversionManifest.load(self.output_path)
+        changed = [tensor_name for tensor_name, record in records.items()
+                   if manifest is None or record.nbytes == 0 or not manifest.unchanged(tensor_name, record)]
+        logging.info("%d of %d tensors changed since the last conversion", len(changed), len(records))
+        new_manifest = ConversionManifest(self.output_path, header_hash(header), records)
+        if manifest is not None and manifest.header_hash == new_manifest.header_hash:
+            self.__start_progress(changed)
+            self.__patch_tensors(records, changed)
+        else:
+            self.__start_progress(self.ms_helper.ckpt_dict)
+            self.__rewrite_tensors(manifest, changed)
+        new_manifest.save()
+
+    def __patch_tensors(self, records: Dict[str, TensorRecord], changed):
+        """write the changed tensors at their offsets of the output"""
+        self.gguf_writer.close()
+        os.remove(self.output_path + PARTIAL_SUFFIX)
+        # the manifest is stale once the output is touched, drop it first in case the patch is interrupted
+        os.remove(ConversionManifest.manifest_path(self.output_path))
+        fd = os.open(self.output_path, os.O_WRONLY)
+        try:
+            for tensor_name, ndarray_tensor in self.__converted_tensors(changed):
+                with self.instrumentation.tensor(tensor_name, "write", ndarray_tensor.nbytes):
+                    pwrite_all(fd, ndarray_tensor, records[tensor_name].offset)
+                del ndarray_tensor
+        finally:
+            os.close(fd)
+
+    def __rewrite_tensors(self, manifest: Optional[ConversionManifest], changed):
+        """write a new file, tensors unchanged since the last run are copied from the last output"""
+        partial_path = self.output_path + PARTIAL_SUFFIX
+        self.gguf_writer.write_header_to_file()
+        self.gguf_writer.write_kv_data_to_file()
+        self.gguf_writer.write_ti_data_to_file()
+        converted_tensors = self.__converted_tensors(changed)
+        changed = set(changed)
+        for tensor_name in list(self.ms_helper.ckpt_dict):
+            if tensor_name in changed:
+                _, ndarray_tensor = next(converted_tensors)
+            else:
+                self.ms_helper.ckpt_dict.pop(tensor_name)
+                record = manifest.tensors[tensor_name]
+                ndarray_tensor = np.memmap(self.output_path, dtype=np.uint8, mode="r", offset=record.offset,
+                                           shape=(record.nbytes,))
+            self.__write_tensor_data(tensor_name, ndarray_tensor)
+            del ndarray_tensor
+        converted_tensors.close()
+        self.gguf_writer.flush()
+        self.gguf_writer.close()
+        os.replace(partial_path, self.output_path)
 
     def __tear_down(self):
         self.gguf_writer.write_header_to_file()
@@ -81,17 +517,148 @@ class Writer:
         self.gguf_writer.write_tensors_to_file()
         self.gguf_writer.close()
 
+    def __mode(self) -> str:
+        if self.incremental:
+            return MODE_INCREMENTAL
+        if self.max_shard_bytes is not None:
+            return MODE_SHARDED
+        if self.pipeline:
+            return MODE_PIPELINE
+        if not self.streaming:
+            return MODE_IN_MEMORY
+        return MODE_WORKERS if self.workers > 0 else MODE_STREAMING
+
+    def __layout_plan(self) -> LayoutPlan:
+        gguf_writers = self.shard_writers or [self.gguf_writer]
+        header_sizes = [len(gguf_header_bytes(gguf_writer)) for gguf_writer in gguf_writers]
+        files = [FilePlan(path, header_size, gguf_writer.offset_tensor, gguf_writer.ti_data_count)
+                 for path, header_size, gguf_writer in zip(self.shard_paths or [self.output_path], header_sizes,
+                                                           gguf_writers)]
+        tensors = []
+        for tensor_name, ms_tensor in self.ms_helper.ckpt_dict.items():
+            file_index = self.tensor_shards.get(tensor_name, 0)
+            tensors.append(TensorPlan(tensor_name, ms_tensor.dtype, self.ms_helper.tensor_shape(tensor_name),
+                                      self.tensor_types[tensor_name],
+                                      self.ms_helper.transpose_axes(tensor_name) is not None, file_index,
+                                      header_sizes[file_index] + self.tensor_offsets[tensor_name],
+                                      self.tensor_nbytes[tensor_name], ms_tensor.nbytes, len(ms_tensor.chunks) > 1))
+        rss_kb = current_rss_kb()
+        return LayoutPlan(self.__mode(), files, tensors, gguf_writers[0].data_alignment,
+                          os.path.getsize(self.ckpt_file_path), rss_kb * 1024 if rss_kb else 0,
+                          workers=self.workers, max_in_flight=self.max_in_flight,
+                          shard_workers=self.shard_workers or min(len(files), os.cpu_count() or 1))
+
+    def plan(self) -> LayoutPlan:
+        """
+        dry run of write, offsets and sizes of the output and the memory of the chosen options are computed
+        from ckpt shapes and dtypes, no tensor data is read and nothing is written.
+        :return:
+        """
+        self.__dry_run = True
+        with self.instrumentation.stage("Writer.plan", output=self.output_path):
+            self.__set_up()
+            try:
+                self.__resolve_tensor_types()
+                if self.max_shard_bytes is not None:
+                    self.__plan_shards()
+                self.__write_metadata()
+                self.__write_tensors_info()
+                layout_plan = self.__layout_plan()
+                for gguf_writer in self.shard_writers or [self.gguf_writer]:
+                    gguf_writer.close()
+                return layout_plan
+            finally:
+                self.__dry_run = False
+                self.ms_helper.close()
+
     def write(self):
-        self.__set_up()
-        self.__write_metadata()
-        self.__write_tensors()
-        self.__tear_down()
+        with self.instrumentation.stage("Writer.write", output=self.output_path):
+            with self.instrumentation.stage("set_up"):
+                self.__set_up()
+            try:
+                with self.instrumentation.stage("resolve_tensor_types"):
+                    self.__resolve_tensor_types()
+                if self.max_shard_bytes is not None:
+                    with self.instrumentation.stage("plan_shards"):
+                        self.__plan_shards()
+                with self.instrumentation.stage("write_metadata"):
+                    self.__write_metadata()
+                if self.streaming:
+                    with self.instrumentation.stage("write_tensors_info"):
+                        self.__write_tensors_info()
+                with self.instrumentation.stage("write_tensors"):
+                    if self.incremental:
+                        self.__stream_tensors_incremental()
+                    elif self.shard_writers:
+                        self.__stream_tensors_sharded()
+                    elif self.pipeline:
+                        self.__stream_tensors_pipelined()
+                    elif self.streaming:
+                        self.__stream_tensors()
+                    else:
+                        self.__write_tensors()
+                        self.__tear_down()
+            finally:
+                self.ms_helper.close()
 
 
 if __name__ == '__main__':
-    writer = Writer(metadata_json_path="llama2/configs/llama2-7b-gguf-metadata.json",
-                    layer_name_map_json_path="llama2/configs/llama2_layer_name_map.json",
-                    ckpt_file_path="llama2/llama2_7b.ckpt",
-                    arch="llama",
-                    need_transpose=False)
-    writer.write()
+    parser = argparse.ArgumentParser(description="convert MindSpore ckpt to gguf")
+    parser.add_argument("--metadata", default="llama2/configs/llama2-7b-gguf-metadata.json",
+                        help="metadata json file path")
+    parser.add_argument("--name-map", default="llama2/configs/llama2_layer_name_map.json",
+                        help="layer name map json file path")
+    parser.add_argument("--ckpt", default="llama2/llama2_7b.ckpt", help="MindSpore ckpt file path")
+    parser.add_argument("--arch", default="llama", help="model arch")
+    parser.add_argument("--transpose", action="store_true", help="whether you need transpose")
+    parser.add_argument("--transpose-map", default=None, help="transpose json file path")
+    parser.add_argument("--quantize-policy", default=None, help="quantize policy json file path")
+    parser.add_argument("--workers", type=int, default=0, help="number of worker processes")
+    parser.add_argument("--float-type", default=AUTO_TYPE_NAME, choices=[AUTO_TYPE_NAME, "F32", "F16"],
+                        help="float type of tensors which are not quantized")
+    parser.add_argument("--output", default="example.gguf", help="output gguf file path")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="overlap reading, converting and writing tensors")
+    parser.add_argument("--progress", action="store_true", help="log progress and eta after every tensor")
+    parser.add_argument("--profile", default=None, help="save stage and tensor timings to this json file path")
+    parser.add_argument("--trace", default=None, help="save a Chrome trace to this json file path")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only convert the tensors changed since the last conversion of the output")
+    parser.add_argument("--split-max-size", type=parse_size, default=None,
+                        help="split the output into shards of at most this size, such as 4G or 500M")
+    parser.add_argument("--shard-workers", type=int, default=None, help="number of shards written at the same time")
+    parser.add_argument("--plan", default=None,
+                        help="save the output layout, sizes and memory estimate to this json file path instead of "
+                             "converting")
+    args = parser.parse_args()
+    recorder = None
+    if args.progress or args.profile or args.trace:
+        recorder = Recorder(log_progress if args.progress else None)
+    if args.progress:
+        logging.basicConfig(level=logging.INFO)
+    writer = Writer(metadata_json_path=args.metadata,
+                    layer_name_map_json_path=args.name_map,
+                    ckpt_file_path=args.ckpt,
+                    arch=args.arch,
+                    need_transpose=args.transpose,
+                    quantize_policy_json_path=args.quantize_policy,
+                    workers=args.workers,
+                    float_type=args.float_type,
+                    transpose_map_json_path=args.transpose_map,
+                    output_path=args.output,
+                    incremental=args.incremental,
+                    pipeline=args.pipeline,
+                    instrumentation=recorder,
+                    max_shard_bytes=args.split_max_size,
+                    shard_workers=args.shard_workers)
+    if args.plan:
+        layout_plan = writer.plan()
+        with open(args.plan, "w", encoding="utf-8") as f:
+            json.dump(layout_plan.to_dict(), f, indent=2)
+        print(json.dumps(layout_plan.to_dict(with_tensors=False)))
+    else:
+        writer.write()
+    if args.profile:
+        recorder.save_json(args.profile)
+    if args.trace:
+        recorder.save_chrome_trace(args.trace)
@@ -1,20 +1,47 @@
+import argparse
 import json
 import logging
+from typing import List, Optional
 
 from constant import GGUFMetadataValueType
+from gguf_index_cache import GGUFIndexCache
+from gguf_typed_metadata import INLINE_ARRAY_MAX_LENGTH, from_metadata_kv, save_typed_metadata
 from read_gguf import GGUFLoader
 
 
 class MetadataDumpHelper:
-    def __init__(self, origin_gguf_file_path: str, metadata_json_output_path: str):
+    def __init__(self, origin_gguf_file_path: str, metadata_json_output_path: str,
+                 index_cache_dir: Optional[str] = None, include_keys: Optional[List[str]] = None,
+                 exclude_keys: Optional[List[str]] = None, typed: bool = False,
+                 inline_max_length: int = INLINE_ARRAY_MAX_LENGTH):
+        """
+        :param origin_gguf_file_path: reference gguf file path
+        :param metadata_json_output_path: metadata json output path
+        :param index_cache_dir: optional folder of gguf header index cache, default None means no cache
+        :param include_keys: fnmatch patterns of keys to dump, such as ["llama.*"], default None means every key
+        :param exclude_keys: fnmatch patterns of keys not to dump, such as ["tokenizer.ggml.*"]
+            other keys are skipped without decoding when include_keys or exclude_keys is given
+        :param typed: whether to keep the type of every key, default False means a plain json object of key to value
+            which keeps only u32, f32, str, bool and array values
+        :param inline_max_length: numeric arrays longer than it are saved to an npz file next to the typed json,
+            -1 keeps all of them in json
+        """
         self.origin_gguf_file_path = origin_gguf_file_path
         self.metadata_json_output_path = metadata_json_output_path
+        self.index_cache = GGUFIndexCache(index_cache_dir) if index_cache_dir else None
+        self.include_keys = include_keys
+        self.exclude_keys = exclude_keys
+        self.typed = typed
+        self.inline_max_length = inline_max_length
         self.gguf_loader: GGUFLoader
         self.meta_data_dict: dict = {}
 
     def __set_up(self):
-        self.gguf_loader = GGUFLoader(self.origin_gguf_file_path)
-        self.gguf_loader.load_and_print()
+        self.gguf_loader = GGUFLoader(self.origin_gguf_file_path, index_cache=self.index_cache)
+        if self.include_keys or self.exclude_keys:
+            self.gguf_loader.load_metadata(self.include_keys, self.exclude_keys)
+        else:
+            self.gguf_loader.load_and_print()
 
     def __get_metadata_dict(self):
         for metadata in self.gguf_loader.metadata:
@@ -30,17 +57,37 @@ class MetadataDumpHelper:
             elif metadata.value_type == GGUFMetadataValueType.BOOL:
                 self.meta_data_dict[metadata.key.string] = bool(metadata.value)
             else:
-                logging.error("unsupport data type {0}", metadata.value_type)
+                logging.error("unsupport data type %s", metadata.value_type)
         with open(self.metadata_json_output_path, "w+", encoding="utf-8") as f:
             json.dump(self.meta_data_dict, f, ensure_ascii=False)
 
+    def __dump_typed_metadata(self):
+        typed_metadata = {metadata.key.string: from_metadata_kv(metadata) for metadata in self.gguf_loader.metadata}
+        save_typed_metadata(typed_metadata, self.metadata_json_output_path, self.inline_max_length)
+
     def dump_json_file(self):
         self.__set_up()
-        self.__get_metadata_dict()
+        if self.typed:
+            self.__dump_typed_metadata()
+        else:
+            self.__get_metadata_dict()
 
 
 if __name__ == "__main__":
-    # example
-    metadata_json_dump_helper = MetadataDumpHelper("llama2/llama-2-7b.Q2_K.gguf",
-                                                   "llama2/configs/llama2-7b-gguf-metadata.json")
+    parser = argparse.ArgumentParser(description="dump gguf metadata to json")
+    parser.add_argument("--gguf", default="llama2/llama-2-7b.Q2_K.gguf", help="reference gguf file path")
+    parser.add_argument("--output", default="llama2/configs/llama2-7b-gguf-metadata.json",
+                        help="metadata json output path")
+    parser.add_argument("--include", action="append", default=None,
+                        help="fnmatch pattern of keys to dump, such as llama.*, can be repeated")
+    parser.add_argument("--exclude", action="append", default=None,
+                        help="fnmatch pattern of keys not to dump, such as tokenizer.ggml.*, can be repeated")
+    parser.add_argument("--typed", action="store_true",
+                        help="keep the type of every key, long numeric arrays go to an npz file of the same name")
+    parser.add_argument("--inline-max-length", type=int, default=INLINE_ARRAY_MAX_LENGTH,
+                        help="numeric arrays up to this length stay in the typed json, -1 keeps all of them")
+    args = parser.parse_args()
+    metadata_json_dump_helper = MetadataDumpHelper(args.gguf, args.output, include_keys=args.include,
+                                                   exclude_keys=args.exclude, typed=args.typed,
+                                                   inline_max_length=args.inline_max_length)
     metadata_json_dump_helper.dump_json_file()
@@ -0,0 +1,227 @@
+"""
+Overlapped read, convert and write of tensors. A reader thread copies ckpt tensors from the mapping into reusable
+buffers, the caller thread converts them into reusable output buffers, a writer thread writes them at their
+offsets in large aligned chunks. numpy releases the GIL while copying and encoding, so disk reads, conversion
+and disk writes run at the same time.
+"""
+import logging
+import os
+import queue
+import threading
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+
+from constant import GGUFException
+from instrumentation import NULL_INSTRUMENTATION, Instrumentation
+from models.ckpt_reader import CkptTensor
+
+# tensors buffered between two stages, two means double buffering
+DEFAULT_PIPELINE_DEPTH = 2
+# bytes of one write call, writes start at multiples of it in file
+DEFAULT_WRITE_CHUNK_BYTES = 8 << 20
+# bytes copied at a time by the reader thread
+_READ_CHUNK_BYTES = 8 << 20
+# interval of checking whether another stage failed while waiting on a queue
+_POLL_SECONDS = 0.1
+
+
+class PipelineTask(NamedTuple):
+    name: str
+    tensor: CkptTensor
+    # absolute offset of tensor data in output file
+    offset: int
+    # bytes of the encoded tensor
+    nbytes: int
+
+
+class BufferPool:
+    def __init__(self, n_buffers: int):
+        """
+        fixed number of byte buffers, a buffer grows when a larger tensor needs it and is reused afterwards,
+        acquiring blocks until a buffer is released, which is the back pressure between stages.
+        :param n_buffers: number of buffers
+        """
+        self._free: "queue.Queue[np.ndarray]" = queue.Queue()
+        for _ in range(n_buffers):
+            self._free.put(np.empty(0, dtype=np.uint8))
+
+    def acquire(self, nbytes: int, stop: threading.Event) -> np.ndarray:
+        """
+        :param nbytes: bytes needed
+        :param stop: acquiring gives up when it is set
+        :return: uint8 buffer of at least nbytes
+        """
+        buffer = _get(self._free, stop)
+        if buffer.nbytes < nbytes:
+            buffer = np.empty(nbytes, dtype=np.uint8)
+        return buffer
+
+    def release(self, buffer: np.ndarray):
+        self._free.put(buffer)
+
+
+class _Stopped(Exception):
+    """another stage failed, this stage gives up"""
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while True:
+        try:
+            return q.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            if stop.is_set():
+                raise _Stopped()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event):
+    while True:
+        try:
+            q.put(item, timeout=_POLL_SECONDS)
+            return
+        except queue.Full:
+            if stop.is_set():
+                raise _Stopped()
+
+
+def preallocate(fd: int, size: int):
+    """reserve the output size up front, so the file system can lay it out contiguously, holes read as zeros"""
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            logging.info("posix_fallocate is not supported here (%s), fall back to ftruncate", e)
+    os.ftruncate(fd, size)
+
+
+def write_chunks(fd: int, data: np.ndarray, offset: int, chunk_bytes: int = DEFAULT_WRITE_CHUNK_BYTES):
+    """write a C contiguous ndarray at offset, split at multiples of chunk_bytes in file"""
+    view = memoryview(data.reshape(-1).view(np.uint8))
+    while view:
+        length = min(len(view), chunk_bytes - offset % chunk_bytes)
+        n_written = os.pwrite(fd, view[:length], offset)
+        view = view[n_written:]
+        offset += n_written
+
+
+class TensorPipeline:
+    def __init__(self, fd: int, convert: Callable[[PipelineTask, CkptTensor, np.ndarray], np.ndarray],
+                 depth: int = DEFAULT_PIPELINE_DEPTH, write_chunk_bytes: int = DEFAULT_WRITE_CHUNK_BYTES,
+                 instrumentation: Optional[Instrumentation] = None):
+        """
+        :param fd: output file descriptor, opened for writing
+        :param convert: convert(task, tensor read into memory, output buffer of task.nbytes bytes) returns the
+            encoded ndarray, it is called by the caller thread and should write into the output buffer
+        :param depth: tensors buffered between two stages, memory is about 2 * depth times the largest tensor
+        :param write_chunk_bytes: bytes of one write call
+        :param instrumentation: receiver of read and write events of tensors, default None
+        """
+        if depth < 1:
+            raise ValueError("depth should be at least 1, got {0}".format(depth))
+        self.fd = fd
+        self.convert = convert
+        self.depth = depth
+        self.write_chunk_bytes = write_chunk_bytes
+        self._read_pool = BufferPool(depth)
+        self._write_pool = BufferPool(depth)
+        self._read_queue: queue.Queue = queue.Queue(maxsize=depth)
+        self._write_queue: queue.Queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+
+    def _fail(self, error: BaseException):
+        if not isinstance(error, _Stopped):
+            self._errors.append(error)
+        self._stop.set()
+
+    def _read(self, tasks: Iterable[PipelineTask]):
+        try:
+            for task in tasks:
+                nbytes = task.tensor.nbytes
+                buffer = self._read_pool.acquire(nbytes, self._stop)
+                target = buffer[:nbytes]
+                with self.instrumentation.tensor(task.name, "read", nbytes):
+                    # slices of a large tensor are copied one after another into the same buffer
+                    cursor = 0
+                    for chunk in task.tensor.chunks:
+                        source = np.frombuffer(chunk, dtype=np.uint8)
+                        for start in range(0, source.nbytes, _READ_CHUNK_BYTES):
+                            np.copyto(target[cursor + start:cursor + start + _READ_CHUNK_BYTES],
+                                      source[start:start + _READ_CHUNK_BYTES])
+                        cursor += source.nbytes
+                        del source
+                tensor = task.tensor._replace(chunks=[memoryview(target)])
+                del target
+                _put(self._read_queue, (task, tensor, buffer), self._stop)
+            _put(self._read_queue, None, self._stop)
+        except BaseException as e:
+            self._fail(e)
+
+    def _write(self):
+        try:
+            while True:
+                item = _get(self._write_queue, self._stop)
+                if item is None:
+                    return
+                name, offset, encoded, buffer = item
+                with self.instrumentation.tensor(name, "write", encoded.nbytes):
+                    write_chunks(self.fd, encoded, offset, self.write_chunk_bytes)
+                del encoded
+                self._write_pool.release(buffer)
+        except BaseException as e:
+            self._fail(e)
+
+    def run(self, tasks: Iterable[PipelineTask]):
+        """
+        convert and write every task, it returns when all tensors are written.
+        :param tasks: tasks in any order, each tensor is written at its own offset
+        :return:
+        """
+        reader = threading.Thread(target=self._read, args=(tasks,), name="gguf-pipeline-reader", daemon=True)
+        writer = threading.Thread(target=self._write, name="gguf-pipeline-writer", daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            while True:
+                item = _get(self._read_queue, self._stop)
+                if item is None:
+                    break
+                task, tensor, read_buffer = item
+                buffer = self._write_pool.acquire(task.nbytes, self._stop)
+                encoded = self.convert(task, tensor, buffer[:task.nbytes])
+                if encoded.nbytes != task.nbytes:
+                    raise GGUFException("tensor {0} should be encoded as {1} bytes, got {2}".format(
+                        task.name, task.nbytes, encoded.nbytes))
+                del tensor
+                self._read_pool.release(read_buffer)
+                _put(self._write_queue, (task.name, task.offset, encoded, buffer), self._stop)
+                del encoded
+            _put(self._write_queue, None, self._stop)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            writer.join()
+            reader.join()
+        if self._errors:
+            raise self._errors[0]
+
+
+def run_pipeline(fd: int, tasks: Iterable[PipelineTask],
+                 convert: Callable[[PipelineTask, CkptTensor, np.ndarray], np.ndarray], file_size: Optional[int] = None,
+                 depth: int = DEFAULT_PIPELINE_DEPTH, write_chunk_bytes: int = DEFAULT_WRITE_CHUNK_BYTES,
+                 instrumentation: Optional[Instrumentation] = None):
+    """
+    :param fd: output file descriptor, opened for writing
+    :param tasks: tensors to convert and write
+    :param convert: see TensorPipeline
+    :param file_size: final output size, the file is preallocated to it when given
+    :param depth: tensors buffered between two stages
+    :param write_chunk_bytes: bytes of one write call
+    :param instrumentation: receiver of read and write events of tensors, default None
+    :return:
+    """
+    if file_size is not None:
+        preallocate(fd, file_size)
+    TensorPipeline(fd, convert, depth, write_chunk_bytes, instrumentation).run(tasks)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Pre-flight check of a ckpt against the reference gguf before converting. Tensor names, shapes and orientation are
+reconciled from the gguf header and the ckpt framing, weights are not loaded, only a few rows are sampled when
+the shape alone can not tell the orientation, such as square matrices.
+"""
+import argparse
+import itertools
+import json
+import logging
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from constant import GGUFException
+from gguf_index_cache import GGUFIndexCache
+from models.ckpt_convert_util import LayerNameMapper, bf16_to_float32
+from models.ckpt_reader import BFLOAT16_TYPE_NAME, CkptTensor, MsCkptReader
+from models.transpose_util import TransposePolicy, permuted_shape
+from read_gguf import GGUFLoader
+
+STATUS_IDENTICAL = "identical"
+STATUS_TRANSPOSED = "transposed"
+STATUS_MISMATCHED = "mismatched"
+# ckpt tensor whose renamed name is not in the reference gguf
+STATUS_UNMAPPED = "unmapped"
+# reference gguf tensor which no ckpt tensor is renamed to
+STATUS_MISSING = "missing"
+
+# how the orientation is decided
+EVIDENCE_SHAPE = "shape"
+EVIDENCE_VALUES = "values"
+# several orientations fit the shape and sampled values do not tell, the tensor is kept as it is
+EVIDENCE_AMBIGUOUS = "ambiguous"
+
+DEFAULT_SAMPLE_ROWS = 4
+# sampled values of the chosen orientation should correlate at least this much with the reference
+MIN_CORRELATION = 0.5
+# permutations are searched for tensors of at most this number of dimensions
+_MAX_PERMUTATION_DIMS = 4
+
+
+class PreflightEntry:
+    def __init__(self, status: str, gguf_name: Optional[str] = None, ms_name: Optional[str] = None,
+                 ckpt_shape: Optional[Tuple[int, ...]] = None, gguf_shape: Optional[Tuple[int, ...]] = None,
+                 axes: Optional[Tuple[int, ...]] = None, evidence: Optional[str] = None,
+                 correlation: Optional[float] = None):
+        """
+        :param status: identical, transposed, mismatched, unmapped or missing
+        :param gguf_name: gguf tensor name
+        :param ms_name: ms ckpt tensor name
+        :param ckpt_shape: shape in ckpt
+        :param gguf_shape: numpy shape in reference gguf
+        :param axes: permutation making ckpt shape the gguf shape, only for transposed
+        :param evidence: shape, values or ambiguous
+        :param correlation: correlation of sampled values of the chosen orientation
+        """
+        self.status = status
+        self.gguf_name = gguf_name
+        self.ms_name = ms_name
+        self.ckpt_shape = ckpt_shape
+        self.gguf_shape = gguf_shape
+        self.axes = axes
+        self.evidence = evidence
+        self.correlation = correlation
+
+    def to_dict(self) -> dict:
+        return {key: list(value) if isinstance(value, tuple) else value for key, value in vars(self).items()
+                if value is not None}
+
+
+class PreflightReport:
+    def __init__(self, reference_gguf_path: str, ckpt_path: str, entries: List[PreflightEntry]):
+        self.reference_gguf_path = reference_gguf_path
+        self.ckpt_path = ckpt_path
+        self.entries = entries
+
+    @property
+    def transpose_plan(self) -> Dict[str, Tuple[int, ...]]:
+        """gguf name to axes permutation of every transposed tensor"""
+        return {entry.gguf_name: entry.axes for entry in self.entries if entry.status == STATUS_TRANSPOSED}
+
+    @property
+    def ok(self) -> bool:
+        """every reference tensor is provided by the ckpt with a compatible shape"""
+        return all(entry.status not in (STATUS_MISMATCHED, STATUS_MISSING) for entry in self.entries)
+
+    def summary(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for entry in self.entries:
+            counts[entry.status] = counts.get(entry.status, 0) + 1
+        ambiguous = sum(1 for entry in self.entries if entry.evidence == EVIDENCE_AMBIGUOUS)
+        if ambiguous:
+            counts[EVIDENCE_AMBIGUOUS] = ambiguous
+        return counts
+
+    def to_dict(self) -> dict:
+        return {"reference": self.reference_gguf_path, "ckpt": self.ckpt_path, "ok": self.ok,
+                "summary": self.summary(), "tensors": [entry.to_dict() for entry in self.entries]}
+
+    def transpose_policy(self) -> TransposePolicy:
+        """policy for MsCkptRefactorHelper, the ambiguous tensors are not transposed"""
+        return TransposePolicy(self.transpose_rules())
+
+    def transpose_rules(self) -> List[dict]:
+        # every other tensor matches an identity rule, so a need_transpose default never changes the plan
+        return [{"name": entry.gguf_name, "axes": list(entry.axes or range(len(entry.ckpt_shape)))}
+                for entry in self.entries if entry.status in (STATUS_IDENTICAL, STATUS_TRANSPOSED)]
+
+    def save_transpose_map(self, transpose_json_path: str):
+        """save the plan as a transpose json, which is passed to Writer as transpose_map_json_path"""
+        with open(transpose_json_path, "w", encoding="utf-8") as f:
+            json.dump({"rules": self.transpose_rules()}, f, indent=2)
+
+
+def _candidate_axes(ckpt_shape: Sequence[int], gguf_shape: Sequence[int]) -> List[Tuple[int, ...]]:
+    """permutations making ckpt shape the gguf shape, identity first"""
+    if len(ckpt_shape) != len(gguf_shape):
+        return []
+    identity = tuple(range(len(ckpt_shape)))
+    if len(ckpt_shape) > _MAX_PERMUTATION_DIMS:
+        return [identity] if tuple(ckpt_shape) == tuple(gguf_shape) else []
+    return [axes for axes in itertools.permutations(identity)
+            if permuted_shape(ckpt_shape, axes) == tuple(gguf_shape)]
+
+
+def _sample_row_indices(n_rows: int, sample_rows: int) -> List[int]:
+    return sorted(set(np.linspace(0, n_rows - 1, num=min(sample_rows, n_rows)).astype(int).tolist()))
+
+
+def _ckpt_rows(tensor: CkptTensor, axes: Tuple[int, ...], rows: List[int]) -> np.ndarray:
+    """float32 values of some rows of the permuted ckpt tensor, only these values are read from the mapped slices"""
+    shape = permuted_shape(tensor.shape, axes)
+    # coordinates of the sampled values in the permuted tensor, then their flat indices in the ckpt layout
+    coordinates = np.empty((len(shape), len(rows), shape[-1]), dtype=np.int64)
+    coordinates[:-1] = np.array(np.unravel_index(rows, shape[:-1]), dtype=np.int64).reshape(-1, len(rows), 1)
+    coordinates[-1] = np.arange(shape[-1])
+    ckpt_coordinates = [None] * len(axes)
+    for permuted_axis, axis in enumerate(axes):
+        ckpt_coordinates[axis] = coordinates[permuted_axis]
+    values = tensor.take(np.ravel_multi_index(ckpt_coordinates, tensor.shape))
+    if tensor.dtype == BFLOAT16_TYPE_NAME:
+        return bf16_to_float32(values)
+    return values.astype(np.float32)
+
+
+def _correlation(a: np.ndarray, b: np.ndarray) -> Optional[float]:
+    a = a.reshape(-1).astype(np.float64)
+    b = b.reshape(-1).astype(np.float64)
+    if not (np.isfinite(a).all() and np.isfinite(b).all()) or a.std() == 0 or b.std() == 0:
+        return None
+    return float(np.corrcoef(a, b)[0, 1])
+
+
+def _decide_by_values(loader: GGUFLoader, gguf_name: str, tensor: CkptTensor, candidates: List[Tuple[int, ...]],
+                      sample_rows: int) -> Tuple[Optional[Tuple[int, ...]], Optional[float]]:
+    """
+    compare sampled rows of the reference with every candidate orientation of the ckpt tensor.
+    :return: best axes and its correlation, axes is None if values do not tell
+    """
+    gguf_shape = permuted_shape(tensor.shape, candidates[0])
+    n_rows = int(np.prod(gguf_shape[:-1], dtype=np.int64))
+    rows = _sample_row_indices(n_rows, sample_rows)
+    reference = np.concatenate([loader.dequantized_tensor(gguf_name, row, row + 1) for row in rows])
+    scores = [(_correlation(reference, _ckpt_rows(tensor, axes, rows)), axes) for axes in candidates]
+    scores = [(score, axes) for score, axes in scores if score is not None]
+    if not scores:
+        return None, None
+    scores.sort(key=lambda item: item[0], reverse=True)
+    best_score, best_axes = scores[0]
+    if best_score < MIN_CORRELATION or (len(scores) > 1 and scores[1][0] >= best_score):
+        return None, best_score
+    return best_axes, best_score
+
+
+def _reconcile(loader: GGUFLoader, gguf_name: str, ms_name: str, tensor: CkptTensor,
+               sample_rows: int) -> PreflightEntry:
+    tensor_info = loader.tensor_info(gguf_name)
+    gguf_shape = tuple(int(dim) for dim in reversed(tensor_info.dimensions))
+    entry = PreflightEntry(STATUS_MISMATCHED, gguf_name, ms_name, tuple(tensor.shape), gguf_shape,
+                           evidence=EVIDENCE_SHAPE)
+    candidates = _candidate_axes(tensor.shape, gguf_shape)
+    if not candidates:
+        return entry
+    axes = candidates[0]
+    if len(candidates) > 1:
+        entry.evidence = EVIDENCE_AMBIGUOUS
+        if sample_rows > 0:
+            best_axes, entry.correlation = _decide_by_values(loader, gguf_name, tensor, candidates, sample_rows)
+            if best_axes is not None:
+                axes = best_axes
+                entry.evidence = EVIDENCE_VALUES
+    if axes == tuple(range(len(axes))):
+        entry.status = STATUS_IDENTICAL
+    else:
+        entry.status = STATUS_TRANSPOSED
+        entry.axes = axes
+    return entry
+
+
+def run_preflight(reference_gguf_path: str, ckpt_path: str, name_map_path: str,
+                  sample_rows: int = DEFAULT_SAMPLE_ROWS, index_cache: Optional[GGUFIndexCache] = None
+                  ) -> PreflightReport:
+    """
+    :param reference_gguf_path: reference gguf file path
+    :param ckpt_path: ms ckpt file path
+    :param name_map_path: ms to gguf layer name map path
+    :param sample_rows: rows sampled to decide the orientation of tensors whose shape fits several orientations,
+        0 means never reading values, such tensors are kept as they are
+    :param index_cache: optional index cache of the reference gguf header
+    :return: report, GGUFException if the reference can not be parsed
+    """
+    loader = GGUFLoader(reference_gguf_path, index_cache=index_cache)
+    entries: List[PreflightEntry] = []
+    try:
+        # a reference which can not be parsed raises, it must not pass as a file without tensors
+        loader.load()
+        with MsCkptReader(ckpt_path) as reader:
+            ckpt_infos = reader.tensor_infos
+            name_map = LayerNameMapper.from_json(name_map_path).rename_all(ckpt_infos)
+            gguf_to_ms = {gguf_name: ms_name for ms_name, gguf_name in name_map.items()}
+            for gguf_name in loader.tensor_names():
+                ms_name = gguf_to_ms.get(gguf_name)
+                if ms_name is None:
+                    tensor_info = loader.tensor_info(gguf_name)
+                    entries.append(PreflightEntry(STATUS_MISSING, gguf_name, gguf_shape=tuple(
+                        int(dim) for dim in reversed(tensor_info.dimensions))))
+                    continue
+                entries.append(_reconcile(loader, gguf_name, ms_name, reader.read(ckpt_infos[ms_name]), sample_rows))
+            for ms_name, gguf_name in name_map.items():
+                if gguf_name not in loader:
+                    entries.append(PreflightEntry(STATUS_UNMAPPED, gguf_name, ms_name, ckpt_infos[ms_name].shape))
+    finally:
+        loader.close()
+    for entry in entries:
+        if entry.status in (STATUS_MISMATCHED, STATUS_MISSING) or entry.evidence == EVIDENCE_AMBIGUOUS:
+            logging.warning("%s %s: ckpt %s %s, gguf shape %s", entry.status, entry.gguf_name, entry.ms_name,
+                            entry.ckpt_shape, entry.gguf_shape)
+    return PreflightReport(reference_gguf_path, ckpt_path, entries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="check a MindSpore ckpt against the reference gguf")
+    parser.add_argument("--reference", required=True, help="reference gguf file path")
+    parser.add_argument("--ckpt", required=True, help="MindSpore ckpt file path")
+    parser.add_argument("--name-map", default="llama2/configs/llama2_layer_name_map.json",
+                        help="layer name map json file path")
+    parser.add_argument("--sample-rows", type=int, default=DEFAULT_SAMPLE_ROWS,
+                        help="rows sampled for tensors whose orientation the shape can not tell, 0 disables it")
+    parser.add_argument("--transpose-map", default=None, help="save the transpose plan to this json file path")
+    parser.add_argument("--output", default=None, help="save the report to this json file path")
+    args = parser.parse_args()
+    try:
+        report = run_preflight(args.reference, args.ckpt, args.name_map, args.sample_rows)
+    except GGUFException as e:
+        sys.exit("can not check {0}: {1}".format(args.reference, e))
+    if args.transpose_map:
+        report.save_transpose_map(args.transpose_map)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report.to_dict(), f, indent=2)
+    print(json.dumps(report.summary()))
+    sys.exit(0 if report.ok else 1)
@@ -0,0 +1,409 @@
+"""
+Vectorized numpy quantizers which encode float tensors into ggml block formats
+"""
+import fnmatch
+import json
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from gguf import GGMLQuantizationType
+
+from constant import GGML_TENSOR_QUANTIZE_DICT, GGML_FILE_TYPE_DICT, GGML_QUANT_SIZES_DICT, GGMLType, GGUFException
+from models.transpose_util import blocked_copy, blocked_transpose, is_identity, iter_chunks
+
+FILE_TYPE_KEY = "general.file_type"
+QUANTIZATION_VERSION_KEY = "general.quantization_version"
+GGML_QUANTIZATION_VERSION = 2
+# tensors are quantized in chunks of about this number of elements, so that temporaries stay small
+QUANTIZE_CHUNK_ELEMENTS = 1 << 22
+_GROUP_MAX_EPS = 1e-15
+# type name meaning the float type chosen for the source tensor, see QuantizePolicy.tensor_type
+AUTO_TYPE_NAME = "auto"
+
+
+def _round_half_away(x: np.ndarray) -> np.ndarray:
+    """same as roundf of C, np.round rounds half to even"""
+    abs_x = np.abs(x)
+    floored = np.floor(abs_x)
+    return np.sign(x) * (floored + np.floor(2 * (abs_x - floored)))
+
+
+def _reciprocal(x: np.ndarray) -> np.ndarray:
+    """1 / x, 0 where x is 0"""
+    return np.divide(1.0, x, out=np.zeros_like(x), where=x != 0)
+
+
+def _fp16_bytes(x: np.ndarray) -> np.ndarray:
+    """(n, 1) float32 -> (n, 2) uint8 of float16"""
+    return x.astype(np.float16).view(np.uint8).reshape(-1, 2)
+
+
+def quantize_q8_0(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q8_0: half d, int8 qs[32]
+    :param blocks: (n, 32) float32
+    :return: (n, 34) uint8
+    """
+    d = np.abs(blocks).max(axis=1, keepdims=True) / 127
+    qs = _round_half_away(blocks * _reciprocal(d)).astype(np.int8)
+    return np.concatenate([_fp16_bytes(d), qs.view(np.uint8)], axis=1)
+
+
+def quantize_q4_0(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q4_0: half d, uint8 qs[16], element j and j + 16 share a byte
+    :param blocks: (n, 32) float32
+    :return: (n, 18) uint8
+    """
+    max_index = np.abs(blocks).argmax(axis=1)[:, np.newaxis]
+    d = np.take_along_axis(blocks, max_index, axis=1) / -8
+    q = np.minimum(15, np.trunc(blocks * _reciprocal(d) + 8.5)).astype(np.uint8).reshape(-1, 2, 16)
+    qs = q[:, 0] | (q[:, 1] << 4)
+    return np.concatenate([_fp16_bytes(d), qs], axis=1)
+
+
+def quantize_q4_1(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q4_1: half d, half m, uint8 qs[16]
+    :param blocks: (n, 32) float32
+    :return: (n, 20) uint8
+    """
+    min_ = blocks.min(axis=1, keepdims=True)
+    d = (blocks.max(axis=1, keepdims=True) - min_) / 15
+    q = np.minimum(15, np.trunc((blocks - min_) * _reciprocal(d) + 0.5)).astype(np.uint8).reshape(-1, 2, 16)
+    qs = q[:, 0] | (q[:, 1] << 4)
+    return np.concatenate([_fp16_bytes(d), _fp16_bytes(min_), qs], axis=1)
+
+
+def _pack_crumbs(q: np.ndarray) -> np.ndarray:
+    """(n, 256) values of 2 bits -> (n, 64) uint8, element l of crumb j of half h is bits 2j of byte 32h + l"""
+    q = q.reshape(-1, 2, 4, 32)
+    return (q[:, :, 0] | (q[:, :, 1] << 2) | (q[:, :, 2] << 4) | (q[:, :, 3] << 6)).reshape(-1, 64)
+
+
+def _sub_block_min_max(sub_blocks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """min and max of every sub block, element by element, which is faster than reducing the short last axis"""
+    low = high = sub_blocks[:, :, 0]
+    for index in range(1, sub_blocks.shape[2]):
+        low = np.minimum(low, sub_blocks[:, :, index])
+        high = np.maximum(high, sub_blocks[:, :, index])
+    return low, high
+
+
+def _fit_scale_min(sub_blocks: np.ndarray, n_max: int, steps: Sequence[float] = (0.0, 0.5, -0.5)):
+    """
+    scale and min of every sub block so that value = scale * q - min with q in [0, n_max].
+    every step divides the range into n_max + step parts, then scale and min are fitted by least squares to the
+    rounded q, the fit of the least error is kept. the error is computed from the sums of the fit instead of the
+    elements.
+    :param sub_blocks: (n, sub blocks, elements) float32
+    :param n_max: largest q
+    :param steps: range divisions to try
+    :return: scales and mins of (n, sub blocks), mins are not negative
+    """
+    low, high = _sub_block_min_max(sub_blocks)
+    low = np.minimum(0, low)
+    n = sub_blocks.shape[2]
+    # sums are small, float64 keeps the error exact enough to compare steps
+    sum_x = np.einsum("ijk->ij", sub_blocks).astype(np.float64)
+    sum_xx = np.einsum("ijk,ijk->ij", sub_blocks, sub_blocks).astype(np.float64)
+    # elements in [0, 1] of the range of their sub block
+    unit = (sub_blocks - low[:, :, np.newaxis]) * _reciprocal(high - low)[:, :, np.newaxis]
+    q = np.empty_like(sub_blocks)
+    low = low.astype(np.float64)
+    best_error = np.full(low.shape, np.inf)
+    best_scale = (high - low) / n_max
+    best_low = low
+    for step in steps:
+        scale = (high - low) / (n_max + step)
+        # elements are not negative, floor of x + 0.5 rounds them, it differs from the rounding of the encoder only
+        # on ties, which does not matter to the fit
+        np.multiply(unit, n_max + step, out=q)
+        q += 0.5
+        np.floor(q, out=q)
+        np.minimum(q, n_max, out=q)
+        sum_q = np.einsum("ijk->ij", q).astype(np.float64)
+        sum_qq = np.einsum("ijk,ijk->ij", q, q).astype(np.float64)
+        sum_qx = np.einsum("ijk,ijk->ij", q, sub_blocks).astype(np.float64)
+        det = n * sum_qq - sum_q * sum_q
+        fitted = det > 0
+        fitted_scale = np.where(fitted, np.maximum(0, (n * sum_qx - sum_q * sum_x) / np.where(fitted, det, 1)),
+                                scale)
+        fitted_low = np.where(fitted, np.minimum(0, (sum_x - fitted_scale * sum_q) / n), low)
+        # sum of (scale * q + low - x) ** 2
+        error = (fitted_scale * (fitted_scale * sum_qq + 2 * fitted_low * sum_q - 2 * sum_qx) +
+                 fitted_low * (n * fitted_low - 2 * sum_x) + sum_xx)
+        better = error < best_error
+        best_error = np.where(better, error, best_error)
+        best_scale = np.where(better, fitted_scale, best_scale)
+        best_low = np.where(better, fitted_low, best_low)
+    return best_scale.astype(np.float32), -best_low.astype(np.float32)
+
+
+def quantize_q2_k(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q2_K: uint8 scales[16], uint8 qs[64], half d, half dmin.
+    every super block has 16 sub blocks of 16 elements, sub block scales and mins are quantized to 4 bits.
+    :param blocks: (n, 256) float32
+    :return: (n, 84) uint8
+    """
+    sub_blocks = blocks.reshape(-1, 16, 16)
+    # value = scale * q - min, 2 bits leave few levels, so scales and mins are fitted instead of taken from the range
+    scales, mins = _fit_scale_min(sub_blocks, 3)
+    max_scale = scales.max(axis=1, keepdims=True)
+    max_min = mins.max(axis=1, keepdims=True)
+    ls = np.minimum(15, _round_half_away(scales * _reciprocal(max_scale / 15))).astype(np.uint8)
+    lm = np.minimum(15, _round_half_away(mins * _reciprocal(max_min / 15))).astype(np.uint8)
+    d = (max_scale / 15).astype(np.float16)
+    dmin = (max_min / 15).astype(np.float16)
+    # quantize elements with the rounded scales, as the dequantizer sees them
+    sub_d = (d.astype(np.float32) * ls)[:, :, np.newaxis]
+    sub_m = (dmin.astype(np.float32) * lm)[:, :, np.newaxis]
+    q = np.clip(_round_half_away((sub_blocks + sub_m) * _reciprocal(sub_d)), 0, 3).astype(np.uint8)
+    return np.concatenate([ls | (lm << 4), _pack_crumbs(q), d.view(np.uint8).reshape(-1, 2),
+                           dmin.view(np.uint8).reshape(-1, 2)], axis=1)
+
+
+def quantize_q3_k(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q3_K: uint8 hmask[32], uint8 qs[64], uint8 scales[12], half d.
+    every super block has 16 sub blocks of 16 elements, sub block scales are quantized to 6 bits, elements are
+    -4 to 3, the low 2 bits in qs and the high bit in hmask.
+    :param blocks: (n, 256) float32
+    :return: (n, 110) uint8
+    """
+    sub_blocks = blocks.reshape(-1, 16, 16)
+    max_index = np.abs(sub_blocks).argmax(axis=2)[:, :, np.newaxis]
+    scales = np.take_along_axis(sub_blocks, max_index, axis=2)[:, :, 0] / -4
+    max_scale_index = np.abs(scales).argmax(axis=1)[:, np.newaxis]
+    max_scale = np.take_along_axis(scales, max_scale_index, axis=1)
+    max_scale = np.where(np.abs(max_scale) < _GROUP_MAX_EPS, 0, max_scale)
+    iscale = _reciprocal(max_scale) * -32
+    ls = np.clip(_round_half_away(iscale * scales), -32, 31).astype(np.int8)
+    d = _reciprocal(iscale).astype(np.float16)
+    sub_d = (d.astype(np.float32) * ls)[:, :, np.newaxis]
+    q = np.clip(_round_half_away(sub_blocks * _reciprocal(sub_d)), -4, 3) + 4
+    q = np.where(sub_d == 0, 4, q).astype(np.uint8).reshape(-1, 2, 4, 32)
+    # bit 4h + j of hmask byte l is the high bit of element l of crumb j of half h
+    hmask = np.zeros((blocks.shape[0], 32), dtype=np.uint8)
+    for half in range(2):
+        for crumb in range(4):
+            hmask |= (q[:, half, crumb] >> 2) << (half * 4 + crumb)
+    ls = (ls + 32).astype(np.uint8)
+    packed_scales = np.empty((blocks.shape[0], 12), dtype=np.uint8)
+    packed_scales[:, 0:8] = (ls[:, 0:8] & 0xF) | ((ls[:, 8:16] & 0xF) << 4)
+    high = ls >> 4
+    packed_scales[:, 8:12] = high[:, 0:4] | (high[:, 4:8] << 2) | (high[:, 8:12] << 4) | (high[:, 12:16] << 6)
+    return np.concatenate([hmask, _pack_crumbs(q & 3), packed_scales, d.view(np.uint8).reshape(-1, 2)], axis=1)
+
+
+def quantize_q4_k(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q4_K: half d, half dmin, uint8 scales[12], uint8 qs[128].
+    every super block has 8 sub blocks of 32 elements, sub block scales and mins are quantized to 6 bits.
+    :param blocks: (n, 256) float32
+    :return: (n, 144) uint8
+    """
+    sub_blocks = blocks.reshape(-1, 8, 32)
+    # value = scale * q - min, min is not negative
+    mins = np.maximum(0, -sub_blocks.min(axis=2))
+    scales = (sub_blocks.max(axis=2) + mins) / 15
+    max_scale = scales.max(axis=1, keepdims=True)
+    max_min = mins.max(axis=1, keepdims=True)
+    ls = np.minimum(63, _round_half_away(scales * _reciprocal(max_scale / 63))).astype(np.uint8)
+    lm = np.minimum(63, _round_half_away(mins * _reciprocal(max_min / 63))).astype(np.uint8)
+    d = (max_scale / 63).astype(np.float16)
+    dmin = (max_min / 63).astype(np.float16)
+    # quantize elements with the rounded scales, as the dequantizer sees them
+    sub_d = (d.astype(np.float32) * ls)[:, :, np.newaxis]
+    sub_m = (dmin.astype(np.float32) * lm)[:, :, np.newaxis]
+    q = np.clip(_round_half_away((sub_blocks + sub_m) * _reciprocal(sub_d)), 0, 15).astype(np.uint8)
+    q = q.reshape(-1, 4, 2, 32)
+    qs = (q[:, :, 0] | (q[:, :, 1] << 4)).reshape(-1, 128)
+    packed_scales = np.empty((blocks.shape[0], 12), dtype=np.uint8)
+    packed_scales[:, 0:4] = ls[:, 0:4] | ((ls[:, 4:8] >> 4) << 6)
+    packed_scales[:, 4:8] = lm[:, 0:4] | ((lm[:, 4:8] >> 4) << 6)
+    packed_scales[:, 8:12] = (ls[:, 4:8] & 0xF) | ((lm[:, 4:8] & 0xF) << 4)
+    return np.concatenate([d.view(np.uint8).reshape(-1, 2), dmin.view(np.uint8).reshape(-1, 2), packed_scales, qs],
+                          axis=1)
+
+
+def quantize_q6_k(blocks: np.ndarray) -> np.ndarray:
+    """
+    block_q6_K: uint8 ql[128], uint8 qh[64], int8 scales[16], half d.
+    every super block has 16 sub blocks of 16 elements, sub block scales are quantized to 8 bits.
+    :param blocks: (n, 256) float32
+    :return: (n, 210) uint8
+    """
+    sub_blocks = blocks.reshape(-1, 16, 16)
+    max_index = np.abs(sub_blocks).argmax(axis=2)[:, :, np.newaxis]
+    scales = np.take_along_axis(sub_blocks, max_index, axis=2)[:, :, 0] / -32
+    max_scale_index = np.abs(scales).argmax(axis=1)[:, np.newaxis]
+    max_scale = np.take_along_axis(scales, max_scale_index, axis=1)
+    max_scale = np.where(np.abs(max_scale) < _GROUP_MAX_EPS, 0, max_scale)
+    iscale = _reciprocal(max_scale) * -128
+    ls = np.minimum(127, _round_half_away(iscale * scales)).astype(np.int8)
+    d = _reciprocal(iscale).astype(np.float16)
+    sub_d = (d.astype(np.float32) * ls)[:, :, np.newaxis]
+    q = np.clip(_round_half_away(sub_blocks * _reciprocal(sub_d)), -32, 31) + 32
+    q = np.where(sub_d == 0, 32, q).astype(np.uint8).reshape(-1, 2, 4, 32)
+    ql = np.concatenate([(q[:, :, 0] & 0xF) | ((q[:, :, 2] & 0xF) << 4),
+                         (q[:, :, 1] & 0xF) | ((q[:, :, 3] & 0xF) << 4)], axis=2).reshape(-1, 128)
+    qh = ((q[:, :, 0] >> 4) | ((q[:, :, 1] >> 4) << 2) | ((q[:, :, 2] >> 4) << 4)
+          | ((q[:, :, 3] >> 4) << 6)).reshape(-1, 64)
+    return np.concatenate([ql, qh, ls.view(np.uint8), d.view(np.uint8).reshape(-1, 2)], axis=1)
+
+
+QUANTIZE_FUNC_DICT: Dict[GGMLQuantizationType, Callable[[np.ndarray], np.ndarray]] = {
+    GGMLQuantizationType.Q8_0: quantize_q8_0,
+    GGMLQuantizationType.Q4_0: quantize_q4_0,
+    GGMLQuantizationType.Q4_1: quantize_q4_1,
+    GGMLQuantizationType.Q2_K: quantize_q2_k,
+    GGMLQuantizationType.Q3_K: quantize_q3_k,
+    GGMLQuantizationType.Q4_K: quantize_q4_k,
+    GGMLQuantizationType.Q6_K: quantize_q6_k,
+}
+FLOAT_TYPE_NP_DICT = {
+    GGMLQuantizationType.F32: np.float32,
+    GGMLQuantizationType.F16: np.float16,
+}
+
+
+def quant_block_and_type_size(quant_type: GGMLQuantizationType) -> Tuple[int, int]:
+    return GGML_QUANT_SIZES_DICT[GGMLType(np.uint32(int(quant_type)))]
+
+
+def quantized_nbytes(shape: Sequence[int], quant_type: GGMLQuantizationType) -> int:
+    block_size, type_size = quant_block_and_type_size(quant_type)
+    return int(np.prod(shape, dtype=np.int64)) // block_size * type_size
+
+
+def encoded_layout(shape: Sequence[int], quant_type: GGMLQuantizationType) -> Tuple[np.dtype, Tuple[int, ...]]:
+    """dtype and shape of the ndarray returned by quantize, for a tensor of shape (after transpose)"""
+    if quant_type in FLOAT_TYPE_NP_DICT:
+        return np.dtype(FLOAT_TYPE_NP_DICT[quant_type]), tuple(shape)
+    block_size, type_size = quant_block_and_type_size(quant_type)
+    return np.dtype(np.uint8), tuple(shape[:-1]) + (shape[-1] // block_size * type_size,)
+
+
+def quantize(tensor: np.ndarray, quant_type: GGMLQuantizationType,
+             axes: Optional[Sequence[int]] = None, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    encode a float tensor, blocks run along the last axis.
+    :param tensor: float ndarray
+    :param quant_type:
+    :param axes: permutation of axes applied before encoding, chunks are transposed into a small buffer one by one,
+        the transposed tensor is never materialized, default None means no transpose
+    :param out: preallocated C contiguous result of the dtype and shape given by encoded_layout, default None
+    :return: float ndarray for F32/F16, else uint8 ndarray whose last axis is the bytes of a row
+    """
+    if quant_type in FLOAT_TYPE_NP_DICT:
+        return blocked_transpose(tensor, axes, FLOAT_TYPE_NP_DICT[quant_type], out)
+    if quant_type not in QUANTIZE_FUNC_DICT:
+        raise GGUFException("unsupported quantization type: {0}".format(quant_type.name))
+    if not is_identity(axes):
+        tensor = tensor.transpose(axes)
+    block_size, type_size = quant_block_and_type_size(quant_type)
+    if tensor.ndim == 0 or tensor.shape[-1] % block_size != 0:
+        raise GGUFException("row size of shape {0} is not a multiple of block size {1}".format(tensor.shape,
+                                                                                              block_size))
+    quantize_func = QUANTIZE_FUNC_DICT[quant_type]
+    result_shape = tensor.shape[:-1] + (tensor.shape[-1] // block_size * type_size,)
+    if out is None:
+        result = np.empty(result_shape, dtype=np.uint8)
+    elif out.shape != result_shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+        raise GGUFException("out should be C contiguous uint8 of shape {0}, got {1}".format(result_shape, out.shape))
+    else:
+        result = out
+    buffer = None
+    for start, chunk in iter_chunks(tensor, QUANTIZE_CHUNK_ELEMENTS):
+        if chunk.dtype != np.float32 or not chunk.flags.c_contiguous:
+            if buffer is None:
+                buffer = np.empty(chunk.shape, dtype=np.float32)
+            # the last chunk may be shorter
+            blocked_copy(chunk, buffer[:chunk.shape[0]])
+            chunk = buffer[:chunk.shape[0]]
+        result[start:start + chunk.shape[0]] = quantize_func(chunk.reshape(-1, block_size)).reshape(
+            result[start:start + chunk.shape[0]].shape)
+    return result
+
+
+class QuantizePolicy:
+    def __init__(self, default_type: str = "F32", rules: Optional[List[dict]] = None, fallback_type: str = "F16"):
+        """
+        decide the ggml type of every tensor.
+        :param default_type: type name of tensors matching no rule, such as "Q4_K", "auto" means the float type
+            chosen for the source tensor
+        :param rules: [{"pattern": "*norm*", "type": "F32"}], fnmatch patterns of gguf tensor name, first match wins
+        :param fallback_type: type name used when the row size is not a multiple of the block size, "F32", "F16" or
+            "auto", a quantized type can not encode these rows either
+        """
+        self.default_type = default_type
+        self.rules = rules or []
+        self.fallback_type = fallback_type
+        for type_name in [default_type, fallback_type] + [rule["type"] for rule in self.rules]:
+            if type_name == AUTO_TYPE_NAME:
+                continue
+            if type_name not in GGML_TENSOR_QUANTIZE_DICT:
+                raise GGUFException("unknown quantization type: {0}".format(type_name))
+            quant_type = GGML_TENSOR_QUANTIZE_DICT[type_name]
+            if quant_type not in QUANTIZE_FUNC_DICT and quant_type not in FLOAT_TYPE_NP_DICT:
+                raise GGUFException("quantization type {0} is not supported by the writer".format(type_name))
+        if fallback_type != AUTO_TYPE_NAME and GGML_TENSOR_QUANTIZE_DICT[fallback_type] not in FLOAT_TYPE_NP_DICT:
+            raise GGUFException("fallback type should be F32, F16 or {0}, got {1}".format(AUTO_TYPE_NAME,
+                                                                                      fallback_type))
+
+    @staticmethod
+    def from_json(policy_json_path: str) -> "QuantizePolicy":
+        """
+        policy json file in model configs folder, such as models/llama2/configs/llama2_quantize_policy.json
+        """
+        with open(policy_json_path, encoding="utf-8", mode="r") as f:
+            policy = json.load(f)
+        return QuantizePolicy(policy.get("default", "F32"), policy.get("rules", []), policy.get("fallback", "F16"))
+
+    def file_type(self, float_type: GGMLQuantizationType = GGMLQuantizationType.F32) -> int:
+        """
+        :param float_type: float type of most tensors, used when default type is "auto"
+        :return: value of general.file_type
+        """
+        if self.default_type == AUTO_TYPE_NAME:
+            return GGML_FILE_TYPE_DICT[float_type.name]
+        return GGML_FILE_TYPE_DICT[self.default_type]
+
+    @property
+    def quantized(self) -> bool:
+        return self.default_type != AUTO_TYPE_NAME \
+            and GGML_TENSOR_QUANTIZE_DICT[self.default_type] in QUANTIZE_FUNC_DICT
+
+    def tensor_type(self, tensor_name: str, shape: Sequence[int],
+                    float_type: GGMLQuantizationType = GGMLQuantizationType.F32) -> GGMLQuantizationType:
+        """
+        :param tensor_name: gguf tensor name
+        :param shape: numpy shape of the tensor to write
+        :param float_type: F32 or F16 chosen for the source tensor, used by "auto"
+        :return:
+        """
+        type_name = self.default_type
+        for rule in self.rules:
+            if fnmatch.fnmatchcase(tensor_name, rule["pattern"]):
+                type_name = rule["type"]
+                break
+        if type_name == AUTO_TYPE_NAME:
+            # 1d tensors such as norms are always F32, as llama.cpp does
+            return float_type if len(shape) >= 2 else GGMLQuantizationType.F32
+        quant_type = GGML_TENSOR_QUANTIZE_DICT[type_name]
+        if quant_type in FLOAT_TYPE_NP_DICT:
+            return quant_type
+        # ggml only quantizes matrices
+        if len(shape) < 2:
+            return GGMLQuantizationType.F32
+        block_size, _ = quant_block_and_type_size(quant_type)
+        if shape[-1] % block_size != 0:
+            logging.warning("row size of %s is %d, not a multiple of %d, fall back to %s", tensor_name, shape[-1],
+                            block_size, self.fallback_type)
+            if self.fallback_type == AUTO_TYPE_NAME:
+                return float_type
+            return GGML_TENSOR_QUANTIZE_DICT[self.fallback_type]
+        return quant_type
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Splice ckpt tensors into a copy of the reference gguf. Header bytes and untouched tensors are copied from the
+reference by the kernel, only the replaced tensors are converted, so the output is byte-identical to the
+reference outside the replaced regions.
+"""
+import argparse
+import errno
+import fnmatch
+import logging
+import os
+from typing import List, NamedTuple, Optional, Sequence
+
+import numpy as np
+from gguf import GGMLQuantizationType
+
+from constant import GGUFException
+from gguf_index_cache import GGUFIndexCache
+from models.ckpt_convert_util import MsCkptRefactorHelper
+from models.incremental import PARTIAL_SUFFIX, pwrite_all
+from models.quantize_util import FLOAT_TYPE_NP_DICT, QUANTIZE_FUNC_DICT, quantize, quantized_nbytes
+from models.transpose_util import TransposePolicy
+from read_gguf import GGUFLoader
+
+# bytes copied by one system call
+_COPY_CHUNK_BYTES = 1 << 30
+# errors meaning the fast path is not supported for these files, such as copying across file systems
+_UNSUPPORTED_COPY_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+
+
+def _sendfile(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    # sendfile writes at the current position of dst
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _read_write(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    data = os.pread(src_fd, min(count, _COPY_CHUNK_BYTES), offset)
+    if not data:
+        return 0
+    return os.pwrite(dst_fd, data, offset)
+
+
+class RangeCopier:
+    def __init__(self, src_fd: int, dst_fd: int):
+        """
+        copy byte ranges between two files at the same offsets, copy_file_range is tried first, it shares
+        extents on file systems supporting reflink, then sendfile, then plain read and write.
+        :param src_fd: source file descriptor
+        :param dst_fd: destination file descriptor, opened for writing
+        """
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+        self._copy_funcs = [_read_write]
+        if hasattr(os, "sendfile"):
+            self._copy_funcs.insert(0, _sendfile)
+        if hasattr(os, "copy_file_range"):
+            self._copy_funcs.insert(0, _copy_file_range)
+
+    def copy(self, offset: int, count: int):
+        while count > 0:
+            copy_func = self._copy_funcs[0]
+            try:
+                n_copied = copy_func(self.src_fd, self.dst_fd, offset, min(count, _COPY_CHUNK_BYTES))
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_COPY_ERRNOS or len(self._copy_funcs) == 1:
+                    raise
+                logging.info("%s is not supported here (%s), fall back", copy_func.__name__, e)
+                self._copy_funcs.pop(0)
+                continue
+            if n_copied == 0:
+                raise GGUFException("unexpected end of file at offset {0}".format(offset))
+            offset += n_copied
+            count -= n_copied
+
+
+class SplicedTensor(NamedTuple):
+    name: str
+    tensor_type: GGMLQuantizationType
+    # numpy shape in reference gguf
+    shape: Sequence[int]
+    # absolute offset of tensor data in reference gguf
+    offset: int
+    nbytes: int
+
+
+class SpliceWriter:
+    def __init__(self, reference_gguf_path: str, layer_name_map_json_path: str, ckpt_file_path: str,
+                 output_path: str = "example.gguf", need_transpose: bool = False,
+                 transpose_map_json_path: Optional[str] = None, keep_patterns: Optional[List[str]] = None,
+                 index_cache: Optional[GGUFIndexCache] = None):
+        """
+        :param reference_gguf_path: reference gguf file path, its metadata, tensor infos and types are kept
+        :param layer_name_map_json_path: layer name map json file path
+        :param ckpt_file_path: MindSpore ckpt file path
+        :param output_path: output gguf file path, default "example.gguf"
+        :param need_transpose: whether you need transpose, default False
+        :param transpose_map_json_path: transpose json file path, such as the one saved by preflight, default None
+        :param keep_patterns: fnmatch patterns of gguf tensor names copied from reference even if the ckpt has them
+        :param index_cache: optional index cache of the reference gguf header
+        """
+        self.reference_gguf_path = reference_gguf_path
+        self.layer_name_map_json_path = layer_name_map_json_path
+        self.ckpt_file_path = ckpt_file_path
+        self.output_path = output_path
+        self.transpose = need_transpose
+        self.transpose_map_json_path = transpose_map_json_path
+        self.keep_patterns = keep_patterns or []
+        self.index_cache = index_cache
+        self.ms_helper: MsCkptRefactorHelper
+        self.loader: GGUFLoader
+
+    def _kept(self, tensor_name: str) -> bool:
+        return any(fnmatch.fnmatchcase(tensor_name, pattern) for pattern in self.keep_patterns)
+
+    def _plan(self) -> List[SplicedTensor]:
+        """
+        tensors to replace in file order, every one is checked before anything is written, the replaced tensor
+        keeps the type of the reference, so that its size and every offset stay the same.
+        :return:
+        """
+        spliced = []
+        for tensor_info in self.loader.tensor_infos:
+            tensor_name = tensor_info.name.string
+            if tensor_name not in self.ms_helper.ckpt_dict or self._kept(tensor_name):
+                continue
+            tensor_type = GGMLQuantizationType(int(tensor_info.type.value))
+            if tensor_type not in FLOAT_TYPE_NP_DICT and tensor_type not in QUANTIZE_FUNC_DICT:
+                raise GGUFException("can not encode {0} as {1}, keep it with keep_patterns".format(
+                    tensor_name, tensor_type.name))
+            _, _, nbytes = GGUFLoader.tensor_layout(tensor_info)
+            shape = tuple(int(dim) for dim in reversed(tensor_info.dimensions))
+            ckpt_shape = self.ms_helper.tensor_shape(tensor_name)
+            if ckpt_shape != shape:
+                raise GGUFException("shape of {0} is {1} in ckpt but {2} in reference, check the transpose".format(
+                    tensor_name, ckpt_shape, shape))
+            if quantized_nbytes(shape, tensor_type) != nbytes:
+                raise GGUFException("tensor {0} should have {1} bytes".format(tensor_name, nbytes))
+            spliced.append(SplicedTensor(tensor_name, tensor_type, shape, int(tensor_info.offset), nbytes))
+        for tensor_name in self.ms_helper.ckpt_dict:
+            if tensor_name not in self.loader:
+                logging.warning("tensor %s is not in reference gguf, it is not written", tensor_name)
+        return sorted(spliced, key=lambda tensor: tensor.offset)
+
+    def _convert_tensor(self, spliced: SplicedTensor) -> np.ndarray:
+        axes = self.ms_helper.transpose_axes(spliced.name)
+        # tensors to quantize or transpose keep the precision of ckpt, they are cast while transposed
+        dtype = FLOAT_TYPE_NP_DICT.get(spliced.tensor_type) if axes is None else None
+        ms_tensor = self.ms_helper.ckpt_dict.pop(spliced.name)
+        ndarray_tensor = MsCkptRefactorHelper.convert_ms_tensor_to_ndarray(ms_tensor, spliced.name, dtype)
+        return quantize(ndarray_tensor, spliced.tensor_type, axes)
+
+    def _splice(self, spliced_tensors: List[SplicedTensor], partial_path: str):
+        file_size = os.path.getsize(self.reference_gguf_path)
+        src_fd = os.open(self.reference_gguf_path, os.O_RDONLY)
+        try:
+            dst_fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                copier = RangeCopier(src_fd, dst_fd)
+                cursor = 0
+                for spliced in spliced_tensors:
+                    # header, padding and untouched tensors in between are copied as they are
+                    copier.copy(cursor, spliced.offset - cursor)
+                    ndarray_tensor = self._convert_tensor(spliced)
+                    pwrite_all(dst_fd, ndarray_tensor, spliced.offset)
+                    del ndarray_tensor
+                    cursor = spliced.offset + spliced.nbytes
+                copier.copy(cursor, file_size - cursor)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    def write(self):
+        if os.path.exists(self.output_path) and os.path.samefile(self.output_path, self.reference_gguf_path):
+            raise GGUFException("output should not be the reference gguf {0}".format(self.reference_gguf_path))
+        self.loader = GGUFLoader(self.reference_gguf_path, index_cache=self.index_cache)
+        self.loader.load()
+        transpose_policy = None
+        if self.transpose_map_json_path:
+            transpose_policy = TransposePolicy.from_json(self.transpose_map_json_path, self.transpose)
+        self.ms_helper = MsCkptRefactorHelper(self.ckpt_file_path, self.layer_name_map_json_path, self.transpose,
+                                              transpose_policy)
+        partial_path = self.output_path + PARTIAL_SUFFIX
+        try:
+            self.ms_helper.do_refactor()
+            spliced_tensors = self._plan()
+            logging.info("replace %d of %d tensors of %s", len(spliced_tensors), len(self.loader.tensor_infos),
+                         self.reference_gguf_path)
+            self._splice(spliced_tensors, partial_path)
+            os.replace(partial_path, self.output_path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        finally:
+            self.ms_helper.close()
+            self.loader.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="splice MindSpore ckpt tensors into a copy of the reference gguf")
+    parser.add_argument("--reference", required=True, help="reference gguf file path")
+    parser.add_argument("--ckpt", required=True, help="MindSpore ckpt file path")
+    parser.add_argument("--name-map", default="llama2/configs/llama2_layer_name_map.json",
+                        help="layer name map json file path")
+    parser.add_argument("--output", default="example.gguf", help="output gguf file path")
+    parser.add_argument("--transpose", action="store_true", help="whether you need transpose")
+    parser.add_argument("--transpose-map", default=None, help="transpose json file path")
+    parser.add_argument("--keep", action="append", default=[],
+                        help="fnmatch pattern of gguf tensor names copied from reference, can be repeated")
+    args = parser.parse_args()
+    writer = SpliceWriter(reference_gguf_path=args.reference,
+                          layer_name_map_json_path=args.name_map,
+                          ckpt_file_path=args.ckpt,
+                          output_path=args.output,
+                          need_transpose=args.transpose,
+                          transpose_map_json_path=args.transpose_map,
+                          keep_patterns=args.keep)
+    writer.write()
@@ -0,0 +1,166 @@
+"""
+Cache-blocked transposition of ndarrays, applied lazily to one tensor at a time while writing
+"""
+import fnmatch
+import json
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from constant import GGUFException
+
+# edge of the square tiles copied at a time, 64 x 64 float32 is 16 KiB and fits in L1 cache
+DEFAULT_BLOCK_SIZE = 64
+
+
+def check_axes(axes: Sequence[int], ndim: int) -> Tuple[int, ...]:
+    axes = tuple(int(axis) for axis in axes)
+    if sorted(axes) != list(range(ndim)):
+        raise GGUFException("axes {0} is not a permutation of {1} dimensions".format(axes, ndim))
+    return axes
+
+
+def is_identity(axes: Optional[Sequence[int]]) -> bool:
+    return axes is None or tuple(axes) == tuple(range(len(axes)))
+
+
+def permuted_shape(shape: Sequence[int], axes: Optional[Sequence[int]]) -> Tuple[int, ...]:
+    if axes is None:
+        return tuple(shape)
+    return tuple(shape[axis] for axis in axes)
+
+
+def _mergeable(shape: Sequence[int], strides: Sequence[int]) -> bool:
+    """whether the axes can be merged into one axis without copy"""
+    return all(strides[axis] == strides[axis + 1] * shape[axis + 1] for axis in range(len(shape) - 1))
+
+
+def _collapse_2d(array: np.ndarray) -> Optional[np.ndarray]:
+    """2d view of the array, merging leading axes and trailing axes, None if no split can be merged without copy"""
+    shape, strides = array.shape, array.strides
+    for split in range(array.ndim - 1, 0, -1):
+        if _mergeable(shape[:split], strides[:split]) and _mergeable(shape[split:], strides[split:]):
+            return np.lib.stride_tricks.as_strided(
+                array, shape=(int(np.prod(shape[:split])), int(np.prod(shape[split:]))),
+                strides=(strides[split - 1], strides[-1]), writeable=False)
+    return None
+
+
+def blocked_copy(src: np.ndarray, dst: np.ndarray, block_size: int = DEFAULT_BLOCK_SIZE):
+    """
+    copy src into dst, casting to the dtype of dst. when the last axis of src is not contiguous, such as a
+    transposed view, it is copied tile by tile, so both reading and writing stay in cache.
+    :param src: ndarray, may be any strided view
+    :param dst: C contiguous ndarray of the same shape
+    :param block_size: edge of the tiles
+    :return:
+    """
+    if src.ndim == 0 or src.shape[-1] <= 1 or src.strides[-1] == src.itemsize:
+        np.copyto(dst, src, casting="unsafe")
+        return
+    if src.ndim > 2:
+        merged = _collapse_2d(src)
+        if merged is None:
+            for index in range(src.shape[0]):
+                blocked_copy(src[index], dst[index], block_size)
+            return
+        src, dst = merged, dst.reshape(merged.shape)
+    if src.ndim == 1:
+        np.copyto(dst, src, casting="unsafe")
+        return
+    n_rows, n_cols = src.shape
+    for row in range(0, n_rows, block_size):
+        row_end = min(row + block_size, n_rows)
+        for col in range(0, n_cols, block_size):
+            col_end = min(col + block_size, n_cols)
+            np.copyto(dst[row:row_end, col:col_end], src[row:row_end, col:col_end], casting="unsafe")
+
+
+def iter_chunks(tensor: np.ndarray, chunk_elements: int) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    split a tensor, which may be a transposed view, along the first axis without copying.
+    :param tensor: ndarray of at least 1 dimension
+    :param chunk_elements: about the number of elements of a chunk, a chunk has at least one slice
+    :return: iterator of (start index on the first axis, view of the chunk)
+    """
+    slice_elements = max(1, tensor.size // tensor.shape[0]) if tensor.shape[0] else 1
+    step = max(1, chunk_elements // slice_elements)
+    for start in range(0, tensor.shape[0], step):
+        yield start, tensor[start:start + step]
+
+
+def blocked_transpose(tensor: np.ndarray, axes: Optional[Sequence[int]], dtype: Optional[np.dtype] = None,
+                      out: Optional[np.ndarray] = None, block_size: int = DEFAULT_BLOCK_SIZE) -> np.ndarray:
+    """
+    permute the axes of a tensor and cast it in one pass, no intermediate copy of the whole tensor is made.
+    :param tensor: ndarray
+    :param axes: permutation of axes as np.transpose, None means keeping the order
+    :param dtype: dtype of the result, None means the dtype of tensor
+    :param out: preallocated C contiguous result, its shape must be the permuted shape
+    :param block_size: edge of the tiles
+    :return: C contiguous ndarray
+    """
+    dtype = np.dtype(dtype or tensor.dtype)
+    if out is None and is_identity(axes):
+        return np.ascontiguousarray(tensor).astype(dtype, copy=False)
+    view = tensor.transpose(axes) if axes is not None else tensor
+    if out is None:
+        out = np.empty(view.shape, dtype=dtype)
+    elif out.shape != view.shape or not out.flags.c_contiguous:
+        raise GGUFException("out should be C contiguous of shape {0}, got {1}".format(view.shape, out.shape))
+    if view.size:
+        blocked_copy(view, out, block_size)
+    return out
+
+
+class TransposePolicy:
+    def __init__(self, rules: Optional[List[dict]] = None, transpose_2d: bool = False):
+        """
+        decide the axes permutation of every tensor.
+        :param rules: [{"pattern": "blk.*.attn_q.weight", "axes": [1, 0]}], fnmatch patterns of gguf tensor name,
+            or {"name": "output.weight", "axes": [1, 0]} matching one tensor exactly, which is looked up without
+            scanning the rules. a rule only matches tensors of len(axes) dimensions, first match wins
+        :param transpose_2d: whether to transpose 2d tensors matching no rule
+        """
+        self.rules = rules or []
+        self.transpose_2d = transpose_2d
+        # (name, number of dimensions) to (rule index, axes) of the first exact rule
+        self._exact_rules: Dict[Tuple[str, int], Tuple[int, Tuple[int, ...]]] = {}
+        self._pattern_rules: List[Tuple[int, dict]] = []
+        for index, rule in enumerate(self.rules):
+            axes = check_axes(rule["axes"], len(rule["axes"]))
+            if "name" in rule:
+                self._exact_rules.setdefault((rule["name"], len(axes)), (index, axes))
+            elif "pattern" in rule:
+                self._pattern_rules.append((index, rule))
+            else:
+                raise GGUFException("transpose rule should have a name or a pattern, got {0}".format(rule))
+
+    @staticmethod
+    def from_json(transpose_json_path: str, transpose_2d: bool = False) -> "TransposePolicy":
+        """
+        transpose json file in model configs folder, {"rules": [{"pattern": "*", "axes": [1, 0]}]},
+        the one saved by preflight has a {"name": ..., "axes": ...} rule of every tensor
+        """
+        with open(transpose_json_path, encoding="utf-8", mode="r") as f:
+            policy = json.load(f)
+        return TransposePolicy(policy.get("rules", []), transpose_2d)
+
+    def axes(self, tensor_name: str, shape: Sequence[int]) -> Optional[Tuple[int, ...]]:
+        """
+        :param tensor_name: gguf tensor name
+        :param shape: shape of the tensor in ckpt
+        :return: axes permutation, None means the tensor is not transposed
+        """
+        exact = self._exact_rules.get((tensor_name, len(shape)))
+        for index, rule in self._pattern_rules:
+            if exact is not None and index > exact[0]:
+                break
+            if len(rule["axes"]) == len(shape) and fnmatch.fnmatchcase(tensor_name, rule["pattern"]):
+                axes = tuple(rule["axes"])
+                return None if is_identity(axes) else axes
+        if exact is not None:
+            return None if is_identity(exact[1]) else exact[1]
+        if self.transpose_2d and len(shape) == 2:
+            return 1, 0
+        return None
@@ -1,35 +1,135 @@
 import logging
+import mmap
 import os.path
+import re
 import shutil
 import struct
-from typing import List, BinaryIO, Any
+import threading
+from collections import OrderedDict
+from typing import List, BinaryIO, Any, Optional, Tuple, Iterator
 
 import numpy as np
 
 from constant import FormatCharacter, GGUFException, GGUFTensorInfo, GGUFMetadataKV, GGUFString, \
     GGUFMetadataValueType, GGUF_METADATA_TYPR_NUMBER_SET, FORMAT_CHARACTER_DICT, FORMAT_NP_TYPE_DICT, K, GGMLType, V, \
-    GGML_QUANT_SIZES_DICT, GGUFMetadataValue
+    GGML_QUANT_SIZES_DICT, GGUFMetadataValue, ggml_type_np_type_dict
+from gguf_dequantize import dequantize
+from gguf_header_parser import GGUFHeaderParser, MetadataKeyFilter
+from gguf_index_cache import GGUFIndexCache
+from gguf_tensor_reader import PositionalReader
+from gguf_tensor_table import GGUFTensorInfoView, GGUFTensorTable
+from instrumentation import NULL_INSTRUMENTATION, Instrumentation
 
 VALID_MAGIC_NUMBER = b"GGUF"
 VALID_GGUF_VERSION = [2, 3]
 ENCODING = "utf-8"
 _TENSORS_SAVING_PATH = "./tensors_temp_saving_folder"
+ALIGNMENT_KEY = "general.alignment"
+# split gguf of llama.cpp gguf-split, every shard has these keys, only the first shard has the other metadata
+SPLIT_NO_KEY = "split.no"
+SPLIT_COUNT_KEY = "split.count"
+SPLIT_TENSORS_COUNT_KEY = "split.tensors.count"
+_SPLIT_PATH_PATTERN = re.compile(r"^(.*)-(\d{5})-of-(\d{5})\.gguf$")
+DEFAULT_TENSOR_CACHE_BYTES = 1 << 30
+# selective reads seek past large values, a small buffer avoids reading what is skipped
+SELECTIVE_READ_CHUNK_SIZE = 64 << 10
+
+
+def split_path(path_prefix: str, split_no: int, split_count: int) -> str:
+    """file path of a shard, such as model-00001-of-00003.gguf, split_no starts from 0"""
+    return "{0}-{1:05d}-of-{2:05d}.gguf".format(path_prefix, split_no + 1, split_count)
+
+
+def split_paths(first_split_path: str, split_count: int) -> List[str]:
+    """file paths of all shards, the first shard path should be named as split_path"""
+    match = _SPLIT_PATH_PATTERN.match(first_split_path)
+    if match is None or int(match.group(2)) != 1 or int(match.group(3)) != split_count:
+        raise GGUFException("{0} should be named as prefix-00001-of-{1:05d}.gguf".format(first_split_path,
+                                                                                      split_count))
+    return [split_path(match.group(1), split_no, split_count) for split_no in range(split_count)]
+
+
+class GGUFTensorCache:
+    def __init__(self, max_bytes: int = DEFAULT_TENSOR_CACHE_BYTES):
+        """
+        LRU cache of loaded tensors bounded by total bytes, thread safe.
+        :param max_bytes: byte budget, tensors larger than it are never cached
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._tensors: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[np.ndarray]:
+        with self._lock:
+            tensor = self._tensors.get(name)
+            if tensor is not None:
+                self._tensors.move_to_end(name)
+            return tensor
+
+    def put(self, name: str, tensor: np.ndarray):
+        if tensor.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old_tensor = self._tensors.pop(name, None)
+            if old_tensor is not None:
+                self.n_bytes -= old_tensor.nbytes
+            self._tensors[name] = tensor
+            self.n_bytes += tensor.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, evicted_tensor = self._tensors.popitem(last=False)
+                self.n_bytes -= evicted_tensor.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tensors.clear()
+            self.n_bytes = 0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tensors
+
+    def __len__(self) -> int:
+        return len(self._tensors)
 
 
 class GGUFLoader:
-    def __init__(self, gguf_file_path: str, need: bool=False):
+    def __init__(self, gguf_file_path: str, need: bool=False, index_cache: Optional[GGUFIndexCache] = None,
+                 tensor_cache_bytes: int = DEFAULT_TENSOR_CACHE_BYTES,
+                 instrumentation: Optional[Instrumentation] = None):
         """
-        :param gguf_file_path: gguf_file_path
+        :param gguf_file_path: gguf_file_path, the first shard of a split gguf opens all shards as one model
+        :param need: whether to map tensors data, tensors are zero-copy numpy views of the file
+        :param index_cache: optional index cache, parsed header is loaded from it when the file has not changed
+        :param tensor_cache_bytes: byte budget of the LRU cache of tensors loaded by tensor(name)
+        :param instrumentation: receiver of stage and tensor events, default None means no instrumentation
         """
         self.gguf_file_path: str = gguf_file_path
         self.tensor_count: np.uint64 = np.uint64(0)
         self.metadata_kv_count: np.uint64 = np.uint(64)
         self.metadata: List[GGUFMetadataKV] = []
-        self.tensor_infos: List[GGUFTensorInfo] = []
+        # columnar tensors info, iterating or indexing it gives GGUFTensorInfo-like views
+        self.tensor_infos: GGUFTensorTable = GGUFTensorTable.from_columns([], [], [], [], [])
         self.f: BinaryIO = None
         self.alignment: int = 32
-        self.tensors: List[List[V]] = []
+        # absolute file offset of the tensor data section
+        self.data_offset: int = 0
+        self.tensors: List[np.ndarray] = []
         self.need = need
+        self._mmap: Optional[mmap.mmap] = None
+        self._parser: Optional[GGUFHeaderParser] = None
+        self.index_cache = index_cache
+        self.tensor_cache = GGUFTensorCache(tensor_cache_bytes)
+        # positional reader used by tensor(name), opened on first access, shared by threads
+        self._tensor_reader: Optional[PositionalReader] = None
+        self._loaded = False
+        # guards the lazy load and the opening of the tensor reader
+        self._lock = threading.Lock()
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        # file paths of all shards of a split gguf, empty for a single file
+        self.split_paths: List[str] = []
+        # loaders of the other shards, and the shard of every row of tensors info, 0 is this file
+        self._shards: List["GGUFLoader"] = []
+        self._tensor_shards: Optional[np.ndarray] = None
 
     @staticmethod
     def auto_struct_unpack(f: BinaryIO, format_: str) -> K:
@@ -65,6 +165,30 @@ class GGUFLoader:
         """adjust offset"""
         return np.uint64(cur_offset + (alignment - (cur_offset % alignment)) % alignment)
 
+    @staticmethod
+    def tensor_layout(tensor_info: GGUFTensorInfo) -> Tuple[np.dtype, Tuple[int, ...], int]:
+        """
+        get numpy dtype, numpy shape and bytes number of a tensor.
+        gguf dimensions are stored from the innermost one, so numpy shape is the reversed dimensions.
+        quantized tensors are described as raw uint8 blocks, the innermost dimension is the bytes number of a row.
+        :param tensor_info:
+        :return: (dtype, shape, n_bytes)
+        """
+        if tensor_info.type not in GGML_QUANT_SIZES_DICT:
+            raise GGUFException("unsupported tensor type: {0}".format(tensor_info.type))
+        block_size, type_size = GGML_QUANT_SIZES_DICT[tensor_info.type]
+        shape = [int(dim) for dim in reversed(tensor_info.dimensions)]
+        if shape and shape[-1] % block_size != 0:
+            raise GGUFException("tensor {0} row size {1} is not a multiple of block size {2}".format(
+                str(tensor_info.name), shape[-1], block_size))
+        n_elements = int(np.prod(shape, dtype=np.uint64))
+        n_bytes = n_elements // block_size * type_size
+        if tensor_info.type in ggml_type_np_type_dict:
+            return np.dtype(FORMAT_NP_TYPE_DICT[ggml_type_np_type_dict[tensor_info.type]]), tuple(shape), n_bytes
+        if shape:
+            shape[-1] = shape[-1] // block_size * type_size
+        return np.dtype(np.uint8), tuple(shape), n_bytes
+
     @staticmethod
     def convert_gguf_metadata_array_to_list(gguf_meta_data: GGUFMetadataValue, meta_data_name: str):
         """
@@ -83,26 +207,50 @@ class GGUFLoader:
             logging.error("unsupported data type: {0}, name is {1}".format(type(gguf_meta_data.value[0]), meta_data_name))
             return []
 
-    def _set_up(self):
+    def _set_up(self, chunk_size: Optional[int] = None):
         """
         setUp: open file
         :return:
         """
         self.f = open(self.gguf_file_path, "rb")
+        self._parser = GGUFHeaderParser(self.f) if chunk_size is None else GGUFHeaderParser(self.f, chunk_size)
 
     def _tear_down(self):
         """
         tearDown: close file
         :return:
         """
+        if self._parser is not None:
+            self._parser.close()
+            self._parser = None
         self.f.close()
 
+    def close(self):
+        """
+        release mapped tensors, mapping is kept alive by numpy views still referenced by caller.
+        :return:
+        """
+        self.tensors = []
+        self.tensor_cache.clear()
+        if self._tensor_reader is not None:
+            self._tensor_reader.close()
+            self._tensor_reader = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # some views are still exported, the mapping is released when they are collected
+                pass
+            self._mmap = None
+        for shard in self._shards:
+            shard.close()
+
     def _check_magic_number(self):
         """
         check whether the magic number is right.
         :return: void
         """
-        if self.f.read(4) != VALID_MAGIC_NUMBER:
+        if self._parser.read_bytes(4) != VALID_MAGIC_NUMBER:
             raise GGUFException("Invalid magic number")
 
     def _check_version(self):
@@ -110,7 +258,7 @@ class GGUFLoader:
         check whether the version is 3.
         :return: void
         """
-        if GGUFLoader.auto_struct_unpack(self.f, FormatCharacter.UINT32) not in VALID_GGUF_VERSION:
+        if self._parser.read_uint32() not in VALID_GGUF_VERSION:
             raise GGUFException("Invalid version")
 
     def _read_tensor_count(self):
@@ -118,93 +266,296 @@ class GGUFLoader:
         read tensor numbers
         :return: void
         """
-        self.tensor_count = GGUFLoader.auto_struct_unpack(self.f, FormatCharacter.UINT64)
+        self.tensor_count = self._parser.read_uint64()
 
     def _read_metadata_kv_count(self):
         """
         read meta data key-value numbers
         :return: void
         """
-        self.metadata_kv_count = GGUFLoader.auto_struct_unpack(self.f, FormatCharacter.UINT64)
+        self.metadata_kv_count = self._parser.read_uint64()
 
     def _read_metadata_key_value_pairs(self):
         """
-        read metadata value.
+        read metadata value, kv pairs of an earlier read such as load_metadata are replaced.
         :return:
         """
+        self.metadata = []
         for i in range(self.metadata_kv_count):
-
-            key = GGUFLoader.get_gguf_string(self.f)
-            value_type = GGUFLoader.get_gguf_metadata_value_type(self.f)
-            value = GGUFLoader.get_gguf_metadata_value(self.f, value_type)
-            metadata_kv = GGUFMetadataKV(key, value_type, value)
-            self.metadata.append(metadata_kv)
+            self.metadata.append(self._parser.read_metadata_kv())
 
     def _read_tensors_info(self):
         """
         get tensors info
         :return:
         """
-        for i in range(self.tensor_count):
-            name = GGUFLoader.get_gguf_string(self.f)
-            n_dimensions = GGUFLoader.auto_struct_unpack(self.f, FormatCharacter.UINT32)
-            dimensions = [GGUFLoader.auto_struct_unpack(self.f, FormatCharacter.UINT64) for _ in range(n_dimensions)]
-            type_ = GGMLType(GGUFLoader.auto_struct_unpack(self.f, FormatCharacter.UINT32))
-            offset = GGUFLoader.auto_struct_unpack(self.f, FormatCharacter.UINT64)
-            self.tensor_infos.append(GGUFTensorInfo(name, n_dimensions, dimensions, type_, offset))
+        self.tensor_infos = self._parser.read_tensor_table(self.tensor_count)
+
+    def _read_alignment(self):
+        """read custom alignment from metadata"""
+        for metadata_kv in self.metadata:
+            if metadata_kv.key.string == ALIGNMENT_KEY:
+                self.alignment = int(metadata_kv.value)
+                if self.alignment == 0 or self.alignment % 8 != 0:
+                    raise GGUFException("Invalid alignment: {0}".format(self.alignment))
 
     def _adjust_tensors_info(self, adjust_offset: int):
         """adjust tensors info offset"""
-        for i in range(len(self.tensor_infos)):
-            self.tensor_infos[i].offset += np.uint64(adjust_offset)
+        self.tensor_infos.shift_offsets(adjust_offset)
+        misaligned_names = self.tensor_infos.misaligned(self.alignment)
+        if misaligned_names:
+            logging.warning("%d tensors are not aligned to %d bytes, such as %s", len(misaligned_names),
+                            self.alignment, misaligned_names[0])
+
+    def _load_from_index_cache(self) -> bool:
+        """
+        restore parsed header from index cache.
+        :return: whether the index cache hits
+        """
+        if self.index_cache is None:
+            return False
+        entry = self.index_cache.load(self.gguf_file_path)
+        if entry is None:
+            return False
+        self.tensor_count = entry.tensor_count
+        self.metadata_kv_count = entry.metadata_kv_count
+        self.metadata = entry.metadata
+        self.alignment = entry.alignment
+        self.tensor_infos = entry.tensor_infos
+        self.data_offset = entry.data_offset
+        return True
+
+    def _save_to_index_cache(self):
+        if self.index_cache is None:
+            return
+        self.index_cache.save(self.gguf_file_path, self.data_offset, self.alignment, self.tensor_count,
+                              self.metadata_kv_count, self.metadata, self.tensor_infos)
+
+    def _read_header(self):
+        """read header, metadata and tensors info"""
+        # CAUTION: these methods should execute by ORDER!
+        self._check_magic_number()
+        self._check_version()
+        self._read_tensor_count()
+        self._read_metadata_kv_count()
+        self._read_metadata_key_value_pairs()
+        self._read_alignment()
+        self._read_tensors_info()
+        self.data_offset = int(GGUFLoader.padding(self._parser.tell(), self.alignment))
+        self._adjust_tensors_info(self.data_offset)
 
     def _read_tensors(self):
+        """map the tensor data section, every tensor is a numpy view located by its offset in tensors info"""
         if not self.need:
             return
-        """using tensors info to read tensors"""
-        for i, tensor_info in enumerate(self.tensor_infos):
-            temp_tensor = []
-            start_offset = tensor_info.offset
-
-            # first we should move to the start_offset
-            if tensor_info.offset >= self.f.tell():
-                self.f.read(np.uint64(start_offset - self.f.tell()))
-                print(tensor_info.name.string, "--", start_offset, self.f.tell())
-                # read tensors
-                tensor_length = np.uint64(np.prod(tensor_info.dimensions))
-                block_size, type_size = GGML_QUANT_SIZES_DICT[tensor_info.type]
-                n_bytes = tensor_length * type_size // block_size
-                # we should not save tensors in memory, because it may be too large
-                if tensor_info.type == GGMLType.F32:
-                    for _ in range(tensor_length):
-                        temp_tensor.append(GGUFLoader.auto_struct_unpack(self.f, FormatCharacter.FLOAT32))
-                elif tensor_info.type == GGMLType.F16:
-                    for _ in range(tensor_length):
-                        temp_tensor.append(np.frombuffer(self.f.read(2), dtype=np.float16)[0])
+        self.tensors = []
+        self._mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        exceeding_names = self.tensor_infos.exceeding(len(self._mmap))
+        if exceeding_names:
+            raise GGUFException("tensor {0} exceeds the file size".format(exceeding_names[0]))
+        for tensor_info in self.tensor_infos:
+            dtype, shape, n_bytes = GGUFLoader.tensor_layout(tensor_info)
+            offset = tensor_info.offset
+            tensor = np.frombuffer(self._mmap, dtype=dtype, count=n_bytes // dtype.itemsize, offset=offset)
+            self.tensors.append(tensor.reshape(shape))
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                # errors are raised, a corrupt file must not look like a file without tensors
+                self.load()
+
+    def tensor_names(self) -> List[str]:
+        self._ensure_loaded()
+        return self.tensor_infos.tensor_names()
+
+    def tensor_info(self, name: str) -> GGUFTensorInfoView:
+        self._ensure_loaded()
+        return self.tensor_infos.info(name)
+
+    def tensor(self, name: str) -> np.ndarray:
+        """
+        get a tensor by name, only this tensor is read from file on first access, then it is kept in LRU cache.
+        if tensors are mapped (need=True), the mapped view is returned directly.
+        :param name: gguf tensor name, such as "blk.13.ffn_gate.weight"
+        :return: tensor with numpy dtype and shape, see tensor_layout
+        """
+        tensor_info = self.tensor_info(name)
+        if self.tensors:
+            return self.tensors[self.tensor_infos.row(name)]
+        tensor = self.tensor_cache.get(name)
+        if tensor is not None:
+            return tensor
+        dtype, shape, n_bytes = GGUFLoader.tensor_layout(tensor_info)
+        with self.instrumentation.tensor(name, "read", n_bytes):
+            tensor = self._read_tensor_bytes(tensor_info, 0, n_bytes).view(dtype).reshape(shape)
+        self.tensor_cache.put(name, tensor)
+        return tensor
+
+    def tensor_reader(self, name: str) -> PositionalReader:
+        """
+        positional reader of the file holding a tensor, such as a shard of a split gguf.
+        it reads by the absolute offsets of tensors info, threads may share it, it is closed by close().
+        :param name: gguf tensor name
+        :return:
+        """
+        return self._tensor_reader_of(self.tensor_info(name))
+
+    def _tensor_reader_of(self, tensor_info: GGUFTensorInfoView) -> PositionalReader:
+        if self._tensor_shards is not None and self._tensor_shards[tensor_info.row]:
+            return self._shards[self._tensor_shards[tensor_info.row] - 1]._tensor_reader_of(tensor_info)
+        if self._tensor_reader is None:
+            with self._lock:
+                if self._tensor_reader is None:
+                    self._tensor_reader = PositionalReader(self.gguf_file_path)
+        return self._tensor_reader
+
+    def _read_tensor_bytes(self, tensor_info: GGUFTensorInfoView, start: int, n_bytes: int) -> np.ndarray:
+        """read n_bytes bytes of a tensor from its start-th byte, threads may read at the same time"""
+        buffer = np.empty(n_bytes, dtype=np.uint8)
+        if self._tensor_reader_of(tensor_info).read_into(memoryview(buffer), tensor_info.offset + start) != n_bytes:
+            raise GGUFException("tensor {0} exceeds the file size".format(tensor_info.name.string))
+        return buffer
+
+    def dequantized_tensor(self, name: str, row_start: int = 0, row_end: Optional[int] = None) -> np.ndarray:
+        """
+        get float32 values of a tensor, quantized blocks are decoded.
+        rows are the flattened leading dimensions, only the bytes of the selected rows are read,
+        so a slice of a large tensor can be checked without decoding the rest.
+        :param name: gguf tensor name, such as "blk.13.ffn_gate.weight"
+        :param row_start: first row to decode
+        :param row_end: row to stop before, default None means the last row
+        :return: float32 ndarray of the numpy shape if all rows are selected, else of (rows, row elements)
+        """
+        tensor_info = self.tensor_info(name)
+        dtype, shape, n_bytes = GGUFLoader.tensor_layout(tensor_info)
+        n_rows = int(np.prod(shape[:-1], dtype=np.int64)) if shape else 1
+        row_end = n_rows if row_end is None else row_end
+        if not 0 <= row_start <= row_end <= n_rows:
+            raise GGUFException("rows [{0}, {1}) out of range of {2} rows of {3}".format(row_start, row_end,
+                                                                                         n_rows, name))
+        row_bytes = n_bytes // n_rows if n_rows else 0
+        if self.tensors or name in self.tensor_cache:
+            rows = self.tensor(name).reshape(n_rows, -1)[row_start:row_end]
+        else:
+            rows = self._read_tensor_bytes(tensor_info, row_start * row_bytes, (row_end - row_start) * row_bytes)
+            rows = rows.view(dtype).reshape(row_end - row_start, -1)
+        with self.instrumentation.tensor(name, "dequantize") as span:
+            values = dequantize(rows, tensor_info.type)
+            span.set(bytes=values.nbytes)
+        if row_start == 0 and row_end == n_rows:
+            return values.reshape([int(dim) for dim in reversed(tensor_info.dimensions)])
+        return values
+
+    def keys(self) -> List[str]:
+        return self.tensor_names()
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.tensor(name)
+
+    def __contains__(self, name: str) -> bool:
+        self._ensure_loaded()
+        return name in self.tensor_infos
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.tensor_names())
+
+    def load_metadata(self, include: Optional[List[str]] = None,
+                      exclude: Optional[List[str]] = None) -> List[GGUFMetadataKV]:
+        """
+        read only the selected metadata kv pairs into self.metadata, tensors info is not read.
+        values of other keys are skipped without decoding, numeric arrays by their byte length and string arrays
+        by their length prefixes. when include has only exact keys, reading stops once all of them are found.
+        the index cache is not used, validating it costs more than this read.
+        :param include: fnmatch patterns of keys to read, such as ["llama.*"], default None means every key
+        :param exclude: fnmatch patterns of keys to skip, such as ["tokenizer.ggml.*"]
+        :return: selected kv pairs in file order
+        """
+        key_filter = MetadataKeyFilter(include, exclude)
+        self._set_up(SELECTIVE_READ_CHUNK_SIZE)
+        try:
+            with self.instrumentation.stage("GGUFLoader.load_metadata", path=self.gguf_file_path) as span:
+                self._check_magic_number()
+                self._check_version()
+                self._read_tensor_count()
+                self._read_metadata_kv_count()
+                self.metadata = self._parser.read_selected_metadata_kvs(self.metadata_kv_count, key_filter)
+                span.set(keys=len(self.metadata), stopped_early=key_filter.done)
+        finally:
+            self._tear_down()
+        return self.metadata
+
+    def _metadata_value(self, key: str, default: Any = None) -> Any:
+        for metadata_kv in self.metadata:
+            if metadata_kv.key.string == key:
+                return metadata_kv.value
+        return default
+
+    def _load_shards(self):
+        """open the other shards of a split gguf, their tensors info is appended to the one of this file"""
+        # shards of an earlier load are replaced
+        for shard in self._shards:
+            shard.close()
+        self._shards = []
+        split_count = int(self._metadata_value(SPLIT_COUNT_KEY, 1))
+        if split_count <= 1:
+            return
+        if int(self._metadata_value(SPLIT_NO_KEY, 0)) != 0:
+            raise GGUFException("{0} is not the first shard of a split gguf".format(self.gguf_file_path))
+        self.split_paths = split_paths(self.gguf_file_path, split_count)
+        tables = [self.tensor_infos]
+        tensor_shards = [np.zeros(len(self.tensor_infos), dtype=np.uint16)]
+        for split_no, path in enumerate(self.split_paths[1:], 1):
+            shard = GGUFLoader(path, self.need, self.index_cache, 0, self.instrumentation)
+            self._shards.append(shard)
+            shard.load(with_shards=False)
+            if int(shard._metadata_value(SPLIT_NO_KEY, -1)) != split_no \
+                    or int(shard._metadata_value(SPLIT_COUNT_KEY, -1)) != split_count:
+                raise GGUFException("{0} is not shard {1} of {2}".format(path, split_no + 1, split_count))
+            tables.append(shard.tensor_infos)
+            tensor_shards.append(np.full(len(shard.tensor_infos), split_no, dtype=np.uint16))
+            self.tensors.extend(shard.tensors)
+        self.tensor_infos = GGUFTensorTable.concat(tables)
+        self._tensor_shards = np.concatenate(tensor_shards)
+        self.tensor_count = len(self.tensor_infos)
+        expected_count = self._metadata_value(SPLIT_TENSORS_COUNT_KEY)
+        if expected_count is not None and int(expected_count) != self.tensor_count:
+            raise GGUFException("split gguf should have {0} tensors, found {1}".format(expected_count,
+                                                                                     self.tensor_count))
+
+    def load(self, with_shards: bool = True):
+        """
+        load this file and the other shards of a split gguf, errors are raised
+        :param with_shards: whether to open the other shards, False for the loaders of shards
+        :return:
+        """
+        self._set_up()
+        try:
+            with self.instrumentation.stage("GGUFLoader.load", path=self.gguf_file_path) as span:
+                if self._load_from_index_cache():
+                    span.set(index_cache_hit=True)
                 else:
-                    for _ in range(int(n_bytes)):
-                        temp_tensor.append(GGUFLoader.auto_struct_unpack(self.f, "B"))
-                self.tensors.append(temp_tensor)
+                    with self.instrumentation.stage("read_header"):
+                        self._read_header()
+                    self._save_to_index_cache()
+                # tensors are mapped lazily by the OS, nothing is read until a view is accessed
+                with self.instrumentation.stage("map_tensors"):
+                    self._read_tensors()
+                if with_shards:
+                    self._load_shards()
+                span.set(tensors=len(self.tensor_infos), data_offset=self.data_offset, shards=len(self._shards) + 1)
+            self._loaded = True
+        finally:
+            self._tear_down()
 
     def load_and_print(self):
         """
         main function to load GGUF info and print summary
         :return: void
         """
-        self._set_up()
         try:
-            # CAUTION: these methods should execute by ORDER!
-            self._check_magic_number()
-            self._check_version()
-            self._read_tensor_count()
-            self._read_metadata_kv_count()
-            self._read_metadata_key_value_pairs()
-            self._read_tensors_info()
-            self._adjust_tensors_info(GGUFLoader.padding(self.f.tell(), self.alignment))
-            # no need to read tensors, it may take much memory
-            self._read_tensors()
+            self.load()
         except GGUFException as e:
             print(e)
-            self._tear_down()
-        finally:
-            self._tear_down()
@@ -0,0 +1,77 @@
+"""
+Shared fixtures of the tests, tiny llama shaped files generated once per session by benchmarks.fixtures
+"""
+import os
+import sys
+from typing import Optional
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# modules of the repository are imported from its root, as the scripts do
+sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.fixtures import FixtureConfig, FixturePaths, make_fixtures  # noqa: E402
+from models.main_writer import Writer  # noqa: E402
+
+LLAMA2_CONFIGS_DIR = os.path.join(ROOT_DIR, "models", "llama2", "configs")
+LAYER_NAME_MAP_JSON_PATH = os.path.join(LLAMA2_CONFIGS_DIR, "llama2_layer_name_map.json")
+QUANTIZE_POLICY_JSON_PATH = os.path.join(LLAMA2_CONFIGS_DIR, "llama2_quantize_policy.json")
+# rows of 256 elements, so that K-quants apply to every matrix
+TINY_CONFIG = FixtureConfig(n_layers=2, hidden_size=256, ffn_size=512, vocab_size=512)
+
+
+def make_writer(paths: FixturePaths, output_path: str, **kwargs) -> Writer:
+    """writer of the ckpt and metadata of paths, named by the llama2 name map"""
+    return Writer(metadata_json_path=paths.metadata_json_path, layer_name_map_json_path=LAYER_NAME_MAP_JSON_PATH,
+                  ckpt_file_path=paths.ckpt_path, arch="llama", output_path=output_path, **kwargs)
+
+
+def write_gguf(paths: FixturePaths, output_path: str, **kwargs) -> Optional[bytes]:
+    """convert the ckpt of paths, the bytes of the output are returned, None when it is sharded"""
+    writer = make_writer(paths, output_path, **kwargs)
+    writer.write()
+    if writer.shard_paths:
+        return None
+    with open(output_path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture(scope="session")
+def fixture_dir(tmp_path_factory) -> str:
+    return str(tmp_path_factory.mktemp("fixtures"))
+
+
+@pytest.fixture(scope="session")
+def tiny_fixtures(fixture_dir) -> FixturePaths:
+    """reference gguf of Q4_K, Q6_K and Q8_0 matrices, float32 ckpt and plain metadata json"""
+    return make_fixtures(fixture_dir, TINY_CONFIG)
+
+
+@pytest.fixture(scope="session")
+def bf16_fixtures(fixture_dir) -> FixturePaths:
+    return make_fixtures(fixture_dir, TINY_CONFIG._replace(ckpt_dtype="BFloat16"))
+
+
+def corrupt_magic(gguf_path: str, output_path: str) -> str:
+    """copy of a gguf file whose magic number is broken"""
+    with open(gguf_path, "rb") as f:
+        data = bytearray(f.read())
+    data[0:4] = b"GGUX"
+    with open(output_path, "wb") as f:
+        f.write(data)
+    return output_path
+
+
+def save_ms_ckpt(ckpt_path: str, arrays: dict, slice_kb: Optional[int] = None) -> str:
+    """save arrays by MindSpore, tensors larger than slice_kb KiB are saved in several slices as large ones are"""
+    ms = pytest.importorskip("mindspore")
+    from mindspore.train import serialization
+    slice_size = serialization.SLICE_SIZE
+    if slice_kb is not None:
+        serialization.SLICE_SIZE = slice_kb
+    try:
+        ms.save_checkpoint([{"name": name, "data": ms.Tensor(array)} for name, array in arrays.items()], ckpt_path)
+    finally:
+        serialization.SLICE_SIZE = slice_size
+    return ckpt_path
@@ -0,0 +1,111 @@
+import json
+import os
+
+import pytest
+
+from conftest import LAYER_NAME_MAP_JSON_PATH, LLAMA2_CONFIGS_DIR, QUANTIZE_POLICY_JSON_PATH
+from constant import GGUFException
+from models import batch_convert
+from models.batch_convert import BatchConverter, load_jobs, parse_job
+
+
+class StopWatching(Exception):
+    pass
+
+
+def save_jobs(jobs_json_path: str, entries) -> str:
+    with open(jobs_json_path, "w", encoding="utf-8") as f:
+        json.dump(entries, f)
+    return jobs_json_path
+
+
+def test_job_paths(tmp_path):
+    configs_dir = tmp_path / "configs"
+    configs_dir.mkdir()
+    (configs_dir / "tiny-gguf-metadata.json").write_text("{}")
+    (configs_dir / "tiny_layer_name_map.json").write_text("{}")
+    base_dir = str(tmp_path / "jobs")
+
+    job = parse_job({"ckpt": "../ckpt/a.ckpt", "output": "a.gguf", "config_dir": "../configs",
+                     "options": {"transpose_map_json_path": "transpose.json"}}, base_dir, 0)
+    assert job.ckpt_path == str(tmp_path / "ckpt" / "a.ckpt")
+    assert job.output_path == os.path.join(base_dir, "a.gguf")
+    assert job.name == "a.gguf"
+    # config files are found in the config folder, or resolved against it
+    assert job.metadata_json_path == str(configs_dir / "tiny-gguf-metadata.json")
+    assert job.layer_name_map_json_path == str(configs_dir / "tiny_layer_name_map.json")
+    assert job.options["transpose_map_json_path"] == str(configs_dir / "transpose.json")
+    assert job.quantize_policy_json_path is None
+
+    job = parse_job({"ckpt": "a.ckpt", "output": "a.gguf", "model": "llama2", "quantize_policy": True}, base_dir, 0)
+    assert job.layer_name_map_json_path == LAYER_NAME_MAP_JSON_PATH
+    assert job.quantize_policy_json_path == QUANTIZE_POLICY_JSON_PATH
+    assert os.path.dirname(job.metadata_json_path) == LLAMA2_CONFIGS_DIR
+
+    # a splice job keeps the metadata of its reference
+    job = parse_job({"ckpt": "a.ckpt", "output": "a.gguf", "model": "llama2", "reference": "ref.gguf"}, base_dir, 0)
+    assert job.reference_gguf_path == os.path.join(base_dir, "ref.gguf")
+    assert job.metadata_json_path is None
+
+
+@pytest.mark.parametrize("entry", [
+    "a.ckpt",
+    1,
+    {"output": "a.gguf", "model": "llama2"},
+    {"ckpt": "a.ckpt", "output": "a.gguf"},
+    {"ckpt": "a.ckpt", "output": "a.gguf", "model": "llama2", "options": 1},
+    {"ckpt": "a.ckpt", "output": "a.gguf", "model": "llama2", "options": {"keep_patterns": []}},
+])
+def test_invalid_job_raises(tmp_path, entry):
+    with pytest.raises(GGUFException):
+        parse_job(entry, str(tmp_path), 0)
+
+
+def test_duplicate_output_raises(tmp_path):
+    jobs_json_path = save_jobs(str(tmp_path / "jobs.json"), {"jobs": [
+        {"ckpt": "a.ckpt", "output": "out/model.gguf", "model": "llama2"},
+        {"ckpt": "b.ckpt", "output": "./out/../out/model.gguf", "model": "llama2"},
+    ]})
+    with pytest.raises(GGUFException, match="more than one job"):
+        load_jobs(jobs_json_path)
+
+
+def test_report_marks_failed_job(tiny_fixtures, tmp_path):
+    jobs_json_path = save_jobs(str(tmp_path / "jobs.json"), [
+        {"ckpt": tiny_fixtures.ckpt_path, "output": "ok.gguf", "model": "llama2",
+         "metadata": tiny_fixtures.metadata_json_path, "arch": "llama"},
+        {"ckpt": "missing.ckpt", "output": "failed.gguf", "model": "llama2",
+         "metadata": tiny_fixtures.metadata_json_path, "arch": "llama"},
+        {"ckpt": tiny_fixtures.ckpt_path, "output": "quantized.gguf", "model": "llama2",
+         "metadata": tiny_fixtures.metadata_json_path, "arch": "llama", "quantize_policy": True},
+    ])
+    report = BatchConverter(workers=2).run_file(jobs_json_path, str(tmp_path / "report.json"))
+    assert (report["ok"], report["failed"]) == (2, 1)
+    assert [job["status"] for job in report["jobs"]] == ["ok", "failed", "ok"]
+    assert report["jobs"][1]["name"] == "failed.gguf"
+    assert report["jobs"][1]["error"]
+    assert not (tmp_path / "failed.gguf").exists()
+    for job in (report["jobs"][0], report["jobs"][2]):
+        assert job["error"] is None
+        assert job["output_bytes"] == os.path.getsize(job["output_path"])
+    # jobs share the parsed metadata and name map
+    assert report["config_cache"]["hits"] > 0
+    with open(str(tmp_path / "report.json"), "r", encoding="utf-8") as f:
+        assert json.load(f) == report
+
+
+def test_watch_survives_malformed_job_file(tmp_path, monkeypatch):
+    spool_dir = tmp_path / "spool"
+    spool_dir.mkdir()
+    # a string passes the key checks by substring and has no get
+    save_jobs(str(spool_dir / "jobs.json"), ["ckpt: a.ckpt, output: a.gguf"])
+
+    def stop(seconds):
+        raise StopWatching()
+
+    monkeypatch.setattr(batch_convert.time, "sleep", stop)
+    with pytest.raises(StopWatching):
+        BatchConverter().watch(str(spool_dir))
+    assert sorted(os.listdir(str(spool_dir))) == ["jobs.json.done", "jobs.json.report.json"]
+    with open(str(spool_dir / "jobs.json.report.json"), "r", encoding="utf-8") as f:
+        assert json.load(f)["error"].startswith("GGUFException")
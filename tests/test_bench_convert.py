@@ -0,0 +1,19 @@
+import pytest
+
+from benchmarks.bench_convert import bench_header_parse, run_isolated
+from conftest import corrupt_magic
+from constant import GGUFException
+
+
+def test_stage_reports_amount(tiny_fixtures, tmp_path):
+    seconds, amount, _ = run_isolated("header_parse", tiny_fixtures, str(tmp_path))
+    assert seconds > 0
+    assert amount > 0
+
+
+def test_broken_fixture_fails_stage(tiny_fixtures, tmp_path):
+    paths = tiny_fixtures._replace(gguf_path=corrupt_magic(tiny_fixtures.gguf_path, str(tmp_path / "bad.gguf")))
+    with pytest.raises(GGUFException):
+        bench_header_parse(paths, str(tmp_path))
+    with pytest.raises(RuntimeError, match="GGUFException"):
+        run_isolated("tensor_read", paths, str(tmp_path))
@@ -0,0 +1,96 @@
+import mmap
+
+import numpy as np
+import pytest
+
+from conftest import LAYER_NAME_MAP_JSON_PATH, save_ms_ckpt
+from models.ckpt_convert_util import MsCkptRefactorHelper, bf16_to_float16, bf16_to_float32
+from models.ckpt_reader import BFLOAT16_TYPE_NAME, MsCkptReader
+from models.transpose_util import TransposePolicy
+
+
+def test_reader_matches_mindspore(tiny_fixtures):
+    ms = pytest.importorskip("mindspore")
+    params = ms.load_checkpoint(tiny_fixtures.ckpt_path)
+    with MsCkptReader(tiny_fixtures.ckpt_path) as reader:
+        assert list(reader.tensor_infos) == list(params)
+        for tensor in reader:
+            assert tensor.shape == tuple(params[tensor.name].shape)
+            np.testing.assert_array_equal(tensor.array(), params[tensor.name].asnumpy())
+
+
+def test_reader_reads_mindspore_saved_ckpt(tmp_path):
+    rng = np.random.default_rng(0)
+    arrays = {"w": rng.standard_normal((8, 4)).astype(np.float32),
+              "h": rng.standard_normal((3, 5)).astype(np.float16),
+              "b": rng.standard_normal((4,)).astype(np.float32)}
+    ckpt_path = save_ms_ckpt(str(tmp_path / "saved.ckpt"), arrays)
+    with MsCkptReader(ckpt_path) as reader:
+        for name, array in arrays.items():
+            tensor = reader.tensor(name)
+            assert tensor.array().dtype == array.dtype
+            np.testing.assert_array_equal(tensor.array(), array)
+
+
+def test_sliced_tensors_stay_lazy(tmp_path):
+    rng = np.random.default_rng(0)
+    arrays = {"w": rng.standard_normal((64, 96)).astype(np.float32),
+              "b": rng.standard_normal((96,)).astype(np.float32)}
+    ckpt_path = save_ms_ckpt(str(tmp_path / "sliced.ckpt"), arrays, slice_kb=4)
+    with MsCkptReader(ckpt_path) as reader:
+        assert len(reader.tensor_infos["w"].chunks) > 1
+        tensors = {tensor.name: tensor for tensor in reader}
+        tensor = tensors["w"]
+        # the slices are views of the mapped file, not a joined copy
+        assert len(tensor.chunks) == len(reader.tensor_infos["w"].chunks)
+        assert all(isinstance(chunk.obj, mmap.mmap) for chunk in tensor.chunks)
+        assert tensor.nbytes == arrays["w"].nbytes
+        np.testing.assert_array_equal(tensor.array(), arrays["w"])
+        indices = np.array([[0, 95], [960, arrays["w"].size - 1]])
+        np.testing.assert_array_equal(tensor.take(indices), arrays["w"].reshape(-1)[indices])
+        np.testing.assert_array_equal(tensors["b"].array(), arrays["b"])
+        np.testing.assert_array_equal(MsCkptRefactorHelper.convert_ms_tensor_to_ndarray(tensor, "w", np.float16),
+                                      arrays["w"].astype(np.float16))
+
+
+def test_bf16_ckpt_converts_exactly(tiny_fixtures, bf16_fixtures):
+    with MsCkptReader(tiny_fixtures.ckpt_path) as f32_reader, MsCkptReader(bf16_fixtures.ckpt_path) as bf16_reader:
+        for tensor in bf16_reader:
+            assert tensor.dtype == BFLOAT16_TYPE_NAME
+            expected = f32_reader.tensor(tensor.name).array()
+            as_f32 = MsCkptRefactorHelper.convert_ms_tensor_to_ndarray(tensor, tensor.name)
+            # the fixture truncates float32 to bfloat16 of 7 bits mantissa
+            np.testing.assert_allclose(as_f32, expected, rtol=2 ** -7)
+            as_f16 = MsCkptRefactorHelper.convert_ms_tensor_to_ndarray(tensor, tensor.name, np.float16)
+            assert as_f16.dtype == np.float16
+            np.testing.assert_array_equal(as_f16, as_f32.astype(np.float16))
+
+
+def test_bf16_to_float16_special_values():
+    values = np.array([0.0, -0.0, 1.0, -2.5, 65504.0, 1e6, -1e6, np.inf, -np.inf, 1e-6, 1e-9], dtype=np.float32)
+    bits = (values.view(np.uint32) >> 16).astype(np.uint16)
+    with np.errstate(over="ignore"):
+        expected = bf16_to_float32(bits).astype(np.float16)
+    np.testing.assert_array_equal(bf16_to_float16(bits), expected)
+    nan_bits = (np.array([np.nan], dtype=np.float32).view(np.uint32) >> 16).astype(np.uint16)
+    assert np.isnan(bf16_to_float16(nan_bits)).all()
+
+
+@pytest.mark.parametrize("transpose, transpose_policy, expected_axes", [
+    (False, None, None),
+    (True, None, (1, 0)),
+    # the policy decides every transpose, the positional flag is ignored
+    (True, TransposePolicy(), None),
+    (False, TransposePolicy([{"pattern": "blk.*.attn_q.weight", "axes": [1, 0]}]), (1, 0)),
+])
+def test_refactor_helper_transpose(tiny_fixtures, transpose, transpose_policy, expected_axes):
+    helper = MsCkptRefactorHelper(tiny_fixtures.ckpt_path, LAYER_NAME_MAP_JSON_PATH, transpose, transpose_policy)
+    try:
+        helper.do_refactor()
+        shape = tuple(helper.ckpt_dict["blk.0.attn_q.weight"].shape)
+        assert helper.transpose_axes("blk.0.attn_q.weight") == expected_axes
+        expected_shape = shape[::-1] if expected_axes else shape
+        assert helper.tensor_shape("blk.0.attn_q.weight") == expected_shape
+        assert helper.transpose_axes("blk.0.attn_norm.weight") is None
+    finally:
+        helper.close()
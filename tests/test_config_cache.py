@@ -0,0 +1,37 @@
+import json
+
+from conftest import LAYER_NAME_MAP_JSON_PATH
+from models.config_cache import ConfigCache
+
+
+def test_entries_hit_until_file_changes(tiny_fixtures, tmp_path):
+    metadata_json_path = str(tmp_path / "metadata.json")
+    with open(tiny_fixtures.metadata_json_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    with open(metadata_json_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+
+    cache = ConfigCache()
+    first = cache.metadata(metadata_json_path)
+    assert (cache.hits, cache.misses) == (0, 1)
+    second = cache.metadata(metadata_json_path)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert second == first
+    # callers get their own dict to add keys to
+    second["general.extra"] = None
+    assert "general.extra" not in cache.metadata(metadata_json_path)
+    assert cache.name_mapper(LAYER_NAME_MAP_JSON_PATH) is cache.name_mapper(LAYER_NAME_MAP_JSON_PATH)
+    assert (cache.hits, cache.misses) == (3, 2)
+
+    # a changed file is loaded again
+    metadata["general.name"] = "changed"
+    with open(metadata_json_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+    assert cache.metadata(metadata_json_path)["general.name"].value == "changed"
+    assert (cache.hits, cache.misses) == (3, 3)
+    assert cache.metadata(metadata_json_path)["general.name"].value == "changed"
+    assert (cache.hits, cache.misses) == (4, 3)
+
+    cache.clear()
+    cache.metadata(metadata_json_path)
+    assert cache.misses == 4
@@ -0,0 +1,61 @@
+import logging
+import shutil
+
+import numpy as np
+
+from conftest import QUANTIZE_POLICY_JSON_PATH, write_gguf
+from models.ckpt_reader import MsCkptReader
+from models.incremental import ConversionManifest
+
+
+def write_quantized(paths, output_path: str, **kwargs) -> bytes:
+    return write_gguf(paths, output_path, quantize_policy_json_path=QUANTIZE_POLICY_JSON_PATH, **kwargs)
+
+
+def negate_tensor(ckpt_path: str, name: str):
+    """negate a float32 tensor of the ckpt in place, its size and every offset stay the same"""
+    with MsCkptReader(ckpt_path) as reader:
+        chunks = reader.tensor_infos[name].chunks
+    with open(ckpt_path, "r+b") as f:
+        for offset, length in chunks:
+            f.seek(offset)
+            data = -np.frombuffer(f.read(length), dtype=np.float32)
+            f.seek(offset)
+            f.write(data.tobytes())
+
+
+def changed_count(caplog) -> str:
+    return [record.getMessage() for record in caplog.records if "changed since" in record.getMessage()][-1]
+
+
+def test_incremental_output_follows_ckpt(tiny_fixtures, tmp_path, caplog):
+    paths = tiny_fixtures._replace(ckpt_path=shutil.copyfile(tiny_fixtures.ckpt_path, str(tmp_path / "model.ckpt")))
+    output_path = str(tmp_path / "incremental.gguf")
+    caplog.set_level(logging.INFO)
+
+    full = write_quantized(paths, str(tmp_path / "full.gguf"))
+    assert write_quantized(paths, output_path, incremental=True) == full
+    assert ConversionManifest.load(output_path) is not None
+    assert write_quantized(paths, output_path, incremental=True) == full
+    assert changed_count(caplog).startswith("0 of ")
+
+    # a changed tensor is patched in place
+    negate_tensor(paths.ckpt_path, "model.layers.0.attention.wq.weight")
+    full = write_quantized(paths, str(tmp_path / "full.gguf"))
+    assert write_quantized(paths, output_path, incremental=True) == full
+    assert changed_count(caplog).startswith("1 of ")
+
+
+def test_incremental_rewrite_on_header_change(tiny_fixtures, tmp_path, caplog):
+    output_path = str(tmp_path / "incremental.gguf")
+    caplog.set_level(logging.INFO)
+    write_quantized(tiny_fixtures, output_path, incremental=True)
+    # another metadata changes the header, unchanged tensors are copied to the new file
+    paths = tiny_fixtures._replace(metadata_json_path=str(tmp_path / "metadata.json"))
+    with open(tiny_fixtures.metadata_json_path, "r", encoding="utf-8") as f:
+        content = f.read()
+    with open(paths.metadata_json_path, "w", encoding="utf-8") as f:
+        f.write(content.replace("{", '{"general.name": "another",', 1))
+    full = write_quantized(paths, str(tmp_path / "full.gguf"))
+    assert write_quantized(paths, output_path, incremental=True) == full
+    assert changed_count(caplog).startswith("0 of ")
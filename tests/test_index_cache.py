@@ -0,0 +1,75 @@
+import os
+import shutil
+
+import pytest
+
+from gguf_index_cache import GGUFIndexCache
+from read_gguf import GGUFLoader
+
+
+@pytest.fixture()
+def gguf_copy(tiny_fixtures, tmp_path) -> str:
+    return shutil.copyfile(tiny_fixtures.gguf_path, str(tmp_path / "model.gguf"))
+
+
+def index_with(gguf_path: str, index_cache: GGUFIndexCache):
+    loader = GGUFLoader(gguf_path, index_cache=index_cache)
+    loader.load()
+    names = loader.tensor_names()
+    loader.close()
+    return names
+
+
+def fail_hash(gguf_file_path, header_size):
+    raise AssertionError("header should not be hashed")
+
+
+def test_unchanged_file_hits_without_hashing(gguf_copy, tmp_path, monkeypatch):
+    index_cache = GGUFIndexCache(str(tmp_path / "index"))
+    names = index_with(gguf_copy, index_cache)
+    monkeypatch.setattr(GGUFIndexCache, "header_hash", staticmethod(fail_hash))
+    entry = index_cache.load(gguf_copy)
+    assert entry is not None
+    assert entry.tensor_infos.tensor_names() == names
+
+
+def test_touched_file_is_hashed_then_refreshed(gguf_copy, tmp_path, monkeypatch):
+    index_cache = GGUFIndexCache(str(tmp_path / "index"))
+    index_with(gguf_copy, index_cache)
+    stat = os.stat(gguf_copy)
+    os.utime(gguf_copy, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    entry = index_cache.load(gguf_copy)
+    assert entry is not None
+    assert entry.mtime_ns == stat.st_mtime_ns + 10 ** 9
+    # the refreshed entry hits without hashing again
+    monkeypatch.setattr(GGUFIndexCache, "header_hash", staticmethod(fail_hash))
+    assert index_cache.load(gguf_copy) is not None
+
+
+def test_changed_header_misses(gguf_copy, tmp_path):
+    index_cache = GGUFIndexCache(str(tmp_path / "index"))
+    index_with(gguf_copy, index_cache)
+    stat = os.stat(gguf_copy)
+    with open(gguf_copy, "r+b") as f:
+        # the version field
+        f.seek(4)
+        f.write(b"\x02")
+    os.utime(gguf_copy, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert index_cache.load(gguf_copy) is None
+    assert not os.listdir(index_cache.cache_dir)
+
+
+def test_strict_cache_hashes_every_hit(gguf_copy, tmp_path, monkeypatch):
+    index_cache = GGUFIndexCache(str(tmp_path / "index"), strict=True)
+    index_with(gguf_copy, index_cache)
+    assert index_cache.load(gguf_copy) is not None
+    monkeypatch.setattr(GGUFIndexCache, "header_hash", staticmethod(fail_hash))
+    with pytest.raises(AssertionError):
+        index_cache.load(gguf_copy)
+
+
+def test_eviction_keeps_max_entries(tiny_fixtures, tmp_path):
+    index_cache = GGUFIndexCache(str(tmp_path / "index"), max_entries=2)
+    for i in range(3):
+        index_with(shutil.copyfile(tiny_fixtures.gguf_path, str(tmp_path / "model{0}.gguf".format(i))), index_cache)
+    assert len(os.listdir(index_cache.cache_dir)) == 2
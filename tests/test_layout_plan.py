@@ -0,0 +1,50 @@
+import os
+
+import pytest
+from gguf import GGUFReader
+
+from conftest import QUANTIZE_POLICY_JSON_PATH, make_writer, save_ms_ckpt
+from models.ckpt_reader import MsCkptReader
+from models.layout_plan import MODE_SHARDED
+
+
+def assert_plan_matches_output(layout_plan, paths):
+    assert [file.path for file in layout_plan.files] == paths
+    offsets = {}
+    for file_index, file in enumerate(layout_plan.files):
+        assert file.file_bytes == os.path.getsize(file.path)
+        reader = GGUFReader(file.path)
+        assert file.tensors == len(reader.tensors)
+        offsets.update((tensor.name, (file_index, tensor.data_offset, int(tensor.n_bytes)))
+                       for tensor in reader.tensors)
+    assert {tensor.name: (tensor.file_index, tensor.offset, tensor.n_bytes)
+            for tensor in layout_plan.tensors} == offsets
+
+
+@pytest.mark.parametrize("options", [{}, {"quantize_policy_json_path": QUANTIZE_POLICY_JSON_PATH},
+                                     {"quantize_policy_json_path": QUANTIZE_POLICY_JSON_PATH,
+                                      "max_shard_bytes": 200000}])
+def test_plan_matches_written_file(tiny_fixtures, tmp_path, options):
+    output_path = str(tmp_path / "model.gguf")
+    layout_plan = make_writer(tiny_fixtures, output_path, **options).plan()
+    assert not os.path.exists(output_path)
+    writer = make_writer(tiny_fixtures, output_path, **options)
+    writer.write()
+    if "max_shard_bytes" in options:
+        assert layout_plan.mode == MODE_SHARDED
+        assert len(writer.shard_paths) > 1
+    assert_plan_matches_output(layout_plan, writer.shard_paths or [output_path])
+
+
+def test_plan_counts_joined_slices(tiny_fixtures, tmp_path):
+    with MsCkptReader(tiny_fixtures.ckpt_path) as reader:
+        arrays = {name: reader.read(info).array().copy() for name, info in reader.tensor_infos.items()}
+    paths = tiny_fixtures._replace(ckpt_path=save_ms_ckpt(str(tmp_path / "sliced.ckpt"), arrays, slice_kb=64))
+    output_path = str(tmp_path / "model.gguf")
+    layout_plan = make_writer(paths, output_path).plan()
+    make_writer(paths, output_path).write()
+    assert_plan_matches_output(layout_plan, [output_path])
+    sliced = [tensor for tensor in layout_plan.tensors if tensor.sliced]
+    assert sliced
+    # the joined copy of a float32 tensor written as it is is the encoded tensor
+    assert all(tensor.conversion_bytes() >= tensor.source_bytes for tensor in sliced)
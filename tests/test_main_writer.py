@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import LAYER_NAME_MAP_JSON_PATH, QUANTIZE_POLICY_JSON_PATH, write_gguf
+from models.ckpt_reader import MsCkptReader
+from models.ckpt_convert_util import LayerNameMapper
+from read_gguf import GGUFLoader
+
+
+@pytest.mark.parametrize("quantize_policy_json_path", [None, QUANTIZE_POLICY_JSON_PATH])
+def test_write_modes_are_byte_identical(tiny_fixtures, tmp_path, quantize_policy_json_path):
+    in_memory = write_gguf(tiny_fixtures, str(tmp_path / "in_memory.gguf"), streaming=False,
+                           quantize_policy_json_path=quantize_policy_json_path)
+    assert write_gguf(tiny_fixtures, str(tmp_path / "streaming.gguf"),
+                      quantize_policy_json_path=quantize_policy_json_path) == in_memory
+    assert write_gguf(tiny_fixtures, str(tmp_path / "pipeline.gguf"), pipeline=True,
+                      quantize_policy_json_path=quantize_policy_json_path) == in_memory
+    assert write_gguf(tiny_fixtures, str(tmp_path / "workers.gguf"), workers=2, max_in_flight=3,
+                      quantize_policy_json_path=quantize_policy_json_path) == in_memory
+
+
+def test_float32_tensors_round_trip(tiny_fixtures, tmp_path):
+    output_path = str(tmp_path / "f32.gguf")
+    write_gguf(tiny_fixtures, output_path, float_type="F32")
+    mapper = LayerNameMapper.from_json(LAYER_NAME_MAP_JSON_PATH)
+    loader = GGUFLoader(output_path)
+    try:
+        with MsCkptReader(tiny_fixtures.ckpt_path) as reader:
+            names = [tensor.name for tensor in reader]
+            assert loader.tensor_names() == [mapper.rename(name) for name in names]
+            for name in names:
+                np.testing.assert_array_equal(loader.tensor(mapper.rename(name)), reader.tensor(name).array())
+    finally:
+        loader.close()
+
+
+def test_file_type_follows_quantize_policy(tiny_fixtures, tmp_path):
+    output_path = str(tmp_path / "q.gguf")
+    write_gguf(tiny_fixtures, output_path, quantize_policy_json_path=QUANTIZE_POLICY_JSON_PATH)
+    loader = GGUFLoader(output_path)
+    loader.load()
+    metadata = {kv.key.string: kv.value for kv in loader.metadata}
+    loader.close()
+    # Q4_K_M of llama.cpp
+    assert metadata["general.file_type"] == 15
+    assert metadata["general.quantization_version"] == 2
+    assert metadata["tokenizer.ggml.tokens"][:3] == ["<unk>", "<s>", "</s>"]
+    assert os.path.getsize(output_path) > 0
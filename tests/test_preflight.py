@@ -0,0 +1,75 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from conftest import LAYER_NAME_MAP_JSON_PATH, ROOT_DIR, corrupt_magic, save_ms_ckpt
+from constant import GGUFException
+from models.ckpt_reader import MsCkptReader
+from models.preflight import STATUS_IDENTICAL, _ckpt_rows, run_preflight
+from models.transpose_util import TransposePolicy
+
+
+def run_cli(reference_path: str, ckpt_path: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, "-m", "models.preflight", "--reference", reference_path, "--ckpt", ckpt_path,
+                           "--name-map", LAYER_NAME_MAP_JSON_PATH], cwd=ROOT_DIR, capture_output=True, text=True)
+
+
+def test_matching_ckpt_is_identical(tiny_fixtures):
+    report = run_preflight(tiny_fixtures.gguf_path, tiny_fixtures.ckpt_path, LAYER_NAME_MAP_JSON_PATH)
+    assert report.ok
+    assert report.entries
+    assert set(report.summary()) == {STATUS_IDENTICAL}
+
+
+def test_corrupt_reference_raises(tiny_fixtures, tmp_path):
+    reference_path = corrupt_magic(tiny_fixtures.gguf_path, str(tmp_path / "bad.gguf"))
+    with pytest.raises(GGUFException):
+        run_preflight(reference_path, tiny_fixtures.ckpt_path, LAYER_NAME_MAP_JSON_PATH)
+
+
+def test_cli_exit_code(tiny_fixtures, tmp_path):
+    assert run_cli(tiny_fixtures.gguf_path, tiny_fixtures.ckpt_path).returncode == 0
+    reference_path = corrupt_magic(tiny_fixtures.gguf_path, str(tmp_path / "bad.gguf"))
+    result = run_cli(reference_path, tiny_fixtures.ckpt_path)
+    assert result.returncode != 0
+    assert "can not check" in result.stderr
+
+
+@pytest.mark.parametrize("axes", [(0, 1, 2), (2, 0, 1), (1, 2, 0)])
+def test_sampled_rows_of_sliced_tensor(tmp_path, axes):
+    array = np.random.default_rng(0).standard_normal((12, 16, 20)).astype(np.float32)
+    ckpt_path = save_ms_ckpt(str(tmp_path / "sliced.ckpt"), {"w": array}, slice_kb=4)
+    with MsCkptReader(ckpt_path) as reader:
+        tensor = reader.tensor("w")
+        assert len(tensor.chunks) > 1
+        permuted = array.transpose(axes)
+        rows = [0, 7, permuted.size // permuted.shape[-1] - 1]
+        np.testing.assert_array_equal(_ckpt_rows(tensor, axes, rows),
+                                      permuted.reshape(-1, permuted.shape[-1])[rows])
+
+
+def test_transpose_rules_are_exact_names(tiny_fixtures):
+    report = run_preflight(tiny_fixtures.gguf_path, tiny_fixtures.ckpt_path, LAYER_NAME_MAP_JSON_PATH)
+    rules = report.transpose_rules()
+    assert rules and all(set(rule) == {"name", "axes"} for rule in rules)
+    policy = report.transpose_policy()
+    for entry in report.entries:
+        assert policy.axes(entry.gguf_name, entry.ckpt_shape) == entry.axes
+
+
+def test_exact_and_pattern_rules_keep_rule_order():
+    policy = TransposePolicy([{"pattern": "blk.0.*", "axes": [0, 1]},
+                              {"name": "blk.0.attn_q.weight", "axes": [1, 0]},
+                              {"name": "blk.1.attn_q.weight", "axes": [1, 0]},
+                              {"pattern": "blk.*", "axes": [0, 1]}], transpose_2d=True)
+    # the first matching rule wins, whether it is exact or a pattern
+    assert policy.axes("blk.0.attn_q.weight", (4, 8)) is None
+    assert policy.axes("blk.1.attn_q.weight", (4, 8)) == (1, 0)
+    assert policy.axes("blk.2.attn_q.weight", (4, 8)) is None
+    # rules only match tensors of len(axes) dimensions
+    assert policy.axes("blk.1.attn_q.weight", (4, 8, 2)) is None
+    assert policy.axes("output.weight", (4, 8)) == (1, 0)
+    with pytest.raises(GGUFException):
+        TransposePolicy([{"axes": [1, 0]}])
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from gguf import GGMLQuantizationType
+
+from constant import GGMLType, GGUFException
+from gguf_dequantize import dequantize
+from models.quantize_util import QuantizePolicy, quantize
+
+# relative rmse bound of gaussian rows, measured errors are about 2/3 of these
+RELATIVE_RMSE_BOUND_DICT = {
+    "Q8_0": 0.01,
+    "Q4_0": 0.12,
+    "Q4_1": 0.12,
+    "Q2_K": 0.35,
+    "Q3_K": 0.22,
+    "Q4_K": 0.11,
+    "Q6_K": 0.03,
+}
+
+
+@pytest.mark.parametrize("type_name", sorted(RELATIVE_RMSE_BOUND_DICT))
+def test_round_trip_error(type_name):
+    rng = np.random.default_rng(0)
+    tensor = rng.standard_normal((16, 512)).astype(np.float32)
+    encoded = quantize(tensor, GGMLQuantizationType[type_name])
+    decoded = dequantize(encoded, GGMLType[type_name])
+    assert decoded.shape == tensor.shape
+    rmse = np.sqrt(np.mean((decoded - tensor) ** 2)) / np.sqrt(np.mean(tensor ** 2))
+    assert rmse < RELATIVE_RMSE_BOUND_DICT[type_name]
+
+
+@pytest.mark.parametrize("type_name", sorted(RELATIVE_RMSE_BOUND_DICT))
+def test_zero_rows_decode_to_zero(type_name):
+    tensor = np.zeros((2, 256), dtype=np.float32)
+    decoded = dequantize(quantize(tensor, GGMLQuantizationType[type_name]), GGMLType[type_name])
+    np.testing.assert_array_equal(decoded, tensor)
+
+
+def test_rows_not_multiple_of_block_size_raise():
+    with pytest.raises(GGUFException):
+        quantize(np.zeros((2, 100), dtype=np.float32), GGMLQuantizationType.Q4_K)
+
+
+@pytest.mark.parametrize("fallback_type", ["F32", "F16", "auto"])
+def test_float_fallback_type_is_accepted(fallback_type):
+    QuantizePolicy(default_type="Q4_K", fallback_type=fallback_type)
+
+
+@pytest.mark.parametrize("fallback_type", ["Q4_0", "Q8_0"])
+def test_quantized_fallback_type_is_rejected(fallback_type):
+    with pytest.raises(GGUFException):
+        QuantizePolicy(default_type="Q4_K", fallback_type=fallback_type)
+
+
+def test_fallback_applies_to_rows_not_multiple_of_block_size():
+    policy = QuantizePolicy(default_type="Q4_K", fallback_type="F16")
+    assert policy.tensor_type("blk.0.attn_q.weight", (256, 256)) == GGMLQuantizationType.Q4_K
+    assert policy.tensor_type("blk.0.attn_q.weight", (256, 100)) == GGMLQuantizationType.F16
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from conftest import corrupt_magic
+from constant import GGUFException
+from read_gguf import GGUFLoader
+
+
+def test_corrupt_file_raises_on_lazy_access(tiny_fixtures, tmp_path):
+    loader = GGUFLoader(corrupt_magic(tiny_fixtures.gguf_path, str(tmp_path / "bad.gguf")))
+    with pytest.raises(GGUFException):
+        loader.tensor_names()
+    with pytest.raises(GGUFException):
+        "token_embd.weight" in loader
+    loader.close()
+
+
+def test_load_metadata_then_tensor_keeps_metadata_once(tiny_fixtures):
+    loader = GGUFLoader(tiny_fixtures.gguf_path)
+    try:
+        n_keys = len(loader.load_metadata())
+        assert n_keys == loader.metadata_kv_count
+        loader.tensor("token_embd.weight")
+        keys = [kv.key.string for kv in loader.metadata]
+        assert len(keys) == n_keys
+        assert len(set(keys)) == n_keys
+        # a second load replaces the parsed header again
+        loader.load()
+        assert len(loader.metadata) == n_keys
+        assert len(loader.tensor_names()) == loader.tensor_count
+    finally:
+        loader.close()
+
+
+def test_selected_metadata(tiny_fixtures):
+    loader = GGUFLoader(tiny_fixtures.gguf_path)
+    try:
+        metadata = loader.load_metadata(include=["llama.*"])
+        assert metadata
+        assert all(kv.key.string.startswith("llama.") for kv in metadata)
+    finally:
+        loader.close()
+
+
+def test_lazy_and_mapped_tensors_are_equal(tiny_fixtures):
+    lazy_loader = GGUFLoader(tiny_fixtures.gguf_path)
+    mapped_loader = GGUFLoader(tiny_fixtures.gguf_path, need=True)
+    try:
+        mapped_loader.load()
+        assert lazy_loader.tensor_names() == mapped_loader.tensor_names()
+        for name in lazy_loader:
+            np.testing.assert_array_equal(lazy_loader[name], mapped_loader[name])
+    finally:
+        lazy_loader.close()
+        mapped_loader.close()
+
+
+def test_dequantized_row_range(tiny_fixtures):
+    loader = GGUFLoader(tiny_fixtures.gguf_path)
+    try:
+        for name in loader.tensor_names():
+            full = loader.dequantized_tensor(name)
+            assert full.dtype == np.float32
+            if full.ndim < 2:
+                continue
+            np.testing.assert_array_equal(loader.dequantized_tensor(name, 3, 7), full[3:7])
+    finally:
+        loader.close()
@@ -0,0 +1,90 @@
+import glob
+import json
+import os
+
+import numpy as np
+import pytest
+
+from conftest import QUANTIZE_POLICY_JSON_PATH, write_gguf
+from constant import GGUFException
+from gguf_verify import verify_gguf
+from read_gguf import ALIGNMENT_KEY, SPLIT_COUNT_KEY, GGUFLoader
+
+
+@pytest.fixture()
+def outputs(tiny_fixtures, tmp_path):
+    single_path = str(tmp_path / "single.gguf")
+    write_gguf(tiny_fixtures, single_path, quantize_policy_json_path=QUANTIZE_POLICY_JSON_PATH)
+    write_gguf(tiny_fixtures, str(tmp_path / "split.gguf"), quantize_policy_json_path=QUANTIZE_POLICY_JSON_PATH,
+               max_shard_bytes=200000, shard_workers=2)
+    shard_paths = sorted(glob.glob(str(tmp_path / "split-*-of-*.gguf")))
+    return single_path, shard_paths
+
+
+def test_shards_read_back_as_single_file(outputs):
+    single_path, shard_paths = outputs
+    assert len(shard_paths) > 2
+    single = GGUFLoader(single_path)
+    split = GGUFLoader(shard_paths[0])
+    try:
+        assert split.tensor_names() == single.tensor_names()
+        assert int(split._metadata_value(SPLIT_COUNT_KEY)) == len(shard_paths)
+        for name in single:
+            np.testing.assert_array_equal(split[name], single[name])
+            np.testing.assert_array_equal(split.dequantized_tensor(name), single.dequantized_tensor(name))
+    finally:
+        single.close()
+        split.close()
+
+
+def test_shards_verify_with_digests_of_single_file(outputs):
+    single_path, shard_paths = outputs
+    single_report = verify_gguf(single_path, workers=2)
+    assert single_report.ok
+    split_report = verify_gguf(shard_paths[0], workers=2, expected_digests=single_report.digests())
+    assert split_report.ok
+    assert split_report.digests() == single_report.digests()
+
+
+def test_missing_shard_raises(outputs):
+    _, shard_paths = outputs
+    os.remove(shard_paths[-1])
+    loader = GGUFLoader(shard_paths[0])
+    with pytest.raises((GGUFException, OSError)):
+        loader.load()
+    loader.close()
+
+
+def test_shards_follow_alignment_of_metadata(tiny_fixtures, tmp_path):
+    with open(tiny_fixtures.metadata_json_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    metadata[ALIGNMENT_KEY] = 4096
+    paths = tiny_fixtures._replace(metadata_json_path=str(tmp_path / "metadata.json"))
+    with open(paths.metadata_json_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+    single_path = str(tmp_path / "single.gguf")
+    write_gguf(paths, single_path, quantize_policy_json_path=QUANTIZE_POLICY_JSON_PATH)
+    max_shard_bytes = 200000
+    write_gguf(paths, str(tmp_path / "split.gguf"), quantize_policy_json_path=QUANTIZE_POLICY_JSON_PATH,
+               max_shard_bytes=max_shard_bytes)
+    shard_paths = sorted(glob.glob(str(tmp_path / "split-*-of-*.gguf")))
+    assert len(shard_paths) > 2
+    for shard_path in shard_paths:
+        shard = GGUFLoader(shard_path)
+        shard.load(with_shards=False)
+        assert shard.alignment == 4096
+        assert all(shard.tensor_info(name).offset % 4096 == 0 for name in shard.tensor_names())
+        data_bytes = os.path.getsize(shard_path) - shard.data_offset
+        assert len(shard.tensor_names()) == 1 or data_bytes <= max_shard_bytes
+        shard.close()
+    single = GGUFLoader(single_path)
+    split = GGUFLoader(shard_paths[0])
+    try:
+        single.load()
+        split.load()
+        assert single.alignment == split.alignment == 4096
+        for name in single:
+            np.testing.assert_array_equal(split[name], single[name])
+    finally:
+        single.close()
+        split.close()
@@ -0,0 +1,28 @@
+import pytest
+
+from conftest import LAYER_NAME_MAP_JSON_PATH, TINY_CONFIG, corrupt_magic
+from benchmarks.fixtures import make_fixtures
+from constant import GGUFException
+from models.splice_writer import SpliceWriter
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("quant_types", [("Q4_K", "Q6_K", "Q8_0"), ("Q2_K", "Q3_K"), ("Q4_0", "Q4_1")])
+def test_splice_reproduces_reference(fixture_dir, tmp_path, quant_types):
+    # the reference holds the ckpt weights encoded by the same encoders, splicing them gives the same bytes
+    paths = make_fixtures(fixture_dir, TINY_CONFIG._replace(quant_types=quant_types))
+    output_path = str(tmp_path / "spliced.gguf")
+    SpliceWriter(paths.gguf_path, LAYER_NAME_MAP_JSON_PATH, paths.ckpt_path, output_path).write()
+    assert read_bytes(output_path) == read_bytes(paths.gguf_path)
+
+
+def test_corrupt_reference_raises(tiny_fixtures, tmp_path):
+    reference_path = corrupt_magic(tiny_fixtures.gguf_path, str(tmp_path / "bad.gguf"))
+    output_path = tmp_path / "spliced.gguf"
+    with pytest.raises(GGUFException):
+        SpliceWriter(reference_path, LAYER_NAME_MAP_JSON_PATH, tiny_fixtures.ckpt_path, str(output_path)).write()
+    assert not output_path.exists()
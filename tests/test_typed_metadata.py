@@ -0,0 +1,59 @@
+import json
+
+import numpy as np
+from gguf import GGUFWriter
+
+from conftest import write_gguf
+from gguf_typed_metadata import encode_metadata_kv, from_metadata_kv, load_metadata_json
+from models.make_gguf_meta_data_json import MetadataDumpHelper
+from read_gguf import GGUFLoader
+
+# header of magic, version, tensor count and kv count
+KV_SECTION_OFFSET = 24
+
+
+def write_typed_reference(gguf_path: str, plain_metadata_json_path: str):
+    """reference of the fixture metadata and keys of the types a plain json can not keep"""
+    with open(plain_metadata_json_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    writer = GGUFWriter(gguf_path, "llama")
+    writer.add_uint32("llama.block_count", metadata["llama.block_count"])
+    writer.add_uint64("general.size", 1 << 40)
+    writer.add_int32("general.offset", -7)
+    writer.add_float64("llama.rope.freq_base", 1e6 + 0.125)
+    writer.add_bool("general.flag", True)
+    writer.add_array("llama.layer_sizes", list(range(100)))
+    writer.add_array("tokenizer.ggml.scores", [float(score) for score in np.linspace(-1, 1, 300)])
+    writer.add_array("tokenizer.ggml.tokens", metadata["tokenizer.ggml.tokens"])
+    writer.add_array("general.nested", [[1, 2], [3]])
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.close()
+
+
+def kv_section(gguf_path: str):
+    loader = GGUFLoader(gguf_path)
+    metadata = loader.load_metadata()
+    loader.close()
+    n_bytes = sum(len(encode_metadata_kv(kv.key.string, from_metadata_kv(kv))) for kv in metadata)
+    with open(gguf_path, "rb") as f:
+        f.seek(KV_SECTION_OFFSET)
+        return [kv.key.string for kv in metadata], f.read(n_bytes)
+
+
+def test_typed_dump_and_write_keep_metadata_bytes(tiny_fixtures, tmp_path):
+    reference_path = str(tmp_path / "reference.gguf")
+    write_typed_reference(reference_path, tiny_fixtures.metadata_json_path)
+    typed_json_path = str(tmp_path / "typed.json")
+    MetadataDumpHelper(reference_path, typed_json_path, typed=True).dump_json_file()
+    # long numeric arrays go to the npz sidecar
+    assert (tmp_path / "typed.npz").is_file()
+    assert load_metadata_json(typed_json_path)["general.size"].value == 1 << 40
+
+    output_path = str(tmp_path / "output.gguf")
+    write_gguf(tiny_fixtures._replace(metadata_json_path=typed_json_path), output_path)
+    reference_keys, reference_bytes = kv_section(reference_path)
+    output_keys, output_bytes = kv_section(output_path)
+    # the writer appends the file type of the tensors it writes
+    assert output_keys == reference_keys + ["general.file_type"]
+    assert output_bytes.startswith(reference_bytes)